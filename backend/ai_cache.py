@@ -0,0 +1,184 @@
+"""
+AI 生成结果缓存 - 进程内 LRU + Redis 两级缓存
+"""
+import hashlib
+import json
+import logging
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import redis.asyncio as redis
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "ai:gen:"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化提示词: 统一全角/半角字符并合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def make_cache_key(
+    prompt: str,
+    diagram_type: str,
+    chart_type: Optional[str],
+    model: str,
+    temperature: float,
+    system_prompt: str
+) -> str:
+    """根据生成参数计算内容寻址的缓存键"""
+    material = json.dumps(
+        [normalize_prompt(prompt), diagram_type, chart_type, model, temperature, system_prompt],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """带 TTL 的进程内 LRU 缓存"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class AICache:
+    """AI 生成结果缓存
+
+    先查进程内 LRU,未命中再查 Redis (启用时),Redis 命中会回填进程内缓存。
+    Redis 不可用时只记录日志,不影响生成请求。
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(settings.AI_CACHE_MAX_ENTRIES, settings.AI_CACHE_TTL)
+        self.hits = 0
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.AI_CACHE_ENABLED
+
+    async def get(self, key: str) -> Optional[str]:
+        """读取缓存"""
+        if not self.enabled:
+            return None
+
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            self.memory_hits += 1
+            return value
+
+        client = get_redis()
+        if client is not None:
+            try:
+                value = await client.get(REDIS_KEY_PREFIX + key)
+            except redis.RedisError as e:
+                logger.warning("读取 Redis 缓存失败: %s", e)
+                value = None
+            if value is not None:
+                self.memory.set(key, value)
+                self.hits += 1
+                self.redis_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        """批量读取缓存,进程内未命中的键通过一次 MGET 从 Redis 读取"""
+        results: Dict[str, Optional[str]] = {key: None for key in keys}
+        if not self.enabled:
+            return results
+
+        missing = []
+        for key in results:
+            value = self.memory.get(key)
+            if value is None:
+                missing.append(key)
+                continue
+            results[key] = value
+            self.hits += 1
+            self.memory_hits += 1
+
+        client = get_redis()
+        if client is not None and missing:
+            try:
+                values = await client.mget([REDIS_KEY_PREFIX + key for key in missing])
+            except redis.RedisError as e:
+                logger.warning("读取 Redis 缓存失败: %s", e)
+                values = [None] * len(missing)
+            for key, value in zip(missing, values):
+                if value is not None:
+                    self.memory.set(key, value)
+                    results[key] = value
+                    self.hits += 1
+                    self.redis_hits += 1
+
+        self.misses += sum(1 for key in missing if results[key] is None)
+        return results
+
+    async def set(self, key: str, value: str):
+        """写入缓存"""
+        if not self.enabled or not value:
+            return
+
+        self.memory.set(key, value)
+        client = get_redis()
+        if client is not None:
+            try:
+                await client.set(REDIS_KEY_PREFIX + key, value, ex=settings.AI_CACHE_TTL)
+            except redis.RedisError as e:
+                logger.warning("写入 Redis 缓存失败: %s", e)
+
+    def stats(self) -> dict:
+        """缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "redis_enabled": get_redis() is not None,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "memory_entries": len(self.memory),
+            "max_entries": self.memory.max_entries,
+        }
+
+
+# 全局 AI 缓存实例
+ai_cache = AICache()
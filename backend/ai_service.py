@@ -1,10 +1,121 @@
 """
 AI 服务模块 - 集成 Google Gemini 和 AIHubMix
 """
-from typing import Optional, Literal
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, List, Optional, Literal, Dict, AsyncIterator, Tuple
 import httpx
+from fastapi import HTTPException
 from config import settings
 from models import DiagramTypeEnum
+from ai_cache import ai_cache, make_cache_key
+from singleflight import SingleFlight
+from latency import LatencyHistogram
+from rate_limit import upstream_governor, rate_limited
+from resilience import CircuitBreaker, backoff_delay, is_retryable, is_upstream_failure
+from mermaid_validator import CHART_KEYWORDS, ValidationResult, detect_chart_type, validate_mermaid
+from prompts import (
+    build_refine_prompt,
+    build_system_prompt,
+    estimate_tokens,
+    excalidraw_auto_layout,
+    max_output_tokens,
+    refine_max_output_tokens,
+)
+from diagram_patch import PatchError, apply_json_patch, apply_line_patch, number_lines, parse_patch
+from excalidraw_parser import ParseResult, excalidraw_payload, parse_elements
+from layout import layout_topology
+from mermaid_converter import CONVERTIBLE_CHART_TYPES, ConversionError, mermaid_to_elements
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 依赖 h2 包,未安装时自动回退到 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com"
+
+Provider = Literal["gemini", "aihubmix"]
+
+# 模型输出中可能出现的 markdown 代码块标记
+FENCE_MARKERS = ("```mermaid", "```json", "```")
+
+
+class FenceStripper:
+    """增量去除流式输出中的 markdown 代码块标记
+    
+    标记可能被拆分在多个分片中,因此末尾可能构成标记前缀的内容会暂存,
+    直到能确定其是否为标记。首部与尾部空白与非流式接口一样被去除。
+    """
+    
+    def __init__(self):
+        self._buffer = ""
+        self._started = False
+        self._pending_ws = ""
+    
+    def feed(self, chunk: str) -> str:
+        """输入一个分片,返回可以安全输出的文本"""
+        self._buffer += chunk
+        out = []
+        while True:
+            index = self._buffer.find("`")
+            if index < 0:
+                out.append(self._buffer)
+                self._buffer = ""
+                break
+            out.append(self._buffer[:index])
+            self._buffer = self._buffer[index:]
+            marker = next((m for m in FENCE_MARKERS if self._buffer.startswith(m)), None)
+            if marker is None:
+                if any(m.startswith(self._buffer) for m in FENCE_MARKERS):
+                    # 可能是被截断的标记,等待后续分片
+                    break
+                out.append(self._buffer[0])
+                self._buffer = self._buffer[1:]
+                continue
+            if marker == "```" and any(
+                m.startswith(self._buffer) for m in FENCE_MARKERS if m != "```"
+            ):
+                # "```" 之后可能还跟着 mermaid/json
+                break
+            self._buffer = self._buffer[len(marker):]
+        return self._emit("".join(out))
+    
+    def flush(self) -> str:
+        """流结束时输出剩余内容"""
+        rest = self._buffer
+        self._buffer = ""
+        for marker in FENCE_MARKERS:
+            rest = rest.replace(marker, "")
+        self._pending_ws = ""
+        return self._emit(rest.rstrip(), final=True)
+    
+    def _emit(self, text: str, final: bool = False) -> str:
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+        text = self._pending_ws + text
+        # 尾部空白暂存,避免输出最终会被 strip 的内容
+        stripped = text.rstrip()
+        self._pending_ws = "" if final else text[len(stripped):]
+        return stripped
+
+
+async def _iter_sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """解析上游 SSE 响应,逐条产出 data 字段"""
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data:
+                yield data
 
 
 class AIService:
@@ -12,31 +123,660 @@ class AIService:
     
     def __init__(self):
         self.provider = settings.AI_PROVIDER
+        # 每个提供商一个长连接客户端,复用 TCP/TLS 连接
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        # 相同缓存键的并发生成请求合并为一次上游调用
+        self.singleflight = SingleFlight("ai")
+        # 各提供商延迟分布,用于计算对冲等待时间
+        self.latency: Dict[Provider, LatencyHistogram] = {
+            "gemini": LatencyHistogram(),
+            "aihubmix": LatencyHistogram(),
+        }
+        self.hedges = 0
+        self.hedge_wins = 0
+        # 各提供商熔断器,以及重试与熔断改道统计
+        self.breakers: Dict[Provider, CircuitBreaker] = {
+            "gemini": CircuitBreaker("gemini"),
+            "aihubmix": CircuitBreaker("aihubmix"),
+        }
+        self.retries = 0
+        self.reroutes = 0
+        # Mermaid 校验统计
+        self.mermaid_repaired = 0
+        self.mermaid_reprompts = 0
+        self.mermaid_invalid = 0
+        # Excalidraw 输出解析统计
+        self.excalidraw_dropped = 0
+        self.excalidraw_truncated = 0
+        self.excalidraw_invalid = 0
+        # 由缓存的 Mermaid 结果直接转换为 Excalidraw 的次数
+        self.mermaid_conversions = 0
+        # 批量生成统计
+        self.batches = 0
+        self.batch_targets = 0
+        self.batch_shared = 0
+        # 增量修改统计
+        self.refines = 0
+        self.refine_retries = 0
+        self.refine_failures = 0
+    
+    def _create_client(self, base_url: str) -> httpx.AsyncClient:
+        """创建带连接池的 HTTP 客户端"""
+        limits = httpx.Limits(
+            max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.AI_HTTP_KEEPALIVE_EXPIRY,
+        )
+        # 连接阶段快速失败,读取阶段给模型留足生成时间
+        timeout = httpx.Timeout(
+            settings.AI_HTTP_TIMEOUT,
+            connect=settings.AI_HTTP_CONNECT_TIMEOUT,
+            read=settings.AI_HTTP_READ_TIMEOUT,
+            write=settings.AI_HTTP_WRITE_TIMEOUT,
+            pool=settings.AI_HTTP_POOL_TIMEOUT,
+        )
+        return httpx.AsyncClient(
+            base_url=base_url,
+            limits=limits,
+            timeout=timeout,
+            http2=settings.AI_HTTP_HTTP2 and HTTP2_AVAILABLE,
+        )
+    
+    def _get_client(self, provider: Provider) -> httpx.AsyncClient:
+        """获取提供商对应的共享客户端,未初始化时按需创建"""
+        client = self._clients.get(provider)
+        if client is None or client.is_closed:
+            base_url = GEMINI_BASE_URL if provider == "gemini" else settings.AIHUBMIX_BASE_URL
+            client = self._create_client(base_url)
+            self._clients[provider] = client
+        return client
+    
+    async def startup(self):
+        """应用启动时创建连接池"""
+        self._get_client("gemini")
+        self._get_client("aihubmix")
+    
+    async def shutdown(self):
+        """应用关闭时释放连接池"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+    
+    def cache_key(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model: Optional[str] = None,
+        chart_type: Optional[str] = "flowchart"
+    ) -> str:
+        """计算生成请求的缓存键"""
+        model_name = model or settings.GEMINI_MODEL
+        return make_cache_key(
+            prompt,
+            diagram_type.value,
+            chart_type,
+            model_name,
+            settings.AI_TEMPERATURE,
+            self._get_system_prompt(diagram_type, chart_type)
+        )
     
     async def generate_diagram(
         self,
         prompt: str,
         diagram_type: DiagramTypeEnum,
         model: Optional[str] = None,
+        chart_type: Optional[str] = "flowchart",
+        use_cache: bool = True
+    ) -> str:
+        """生成图形代码
+        
+        use_cache=False 时跳过缓存读取且直接调用模型,不与其他请求共享结果,新结果仍会写入缓存。
+        缓存未命中时,相同键的并发请求共享同一次上游调用。
+        请求 Excalidraw 而相同需求的 Mermaid 结果已缓存时,直接转换而不调用模型。
+        """
+        self._check_prompt_budget(prompt)
+        model_name = model or settings.GEMINI_MODEL
+        key = self.cache_key(prompt, diagram_type, model_name, chart_type)
+        
+        if not use_cache:
+            return await self._generate_and_store(key, prompt, diagram_type, model_name, chart_type)
+        
+        cached = await ai_cache.get(key)
+        if cached is None and diagram_type == DiagramTypeEnum.EXCALIDRAW:
+            cached = await self._convert_cached_mermaid(key, prompt, model_name, chart_type)
+        if cached is not None:
+            return cached
+        return await self._generate_shared(key, prompt, diagram_type, model_name, chart_type)
+    
+    async def _generate_and_store(
+        self,
+        key: str,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model_name: str,
+        chart_type: Optional[str]
+    ) -> str:
+        """调用模型生成,校验后写入缓存"""
+        result = await self._generate(prompt, diagram_type, model_name, chart_type)
+        if diagram_type == DiagramTypeEnum.MERMAID:
+            result = await self._ensure_valid_mermaid(result, prompt, model_name, chart_type)
+        else:
+            result = self.normalize_excalidraw(await self.parse_excalidraw_async(result), result)
+        await ai_cache.set(key, result)
+        return result
+    
+    async def _generate_shared(
+        self,
+        key: str,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model_name: str,
+        chart_type: Optional[str]
+    ) -> str:
+        """缓存未命中时生成,相同键的并发请求共享同一次上游调用"""
+        return await self.singleflight.do(
+            key,
+            lambda: self._generate_and_store(key, prompt, diagram_type, model_name, chart_type),
+            lookup=lambda: ai_cache.get(key)
+        )
+    
+    async def generate_batch(
+        self,
+        prompt: str,
+        targets: List[Tuple[DiagramTypeEnum, Optional[str], Optional[str]]],
+        use_cache: bool = True
+    ) -> AsyncIterator[Tuple[int, Optional[str], Optional[BaseException]]]:
+        """并发生成同一需求的多个目标 (图形类型, 模型, 图表类型),按完成顺序产出 (目标下标, 结果, 异常)
+        
+        需求长度只检查一次,所有目标的缓存一次批量读取,相同目标只生成一次。
+        Excalidraw 目标在同一批次中有相同模型与图表类型的 Mermaid 目标时,等待其结果后直接转换。
+        单个批次同时进行的上游调用不超过 AI_BATCH_MAX_CONCURRENCY,并且仍受进程级上游并发限制。
+        """
+        self._check_prompt_budget(prompt)
+        self.batches += 1
+        self.batch_targets += len(targets)
+        
+        specs: Dict[str, Tuple[DiagramTypeEnum, str, Optional[str]]] = {}
+        indices: Dict[str, List[int]] = {}
+        for index, (diagram_type, model, chart_type) in enumerate(targets):
+            model_name = model or settings.GEMINI_MODEL
+            key = self.cache_key(prompt, diagram_type, model_name, chart_type)
+            specs[key] = (diagram_type, model_name, chart_type)
+            indices.setdefault(key, []).append(index)
+        self.batch_shared += len(targets) - len(specs)
+        
+        # Excalidraw 目标可由对应的 Mermaid 结果转换得到
+        sources = {
+            key: self.cache_key(prompt, DiagramTypeEnum.MERMAID, model_name, chart_type)
+            for key, (diagram_type, model_name, chart_type) in specs.items()
+            if diagram_type == DiagramTypeEnum.EXCALIDRAW and chart_type in CONVERTIBLE_CHART_TYPES
+        }
+        cached: Dict[str, Optional[str]] = {}
+        if use_cache:
+            cached = await ai_cache.get_many(list(dict.fromkeys([*specs, *sources.values()])))
+        
+        semaphore = asyncio.Semaphore(settings.AI_BATCH_MAX_CONCURRENCY)
+        tasks: Dict[str, asyncio.Task] = {}
+        
+        async def generate(key: str) -> str:
+            if cached.get(key) is not None:
+                return cached[key]
+            source = sources.get(key)
+            if source is not None:
+                code = cached.get(source)
+                if code is None and source in tasks:
+                    # 等待同批次的 Mermaid 目标,不占用上游名额
+                    try:
+                        code = await asyncio.shield(tasks[source])
+                    except Exception:
+                        code = None
+                if code is not None:
+                    converted = await self._store_conversion(key, code)
+                    if converted is not None:
+                        return converted
+            diagram_type, model_name, chart_type = specs[key]
+            # 缓存已批量读取过,这里直接生成;跳过缓存时不与其他请求共享结果
+            generate_target = self._generate_shared if use_cache else self._generate_and_store
+            async with semaphore:
+                return await generate_target(key, prompt, diagram_type, model_name, chart_type)
+        
+        for key in specs:
+            tasks[key] = asyncio.create_task(generate(key))
+        keys = {task: key for key, task in tasks.items()}
+        pending = set(tasks.values())
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    result = None if error is not None else task.result()
+                    for index in indices[keys[task]]:
+                        yield index, result, error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    def _check_prompt_budget(self, prompt: str):
+        """需求描述超过输入预算时返回 413"""
+        tokens = estimate_tokens(prompt)
+        if tokens > settings.AI_MAX_INPUT_TOKENS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"需求描述过长 (约 {tokens} tokens),请精简到 {settings.AI_MAX_INPUT_TOKENS} tokens 以内"
+            )
+    
+    async def _generate(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model_name: str,
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> str:
+        """调用上游模型生成,启用对冲模式时可能同时请求两个提供商"""
+        provider, model_name = self._route(model_name)
+        fallback = self._hedge_target(provider)
+        
+        if not settings.AI_HEDGE_ENABLED or fallback is None:
+            return await self._call_provider(
+                provider, prompt, diagram_type, model_name, chart_type, system_prompt, max_tokens
+            )
+        
+        return await self._generate_hedged(
+            provider, model_name, fallback, prompt, diagram_type, chart_type, system_prompt, max_tokens
+        )
+    
+    def _provider_for(self, model_name: str) -> Provider:
+        """根据模型名判断使用哪个提供商"""
+        # Gemini 模型以 "gemini" 开头,其他模型使用 AIHubMix
+        return "gemini" if model_name.startswith("gemini") else "aihubmix"
+    
+    def _route(self, model_name: str) -> Tuple[Provider, str]:
+        """选择提供商,主提供商熔断时改用另一个可用的提供商"""
+        provider = self._provider_for(model_name)
+        fallback = self._hedge_target(provider)
+        if (
+            settings.AI_BREAKER_ENABLED
+            and not self.breakers[provider].available
+            and fallback is not None
+            and self.breakers[fallback[0]].available
+        ):
+            self.reroutes += 1
+            return fallback
+        return provider, model_name
+    
+    def _check_breaker(self, provider: Provider):
+        """熔断打开时直接返回 503"""
+        breaker = self.breakers[provider]
+        if not breaker.allow():
+            raise HTTPException(
+                status_code=503,
+                detail="AI 提供商暂时不可用,请稍后重试",
+                headers={"Retry-After": str(max(1, int(breaker.retry_after + 0.999)))}
+            )
+    
+    def _record_failure(self, provider: Provider, exc: BaseException):
+        """按异常类型更新熔断器"""
+        breaker = self.breakers[provider]
+        if is_upstream_failure(exc):
+            breaker.record_failure()
+        else:
+            breaker.release_probe()
+    
+    def _upstream_error(self, exc: Exception) -> HTTPException:
+        """重试耗尽后,提供商故障以 502 返回而不是笼统的 500"""
+        return HTTPException(status_code=502, detail=f"AI 提供商暂时不可用: {exc}")
+    
+    def _hedge_target(self, provider: Provider) -> Optional[Tuple[Provider, str]]:
+        """对冲请求使用的另一个提供商及模型,未配置密钥时返回 None"""
+        if provider == "gemini":
+            return ("aihubmix", settings.AIHUBMIX_MODEL) if settings.AIHUBMIX_API_KEY else None
+        return ("gemini", settings.GEMINI_MODEL) if settings.GEMINI_API_KEY else None
+    
+    def _hedge_delay(self, provider: Provider) -> float:
+        """对冲等待时间: 主提供商近期延迟的分位数,样本不足时使用默认值"""
+        histogram = self.latency[provider]
+        if histogram.samples < settings.AI_HEDGE_MIN_SAMPLES:
+            delay = settings.AI_HEDGE_DEFAULT_DELAY
+        else:
+            delay = histogram.percentile(settings.AI_HEDGE_PERCENTILE)
+        return min(settings.AI_HEDGE_MAX_DELAY, max(settings.AI_HEDGE_MIN_DELAY, delay))
+    
+    @asynccontextmanager
+    async def _upstream(self, provider: Provider) -> AsyncIterator[None]:
+        """上游调用的限流与并发控制,提供商返回 429 时进入退避并向客户端返回 429"""
+        async with upstream_governor.slot(provider):
+            try:
+                yield
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 429:
+                    raise
+                delay = await upstream_governor.throttled(provider, e.response.headers.get("Retry-After"))
+                raise rate_limited(delay, "AI 提供商限流,请稍后重试") from e
+            upstream_governor.succeeded(provider)
+    
+    async def _call_provider(
+        self,
+        provider: Provider,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model_name: str,
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> str:
+        """调用指定提供商并记录成功请求的耗时
+        
+        连接错误与 5xx 按指数退避加抖动重试,熔断打开时直接失败。
+        """
+        attempt = 0
+        while True:
+            self._check_breaker(provider)
+            try:
+                async with self._upstream(provider):
+                    started = time.monotonic()
+                    if provider == "gemini":
+                        result = await self._generate_with_gemini(
+                            prompt, diagram_type, model_name, chart_type, system_prompt, max_tokens
+                        )
+                    else:
+                        result = await self._generate_with_aihubmix(
+                            prompt, diagram_type, model_name, chart_type, system_prompt, max_tokens
+                        )
+                    self.latency[provider].observe(time.monotonic() - started)
+            except asyncio.CancelledError:
+                self.breakers[provider].release_probe()
+                raise
+            except Exception as e:
+                self._record_failure(provider, e)
+                attempt += 1
+                if attempt >= settings.AI_RETRY_MAX_ATTEMPTS or not is_retryable(e):
+                    if is_upstream_failure(e):
+                        raise self._upstream_error(e) from e
+                    raise
+                self.retries += 1
+                await asyncio.sleep(backoff_delay(attempt - 1))
+                continue
+            self.breakers[provider].record_success()
+            return result
+    
+    async def _generate_hedged(
+        self,
+        provider: Provider,
+        model_name: str,
+        fallback: Tuple[Provider, str],
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> str:
+        """对冲请求: 主提供商超过分位延迟未返回时,再向另一个提供商发起请求
+        
+        先返回有效结果的请求胜出,其余请求被取消
+        """
+        primary = asyncio.ensure_future(
+            self._call_provider(
+                provider, prompt, diagram_type, model_name, chart_type, system_prompt, max_tokens
+            )
+        )
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay(provider))
+            if primary in done and primary.exception() is None and primary.result():
+                return primary.result()
+            
+            # 主请求过慢或已失败,发起对冲请求
+            fallback_provider, fallback_model = fallback
+            self.hedges += 1
+            hedge = asyncio.ensure_future(
+                self._call_provider(
+                    fallback_provider, prompt, diagram_type, fallback_model, chart_type, system_prompt, max_tokens
+                )
+            )
+            tasks.add(hedge)
+            
+            pending = {task for task in tasks if not task.done()}
+            error: Optional[BaseException] = primary.exception() if primary.done() else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result():
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+            
+            raise error or ValueError("AI 生成失败,未返回有效内容")
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    def provider_stats(self) -> dict:
+        """各提供商延迟分布、对冲与 Mermaid 校验统计"""
+        return {
+            "hedge_enabled": settings.AI_HEDGE_ENABLED,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": {provider: self._hedge_delay(provider) for provider in self.latency},
+            "upstream": upstream_governor.stats(),
+            "retries": self.retries,
+            "reroutes": self.reroutes,
+            "breakers": {provider: breaker.snapshot() for provider, breaker in self.breakers.items()},
+            "latency": {provider: histogram.snapshot() for provider, histogram in self.latency.items()},
+            "prompt_tokens": {
+                chart_type: estimate_tokens(self._get_system_prompt(DiagramTypeEnum.MERMAID, chart_type))
+                for chart_type in CHART_KEYWORDS
+            },
+            "refine": {
+                "requests": self.refines,
+                "retries": self.refine_retries,
+                "failures": self.refine_failures,
+            },
+            "mermaid_validation": {
+                "enabled": settings.AI_MERMAID_VALIDATE,
+                "repaired": self.mermaid_repaired,
+                "reprompts": self.mermaid_reprompts,
+                "invalid": self.mermaid_invalid,
+            },
+            "excalidraw_parsing": {
+                "dropped_elements": self.excalidraw_dropped,
+                "truncated": self.excalidraw_truncated,
+                "invalid": self.excalidraw_invalid,
+                "mermaid_conversions": self.mermaid_conversions,
+            },
+            "batch": {
+                "requests": self.batches,
+                "targets": self.batch_targets,
+                "deduplicated": self.batch_shared,
+            },
+        }
+    
+    def check_mermaid(self, code: str, chart_type: Optional[str] = "flowchart") -> Optional[ValidationResult]:
+        """确定性校验与修复,未启用校验或图形类型不受支持时返回 None"""
+        if not settings.AI_MERMAID_VALIDATE or chart_type not in CHART_KEYWORDS:
+            return None
+        check = validate_mermaid(code, chart_type)
+        if check.repaired:
+            self.mermaid_repaired += 1
+        return check
+    
+    async def _ensure_valid_mermaid(
+        self,
+        code: str,
+        prompt: str,
+        model_name: str,
         chart_type: Optional[str] = "flowchart"
     ) -> str:
-        """生成图形代码"""
-        # 根据模型名判断使用哪个提供商
+        """校验 Mermaid 输出,仅在确定性修复失败时重新请求模型"""
+        check = self.check_mermaid(code, chart_type)
+        if check is None:
+            return code
+        
+        retries = 0
+        while not check.valid and retries < settings.AI_MERMAID_REPAIR_RETRIES:
+            retries += 1
+            self.mermaid_reprompts += 1
+            problems = "\n".join(f"- {error}" for error in check.errors)
+            repair_prompt = (
+                f"{prompt}\n\n上一次生成的代码存在以下语法问题,请修正后重新输出完整代码:\n"
+                f"{problems}\n\n上一次生成的代码:\n{check.code}"
+            )
+            code = await self._generate(repair_prompt, DiagramTypeEnum.MERMAID, model_name, chart_type)
+            check = self.check_mermaid(code, chart_type)
+        
+        if not check.valid:
+            self.mermaid_invalid += 1
+            logger.warning("Mermaid 输出校验失败: %s", "; ".join(check.errors))
+        return check.code
+    
+    async def _convert_cached_mermaid(
+        self,
+        key: str,
+        prompt: str,
+        model_name: str,
+        chart_type: Optional[str]
+    ) -> Optional[str]:
+        """相同需求的 Mermaid 结果已缓存时确定性转换为 Excalidraw 元素,并写入 Excalidraw 的缓存"""
+        if chart_type not in CONVERTIBLE_CHART_TYPES:
+            return None
+        code = await ai_cache.get(self.cache_key(prompt, DiagramTypeEnum.MERMAID, model_name, chart_type))
+        if code is None:
+            return None
+        return await self._store_conversion(key, code)
+    
+    async def _store_conversion(self, key: str, code: str) -> Optional[str]:
+        """把 Mermaid 代码转换为 Excalidraw 元素并写入缓存,无法转换时返回 None"""
+        try:
+            elements = await asyncio.to_thread(mermaid_to_elements, code)
+        except ConversionError as e:
+            logger.info("缓存的 Mermaid 结果无法转换: %s", e)
+            return None
+        self.mermaid_conversions += 1
+        result = json.dumps(elements, ensure_ascii=False, separators=(",", ":"))
+        await ai_cache.set(key, result)
+        return result
+    
+    def parse_excalidraw(self, text: str) -> ParseResult:
+        """解析 Excalidraw 输出: 自动布局模式下模型只输出节点与连线,在此计算坐标"""
+        if excalidraw_auto_layout():
+            return layout_topology(text)
+        return parse_elements(text)
+    
+    async def parse_excalidraw_async(self, text: str) -> ParseResult:
+        """在线程中解析 Excalidraw 输出,自动布局的计算不阻塞事件循环"""
+        return await asyncio.to_thread(self.parse_excalidraw, text)
+    
+    def normalize_excalidraw(self, result: ParseResult, text: str) -> str:
+        """只保留校验通过的 Excalidraw 元素,序列化为紧凑的 JSON 数组
+
+        输出中没有元素数组时原样返回 (由前端按 Mermaid 代码转换);
+        有数组但没有任何有效元素时返回 502,结果不写入缓存。
+        """
+        if not result.found_array:
+            return text
+        self.excalidraw_dropped += len(result.errors)
+        if result.truncated:
+            self.excalidraw_truncated += 1
+        if result.warnings:
+            logger.warning("Excalidraw 输出存在问题: %s", "; ".join(result.warnings))
+        if not result.elements:
+            self.excalidraw_invalid += 1
+            raise HTTPException(status_code=502, detail="AI 未返回有效的 Excalidraw 元素")
+        return json.dumps(result.elements, ensure_ascii=False, separators=(",", ":"))
+    
+    async def refine_diagram(
+        self,
+        diagram_type: DiagramTypeEnum,
+        instruction: str,
+        mermaid_code: Optional[str] = None,
+        excalidraw_data: Any = None,
+        model: Optional[str] = None
+    ) -> Tuple[Any, List[dict]]:
+        """按修改指令增量修改图形,返回 (修改后的内容, 补丁)
+        
+        模型只输出补丁,输出长度随修改规模而不是图形大小增长;
+        补丁无法应用或修改结果校验失败时,带着错误信息重新请求。
+        """
+        self._check_prompt_budget(instruction)
         model_name = model or settings.GEMINI_MODEL
+        system_prompt = build_refine_prompt(diagram_type)
+        max_tokens = refine_max_output_tokens(instruction)
         
-        # Gemini 模型以 "gemini" 开头
-        if model_name.startswith("gemini"):
-            return await self._generate_with_gemini(prompt, diagram_type, model_name, chart_type)
-        # 其他模型使用 AIHubMix
+        if diagram_type == DiagramTypeEnum.MERMAID:
+            mermaid_code = mermaid_code or ""
+            chart_type = detect_chart_type(mermaid_code) or "flowchart"
+            source = f"现有代码:\n{number_lines(mermaid_code)}"
         else:
-            return await self._generate_with_aihubmix(prompt, diagram_type, model_name, chart_type)
+            chart_type = None
+            data = json.dumps(excalidraw_data, ensure_ascii=False, separators=(",", ":"))
+            source = f"现有数据:\n{data}"
+        prompt = f"{source}\n\n修改指令: {instruction}"
+        
+        self.refines += 1
+        error = None
+        for attempt in range(settings.AI_REFINE_RETRIES + 1):
+            request = prompt
+            if error is not None:
+                self.refine_retries += 1
+                request = f"{prompt}\n\n上一次返回的补丁无法使用: {error}\n请修正后重新输出补丁。"
+            output = await self._generate(
+                request, diagram_type, model_name, chart_type, system_prompt, max_tokens
+            )
+            try:
+                if diagram_type == DiagramTypeEnum.MERMAID:
+                    return self._apply_mermaid_patch(mermaid_code, output, chart_type)
+                return self._apply_excalidraw_patch(excalidraw_data, output)
+            except PatchError as e:
+                error = str(e)
+        
+        self.refine_failures += 1
+        raise HTTPException(status_code=422, detail=f"AI 返回的修改无法应用: {error}")
+    
+    def _apply_mermaid_patch(self, code: str, output: str, chart_type: str) -> Tuple[str, List[dict]]:
+        """应用 Mermaid 行级补丁并校验结果"""
+        try:
+            ops = parse_patch(output)
+        except PatchError:
+            # 模型未按要求返回补丁而是返回了完整代码时,视为整体替换
+            if detect_chart_type(output) is None:
+                raise
+            total = len(code.splitlines())
+            if total:
+                ops = [{"op": "replace", "start": 1, "end": total, "lines": output.splitlines()}]
+            else:
+                ops = [{"op": "insert", "after": 0, "lines": output.splitlines()}]
+        
+        new_code = apply_line_patch(code, ops)
+        check = self.check_mermaid(new_code, chart_type)
+        if check is not None:
+            if not check.valid:
+                raise PatchError("修改后的代码存在语法问题: " + "; ".join(check.errors))
+            new_code = check.code
+        return new_code, ops
+    
+    def _apply_excalidraw_patch(self, data: Any, output: str) -> Tuple[dict, List[dict]]:
+        """应用 Excalidraw JSON Patch,结果必须仍是带 elements 列表的场景对象"""
+        ops = parse_patch(output)
+        new_data = apply_json_patch(data, ops)
+        if not isinstance(new_data, dict):
+            raise PatchError("修改后的数据必须是对象")
+        if not isinstance(new_data.get("elements"), list):
+            raise PatchError("修改后的数据缺少 elements 列表")
+        return new_data, ops
     
     async def _generate_with_gemini(
         self,
         prompt: str,
         diagram_type: DiagramTypeEnum,
         model: Optional[str] = None,
-        chart_type: Optional[str] = "flowchart"
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
     ) -> str:
         """使用 Google Gemini 生成"""
         if not settings.GEMINI_API_KEY:
@@ -44,38 +784,19 @@ class AIService:
         
         model_name = model or settings.GEMINI_MODEL
         
-        # 构建系统提示词
-        system_prompt = self._get_system_prompt(diagram_type, chart_type)
-        
         # 调用 Gemini API
-        url = f"https://generativelanguage.googleapis.com/v1/models/{model_name}:generateContent"
+        url = f"/v1/models/{model_name}:generateContent"
+        payload = self._build_gemini_payload(prompt, diagram_type, chart_type, system_prompt, max_tokens)
         
-        headers = {
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
-            "contents": [{
-                "parts": [{
-                    "text": f"{system_prompt}\n\n用户需求: {prompt}"
-                }]
-            }],
-            "generationConfig": {
-                "temperature": settings.AI_TEMPERATURE,
-                "maxOutputTokens": settings.AI_MAX_TOKENS,
-            }
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                headers=headers,
-                json=payload,
-                params={"key": settings.GEMINI_API_KEY},
-                timeout=60.0
-            )
-            response.raise_for_status()
-            data = response.json()
+        client = self._get_client("gemini")
+        response = await client.post(
+            url,
+            headers={"Content-Type": "application/json"},
+            json=payload,
+            params={"key": settings.GEMINI_API_KEY}
+        )
+        response.raise_for_status()
+        data = response.json()
         
         # 提取生成的代码
         if "candidates" in data and len(data["candidates"]) > 0:
@@ -91,21 +812,223 @@ class AIService:
         prompt: str,
         diagram_type: DiagramTypeEnum,
         model: Optional[str] = None,
-        chart_type: Optional[str] = "flowchart"
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
     ) -> str:
         """使用 AIHubMix 生成"""
         if not settings.AIHUBMIX_API_KEY:
             raise ValueError("未配置 AIHUBMIX_API_KEY")
         
         model_name = model or settings.AIHUBMIX_MODEL
-        system_prompt = self._get_system_prompt(diagram_type, chart_type)
         
-        url = f"{settings.AIHUBMIX_BASE_URL}/v1/chat/completions"
+        url = "/v1/chat/completions"
+        payload = self._build_aihubmix_payload(
+            prompt, diagram_type, model_name, chart_type, system_prompt, max_tokens
+        )
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {settings.AIHUBMIX_API_KEY}"
+        client = self._get_client("aihubmix")
+        response = await client.post(
+            url,
+            headers=self._aihubmix_headers(),
+            json=payload
+        )
+        response.raise_for_status()
+        data = response.json()
+        
+        # 提取生成的代码
+        if "choices" in data and len(data["choices"]) > 0:
+            text = data["choices"][0]["message"]["content"]
+            text = text.replace("```mermaid", "").replace("```json", "").replace("```", "").strip()
+            return text
+        
+        raise ValueError("AI 生成失败,未返回有效内容")
+    
+    async def stream_diagram(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model: Optional[str] = None,
+        chart_type: Optional[str] = "flowchart",
+        use_cache: bool = True
+    ) -> AsyncIterator[str]:
+        """流式生成图形代码,逐段产出已去除代码块标记的文本
+        
+        缓存命中时一次性产出完整结果
+        """
+        self._check_prompt_budget(prompt)
+        model_name = model or settings.GEMINI_MODEL
+        key = self.cache_key(prompt, diagram_type, model_name, chart_type)
+        
+        if use_cache:
+            cached = await ai_cache.get(key)
+            if cached is None and diagram_type == DiagramTypeEnum.EXCALIDRAW:
+                cached = await self._convert_cached_mermaid(key, prompt, model_name, chart_type)
+            if cached is not None:
+                yield cached
+                return
+        
+        provider, upstream_model = self._route(model_name)
+        stripper = FenceStripper()
+        parts = []
+        attempt = 0
+        while True:
+            self._check_breaker(provider)
+            if provider == "gemini":
+                chunks = self._stream_with_gemini(prompt, diagram_type, upstream_model, chart_type)
+            else:
+                chunks = self._stream_with_aihubmix(prompt, diagram_type, upstream_model, chart_type)
+            
+            settled = False
+            try:
+                async with self._upstream(provider):
+                    async for chunk in chunks:
+                        text = stripper.feed(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+                settled = True
+            except Exception as e:
+                settled = True
+                self._record_failure(provider, e)
+                attempt += 1
+                # 已有内容输出后无法透明重试
+                if parts or attempt >= settings.AI_RETRY_MAX_ATTEMPTS or not is_retryable(e):
+                    if is_upstream_failure(e):
+                        raise self._upstream_error(e) from e
+                    raise
+                self.retries += 1
+                stripper = FenceStripper()
+                await asyncio.sleep(backoff_delay(attempt - 1))
+                continue
+            finally:
+                # 取消或消费方在 yield 处关闭生成器 (GeneratorExit) 时既不算成功也不算失败,归还探测名额
+                if not settled:
+                    self.breakers[provider].release_probe()
+            self.breakers[provider].record_success()
+            break
+        
+        tail = stripper.flush()
+        if tail:
+            parts.append(tail)
+            yield tail
+        
+        # 流式输出无法在中途修复,只缓存校验通过的结果
+        text = "".join(parts)
+        if diagram_type == DiagramTypeEnum.MERMAID:
+            check = self.check_mermaid(text, chart_type)
+            if check is not None:
+                if not check.valid:
+                    return
+                text = check.code
+        else:
+            try:
+                text = self.normalize_excalidraw(await self.parse_excalidraw_async(text), text)
+            except HTTPException:
+                return
+        await ai_cache.set(key, text)
+    
+    async def _stream_with_gemini(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model: Optional[str] = None,
+        chart_type: Optional[str] = "flowchart"
+    ) -> AsyncIterator[str]:
+        """使用 Gemini streamGenerateContent 流式生成"""
+        if not settings.GEMINI_API_KEY:
+            raise ValueError("未配置 GEMINI_API_KEY")
+        
+        model_name = model or settings.GEMINI_MODEL
+        url = f"/v1/models/{model_name}:streamGenerateContent"
+        payload = self._build_gemini_payload(prompt, diagram_type, chart_type)
+        
+        client = self._get_client("gemini")
+        async with client.stream(
+            "POST",
+            url,
+            headers={"Content-Type": "application/json"},
+            json=payload,
+            params={"key": settings.GEMINI_API_KEY, "alt": "sse"}
+        ) as response:
+            response.raise_for_status()
+            async for data in _iter_sse_data(response):
+                event = json.loads(data)
+                for candidate in event.get("candidates", []):
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            yield part["text"]
+    
+    async def _stream_with_aihubmix(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model: Optional[str] = None,
+        chart_type: Optional[str] = "flowchart"
+    ) -> AsyncIterator[str]:
+        """使用 AIHubMix (OpenAI 兼容, stream=true) 流式生成"""
+        if not settings.AIHUBMIX_API_KEY:
+            raise ValueError("未配置 AIHUBMIX_API_KEY")
+        
+        model_name = model or settings.AIHUBMIX_MODEL
+        payload = self._build_aihubmix_payload(prompt, diagram_type, model_name, chart_type)
+        payload["stream"] = True
+        
+        client = self._get_client("aihubmix")
+        async with client.stream(
+            "POST",
+            "/v1/chat/completions",
+            headers=self._aihubmix_headers(),
+            json=payload
+        ) as response:
+            response.raise_for_status()
+            async for data in _iter_sse_data(response):
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                for choice in event.get("choices", []):
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+    
+    def _build_gemini_payload(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> dict:
+        """构建 Gemini 请求体
+        
+        系统提示词在前、用户需求在后,相同图形类型的请求共享前缀,可命中 Gemini 的隐式缓存
+        """
+        # 构建系统提示词
+        system_prompt = system_prompt or self._get_system_prompt(diagram_type, chart_type)
+        
+        return {
+            "contents": [{
+                "parts": [{
+                    "text": f"{system_prompt}\n\n用户需求: {prompt}"
+                }]
+            }],
+            "generationConfig": {
+                "temperature": settings.AI_TEMPERATURE,
+                "maxOutputTokens": max_tokens or max_output_tokens(diagram_type, chart_type, prompt),
+            }
         }
+    
+    def _build_aihubmix_payload(
+        self,
+        prompt: str,
+        diagram_type: DiagramTypeEnum,
+        model_name: str,
+        chart_type: Optional[str] = "flowchart",
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> dict:
+        """构建 AIHubMix (OpenAI 兼容) 请求体"""
+        system_prompt = system_prompt or self._get_system_prompt(diagram_type, chart_type)
         
         payload = {
             "model": model_name,
@@ -114,121 +1037,31 @@ class AIService:
                 {"role": "user", "content": prompt}
             ],
             "temperature": settings.AI_TEMPERATURE,
-            "max_completion_tokens": settings.AI_MAX_TOKENS
+            "max_completion_tokens": max_tokens or max_output_tokens(diagram_type, chart_type, prompt)
+        }
+        if settings.AI_PROMPT_CACHE_KEY:
+            # 相同系统提示词的请求路由到同一缓存分区,提高前缀缓存命中率
+            payload["prompt_cache_key"] = f"genai-flow:{diagram_type.value}:{chart_type}"
+        return payload
+    
+    def _aihubmix_headers(self) -> dict:
+        """AIHubMix 请求头"""
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {settings.AIHUBMIX_API_KEY}"
         }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=60.0
-            )
-            response.raise_for_status()
-            data = response.json()
-        
-        # 提取生成的代码
-        if "choices" in data and len(data["choices"]) > 0:
-            text = data["choices"][0]["message"]["content"]
-            text = text.replace("```mermaid", "").replace("```json", "").replace("```", "").strip()
-            return text
-        
-        raise ValueError("AI 生成失败,未返回有效内容")
     
     def _get_system_prompt(self, diagram_type: DiagramTypeEnum, chart_type: Optional[str] = "flowchart") -> str:
-        """获取系统提示词"""
-        if diagram_type == DiagramTypeEnum.MERMAID:
-            # 图形类型映射
-            chart_type_map = {
-                'flowchart': 'graph TD',
-                'sequence': 'sequenceDiagram',
-                'class': 'classDiagram',
-                'state': 'stateDiagram-v2',
-                'er': 'erDiagram',
-                'gantt': 'gantt',
-                'pie': 'pie',
-                'journey': 'journey',
-                'architecture': 'architecture-beta'
-            }
-            
-            mermaid_keyword = chart_type_map.get(chart_type, 'graph TD')
-            
-            # Architecture 架构图需要特殊的提示词
-            if chart_type == 'architecture':
-                return f"""{settings.AI_MERMAID_SYSTEM_PROMPT}
-
-【重要】用户选择的图形类型: Architecture 架构图
-你必须严格按照以下 Mermaid architecture-beta 语法生成代码:
-
-【关键规则】:
-1. 必须以 'architecture-beta' 开头
-2. 使用 group 定义分组: group groupId(icon)[DisplayName]
-   - icon 可选值: cloud, server, disk, database, internet, users 等
-   - DisplayName 必须使用英文，不要使用中文
-3. 使用 service 定义服务: service serviceId(icon)[DisplayName] in groupId
-   - icon 可选值: server, disk, database, internet 等
-   - DisplayName 必须使用英文，不要使用中文
-   - 'in groupId' 指定服务所属分组
-4. 使用连接符定义关系:
-   - **只能在 service 之间建立连接，不能连接到 group**
-   - serviceA:L -- R:serviceB  (左到右)
-   - serviceA:T -- B:serviceB  (上到下)
-   - L=Left, R=Right, T=Top, B=Bottom
-
-示例 (包含 EC2、ELB、RDS - 注意全部使用英文):
-architecture-beta
-    group aws(cloud)[AWS Cloud]
-    
-    service elb(internet)[Load Balancer] in aws
-    service ec2_1(server)[Web Server 1] in aws
-    service ec2_2(server)[Web Server 2] in aws
-    service api(server)[API Gateway] in aws
-    service rds(database)[MySQL Database] in aws
-    
-    elb:B -- T:ec2_1
-    elb:B -- T:ec2_2
-    ec2_1:R -- L:api
-    ec2_2:R -- L:api
-    api:B -- T:rds
-
-【关键注意事项】:
-- 所有 ID 必须是单个单词(使用下划线连接，不含空格和中划线)
-- **显示名称必须使用英文，不要使用中文** (例如: [Web Server] 而不是 [Web应用])
-- 显示名称用方括号 [] 包裹
-- 图标用圆括号 () 包裹
-- 连接使用 :L :R :T :B 指定方向
-- 常用图标: cloud, server, disk, database, internet, users
-- 使用缩进来提高可读性
-- 连接语法必须是 serviceA:方向 -- 方向:serviceB 的格式
-
-【严格禁止】:
-- 不要在方括号 [] 中使用中文字符
-- 不要在 ID 中使用中文
-- 不要遗漏冒号 : 或双横线 --
-- **不要在连接关系中使用 group ID，只能使用 service ID**
-- **不要让 service 连接到 group，group 不能作为连接的端点**
-
-请严格遵守以上语法规则生成 architecture-beta 架构图代码。"""
-            
-            return f"""{settings.AI_MERMAID_SYSTEM_PROMPT}
-
-【重要】用户选择的图形类型: {chart_type}
-你必须严格使用 '{mermaid_keyword}' 作为图形起始关键字。
-例如:
-- 如果是流程图 (flowchart): 使用 'graph TD' 或 'graph LR'
-- 如果是时序图 (sequence): 使用 'sequenceDiagram'
-- 如果是类图 (class): 使用 'classDiagram'
-- 如果是状态图 (state): 使用 'stateDiagram-v2'
-- 如果是ER图 (er): 使用 'erDiagram'
-- 如果是甘特图 (gantt): 使用 'gantt'
-- 如果是饼图 (pie): 使用 'pie'
-- 如果是旅程图 (journey): 使用 'journey'
-- 如果是架构图 (architecture): 使用 'architecture-beta'
-
-请根据用户选择的类型和提示词内容,生成对应类型的 Mermaid 图形代码。"""
-        else:  # EXCALIDRAW
-            return settings.AI_EXCALIDRAW_SYSTEM_PROMPT
+        """获取系统提示词,只包含所选图形类型相关的规则"""
+        return build_system_prompt(diagram_type, chart_type)
 
 
 # 全局 AI 服务实例
 ai_service = AIService()
+
+
+def generation_response(diagram_type: DiagramTypeEnum, result: str) -> dict:
+    """生成接口的响应体: Mermaid 返回代码字符串,Excalidraw 返回校验后的元素列表"""
+    if diagram_type == DiagramTypeEnum.MERMAID:
+        return {"success": True, "diagram_type": diagram_type.value, "code": result}
+    return {"success": True, "diagram_type": diagram_type.value, "data": excalidraw_payload(result)}
@@ -1,17 +1,25 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from config import settings
 from database import get_db
 from models import User
+from user_cache import user_cache
 
 # HTTP Bearer 认证
 security = HTTPBearer()
 
+# bcrypt 是 CPU 密集操作 (会释放 GIL),放到有界线程池执行,避免阻塞事件循环
+_password_executor: Optional[ThreadPoolExecutor] = None
+# 限制同时排队/执行的哈希数量,登录高峰时多余请求在此等待
+_password_semaphore = asyncio.Semaphore(settings.PASSWORD_HASH_MAX_CONCURRENCY)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """验证密码"""
@@ -20,7 +28,52 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 
 def get_password_hash(password: str) -> str:
     """生成密码哈希"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """哈希的 cost 因子与当前配置不一致时需要重新哈希"""
+    # bcrypt 哈希格式: $2b$<rounds>$<salt+hash>
+    try:
+        rounds = int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != settings.BCRYPT_ROUNDS
+
+
+def _get_password_executor() -> ThreadPoolExecutor:
+    global _password_executor
+    if _password_executor is None:
+        _password_executor = ThreadPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            thread_name_prefix="password-hash"
+        )
+    return _password_executor
+
+
+async def _run_password_task(func, *args):
+    async with _password_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_password_executor(), func, *args)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """在线程池中验证密码"""
+    return await _run_password_task(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """在线程池中生成密码哈希"""
+    return await _run_password_task(get_password_hash, password)
+
+
+def shutdown_password_executor():
+    """关闭密码哈希线程池"""
+    global _password_executor
+    if _password_executor is not None:
+        executor, _password_executor = _password_executor, None
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -36,11 +89,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """获取当前用户"""
+async def authenticate_token(token: str, db: AsyncSession) -> User:
+    """校验访问令牌并返回对应用户 (HTTP 依赖与 WebSocket 共用)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="无法验证凭证",
@@ -48,21 +98,32 @@ async def get_current_user(
     )
     
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
+        user_id: int = int(payload.get("sub"))
+    except (JWTError, TypeError, ValueError):
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
+    # 优先使用缓存,命中时认证无需访问数据库
+    user = await user_cache.get(user_id)
+    if user is not None:
+        return user
+    
+    user = await db.get(User, user_id)
     if user is None:
         raise credentials_exception
     
+    await user_cache.set(user)
     return user
 
 
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """获取当前用户"""
+    return await authenticate_token(credentials.credentials, db)
+
+
 async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
     """获取当前活跃用户"""
     if not current_user.is_active:
@@ -0,0 +1,603 @@
+"""
+实时协作 - 每个图形一个房间,客户端操作按节拍合并后经 Redis 频道广播到所有 worker
+
+Excalidraw 操作为按 id 的元素更新,合并规则与 Excalidraw 一致 (version 高者胜出);
+Mermaid 操作为基于序号的行级编辑,所有副本按频道中的同一顺序决定是否接受,
+基于旧序号的编辑被拒绝,发起者收到最新代码后重新提交。
+房间状态每 COLLAB_SNAPSHOT_INTERVAL 秒最多写回 Diagram 表一次,并按自动保存规则记录版本。
+写回 Mermaid 代码前检查图形修订号: 房间加载后代码被 REST 接口修改时不覆盖,
+而是经频道广播变基,各副本按三方合并把外部修改并入房间状态,冲突时以外部修改为准。
+"""
+import asyncio
+import json
+import logging
+import uuid
+from typing import Any, Dict, List, Optional
+import redis.asyncio as redis
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from config import settings
+from database import AsyncSessionLocal
+from models import Diagram, DiagramTypeEnum, User
+from redis_client import get_redis
+from diagram_patch import PatchError, element_version, upsert_elements
+from version_store import apply_line_diff, content_of, diff_lines, version_store
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "collab:diagram:"
+
+
+def validate_text_edits(code: str, edits: Any) -> List[list]:
+    """校验行级编辑 [[起始行, 结束行, 新行列表], ...]: 行号为 0 起始下标,区间有序且不重叠"""
+    if not isinstance(edits, list):
+        raise PatchError("edits 必须是数组")
+    total = len(code.splitlines(keepends=True))
+    previous_end = 0
+    for edit in edits:
+        if not (isinstance(edit, list) and len(edit) == 3):
+            raise PatchError("每个编辑必须是 [start, end, lines]")
+        start, end, lines = edit
+        if not all(isinstance(value, int) and not isinstance(value, bool) for value in (start, end)):
+            raise PatchError("start / end 必须是整数")
+        if not previous_end <= start <= end <= total:
+            raise PatchError(f"编辑区间无效: [{start}, {end}]")
+        if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+            raise PatchError("lines 必须是字符串数组")
+        previous_end = end
+    return edits
+
+
+def merge_text(base: str, ours: str, theirs: str) -> Optional[str]:
+    """三方合并行级修改: 双方修改的区间不重叠 (或修改完全相同) 时返回合并结果,冲突时返回 None"""
+    if ours == base or ours == theirs:
+        return theirs
+    if theirs == base:
+        return ours
+    edits = sorted(diff_lines(base, ours) + diff_lines(base, theirs), key=lambda edit: (edit[0], edit[1]))
+    merged: List[list] = []
+    for edit in edits:
+        if merged:
+            last = merged[-1]
+            if edit == last:
+                continue
+            # 区间相交,或在同一位置开始 (插入顺序无法确定)
+            if edit[0] < last[1] or edit[0] == last[0]:
+                return None
+        merged.append(edit)
+    return apply_line_diff(base, merged)
+
+
+class CollabPeer:
+    """一个 WebSocket 连接,消息经有界队列发送,慢速客户端不会阻塞房间"""
+
+    def __init__(self, websocket: WebSocket, user: User, can_edit: bool):
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.user_id = user.id
+        self.username = user.username
+        self.can_edit = can_edit
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.COLLAB_SEND_QUEUE_SIZE)
+        self.overflowed = False
+
+    @property
+    def info(self) -> dict:
+        return {"peer": self.id, "user_id": self.user_id, "username": self.username}
+
+    def send(self, message: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # 积压过多时断开,客户端重连后通过 init 消息获取完整状态
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class CollabRoom:
+    """单个图形在当前 worker 上的协作副本"""
+
+    def __init__(self, hub: "CollabHub", diagram_id: int):
+        self.hub = hub
+        self.diagram_id = diagram_id
+        self.diagram_type = DiagramTypeEnum.MERMAID
+        self.peers: Dict[str, CollabPeer] = {}
+        # 所有 worker 上的在线成员
+        self.presence: Dict[str, dict] = {}
+        # 副本状态
+        self.seq = 0
+        self.mermaid_code = ""
+        # 房间状态所基于的数据库修订号及该修订的 Mermaid 代码,用于发现房间外的修改
+        self.revision: Optional[int] = None
+        self.base_code = ""
+        self.document: Dict[str, Any] = {}
+        self.elements: Dict[str, dict] = {}
+        # 等待下一个节拍广播的本地操作
+        self.pending_elements: Dict[str, dict] = {}
+        self.pending_text: List[dict] = []
+        self.pending_cursors: Dict[str, dict] = {}
+        self.pending_presence: List[dict] = []
+        self.dirty = False
+        self.last_editor: Optional[int] = None
+        self._ticker: Optional[asyncio.Task] = None
+
+    @property
+    def channel(self) -> str:
+        return f"{CHANNEL_PREFIX}{self.diagram_id}"
+
+    @property
+    def _elements_key(self) -> str:
+        return f"collab:{self.diagram_id}:elements"
+
+    @property
+    def _text_key(self) -> str:
+        return f"collab:{self.diagram_id}:text"
+
+    def excalidraw_data(self) -> dict:
+        return {**self.document, "elements": list(self.elements.values())}
+
+    # ===== 加载与关闭 =====
+
+    async def load(self) -> bool:
+        """从数据库加载图形,并叠加 Redis 中尚未写回的协作状态;图形不存在时返回 False"""
+        async with AsyncSessionLocal() as db:
+            diagram = await db.get(Diagram, self.diagram_id)
+            if diagram is None or diagram.is_deleted:
+                return False
+            self.diagram_type = diagram.render_engine
+            self.mermaid_code = diagram.mermaid_code or ""
+            self.revision = diagram.revision
+            self.base_code = self.mermaid_code
+            data = diagram.excalidraw_data if isinstance(diagram.excalidraw_data, dict) else {}
+            self.document = {key: value for key, value in data.items() if key != "elements"}
+            for element in data.get("elements") or []:
+                if isinstance(element, dict) and isinstance(element.get("id"), str):
+                    self.elements[element["id"]] = element
+
+        client = get_redis()
+        if client is not None:
+            try:
+                text = await client.get(self._text_key)
+                overlay = await client.hgetall(self._elements_key)
+            except redis.RedisError as e:
+                logger.warning("读取协作状态失败 (diagram=%s): %s", self.diagram_id, e)
+            else:
+                if text is not None:
+                    state = json.loads(text)
+                    self.seq, self.mermaid_code = state["seq"], state["code"]
+                for raw in overlay.values():
+                    self._merge_element(json.loads(raw))
+
+        self._ticker = asyncio.create_task(self._run(), name=f"collab-room-{self.diagram_id}")
+        return True
+
+    async def close(self):
+        """最后一个本地连接断开: 广播剩余操作并写回状态"""
+        if self._ticker is not None:
+            self._ticker.cancel()
+            await asyncio.gather(self._ticker, return_exceptions=True)
+        await self._publish_pending()
+        # 写回时发现房间外的修改会先变基,再写回一次合并结果
+        for _ in range(2):
+            if not self.dirty:
+                break
+            await self.snapshot(force=True)
+
+    # ===== 本地连接 =====
+
+    def add(self, peer: CollabPeer):
+        self.peers[peer.id] = peer
+        self.presence[peer.id] = peer.info
+        self.pending_presence.append({**peer.info, "event": "join"})
+        peer.send({
+            "type": "init",
+            "peer": peer.id,
+            "can_edit": peer.can_edit,
+            "diagram_type": self.diagram_type.value,
+            "seq": self.seq,
+            "mermaid_code": self.mermaid_code,
+            "excalidraw_data": self.excalidraw_data(),
+            "peers": list(self.presence.values()),
+        })
+
+    def remove(self, peer: CollabPeer):
+        self.peers.pop(peer.id, None)
+        self.presence.pop(peer.id, None)
+        self.pending_cursors.pop(peer.id, None)
+        self.pending_presence.append({**peer.info, "event": "leave"})
+
+    def submit(self, peer: CollabPeer, message: Any):
+        """接收客户端消息,编辑操作在下一个节拍合并广播"""
+        if not isinstance(message, dict):
+            raise PatchError("消息必须是 JSON 对象")
+        kind = message.get("type")
+        if kind == "cursor":
+            self.pending_cursors[peer.id] = {
+                **peer.info,
+                "x": message.get("x"),
+                "y": message.get("y"),
+                "element_id": message.get("element_id"),
+            }
+            return
+        if kind not in ("elements", "text"):
+            raise PatchError(f"不支持的消息类型: {kind}")
+        if not peer.can_edit:
+            raise PatchError("没有编辑权限")
+
+        if kind == "elements":
+            if self.diagram_type != DiagramTypeEnum.EXCALIDRAW:
+                raise PatchError("Mermaid 图形不支持元素操作")
+            elements = message.get("elements")
+            if not isinstance(elements, list):
+                raise PatchError("elements 必须是数组")
+            for element in elements:
+                if not isinstance(element, dict) or not isinstance(element.get("id"), str):
+                    raise PatchError("元素缺少 id")
+                # 同一节拍内同一元素只保留版本最高的一次修改
+                pending = self.pending_elements.get(element["id"])
+                if pending is None or element_version(element) >= element_version(pending):
+                    self.pending_elements[element["id"]] = {**element}
+            self.last_editor = peer.user_id
+            return
+
+        if self.diagram_type != DiagramTypeEnum.MERMAID:
+            raise PatchError("Excalidraw 图形不支持文本操作")
+        base = message.get("base")
+        if not isinstance(base, int) or isinstance(base, bool):
+            raise PatchError("base 必须是整数")
+        edits = message.get("edits")
+        if not isinstance(edits, list):
+            raise PatchError("edits 必须是数组")
+        self.pending_text.append({
+            "op_id": str(message.get("op_id") or uuid.uuid4().hex),
+            "peer": peer.id,
+            "user_id": peer.user_id,
+            "base": base,
+            "edits": edits,
+        })
+        self.last_editor = peer.user_id
+
+    # ===== 节拍: 合并、广播与写回 =====
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_snapshot = loop.time() + settings.COLLAB_SNAPSHOT_INTERVAL
+        while True:
+            await asyncio.sleep(settings.COLLAB_TICK_MS / 1000)
+            try:
+                await self._publish_pending()
+                if loop.time() >= next_snapshot:
+                    next_snapshot = loop.time() + settings.COLLAB_SNAPSHOT_INTERVAL
+                    if self.dirty:
+                        await self.snapshot()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("协作房间节拍处理失败 (diagram=%s)", self.diagram_id)
+
+    async def _publish_pending(self):
+        if not (self.pending_elements or self.pending_text or self.pending_cursors or self.pending_presence):
+            return
+        batch = {
+            "origin": self.hub.worker_id,
+            "editor": self.last_editor,
+            "elements": list(self.pending_elements.values()),
+            "text": self.pending_text,
+            "cursors": list(self.pending_cursors.values()),
+            "presence": self.pending_presence,
+        }
+        self.pending_elements = {}
+        self.pending_text = []
+        self.pending_cursors = {}
+        self.pending_presence = []
+        await self.hub.publish(self, batch)
+
+    def _merge_element(self, element: dict) -> bool:
+        current = self.elements.get(element["id"])
+        if current is not None and element_version(element) < element_version(current):
+            return False
+        self.elements[element["id"]] = element
+        return True
+
+    async def receive(self, batch: dict):
+        """应用频道中的一批操作 (包括本 worker 发出的),并推送给本地连接
+
+        所有副本按相同顺序应用,文本操作的接受与拒绝在各副本上一致。
+        """
+        saved = batch.get("saved")
+        if saved is not None:
+            self.revision, self.base_code = saved["revision"], saved["code"]
+        rebased = batch.get("rebase") is not None and self._rebase(batch["rebase"])
+
+        accepted_elements = [element for element in batch.get("elements", []) if self._merge_element(element)]
+
+        accepted_text = []
+        rejected_text = []
+        for op in batch.get("text", []):
+            if op["base"] != self.seq:
+                rejected_text.append((op, None))
+                continue
+            try:
+                edits = validate_text_edits(self.mermaid_code, op["edits"])
+            except PatchError as e:
+                rejected_text.append((op, str(e)))
+                continue
+            self.mermaid_code = apply_line_diff(self.mermaid_code, edits)
+            self.seq += 1
+            accepted_text.append({
+                "seq": self.seq,
+                "op_id": op["op_id"],
+                "peer": op["peer"],
+                "user_id": op["user_id"],
+                "edits": edits,
+            })
+
+        for event in batch.get("presence", []):
+            if event["event"] == "join":
+                self.presence[event["peer"]] = {key: event[key] for key in ("peer", "user_id", "username")}
+            else:
+                self.presence.pop(event["peer"], None)
+
+        if accepted_elements or accepted_text:
+            self.dirty = True
+            if batch.get("editor") is not None:
+                self.last_editor = batch["editor"]
+
+        message = {
+            "type": "batch",
+            "elements": accepted_elements,
+            "text": accepted_text,
+            "cursors": batch.get("cursors", []),
+            "presence": batch.get("presence", []),
+        }
+        if any(message[key] for key in ("elements", "text", "cursors", "presence")):
+            for peer in list(self.peers.values()):
+                peer.send(message)
+
+        for op, error in rejected_text:
+            peer = self.peers.get(op["peer"])
+            if peer is None:
+                continue
+            if error is not None:
+                peer.send({"type": "error", "op_id": op["op_id"], "detail": error})
+            else:
+                # 基于旧序号的编辑: 发送最新代码,由客户端变基后重新提交
+                peer.send({"type": "resync", "op_id": op["op_id"], "seq": self.seq, "mermaid_code": self.mermaid_code})
+
+        if batch.get("origin") == self.hub.worker_id and (accepted_elements or accepted_text or rebased):
+            await self._save_state(accepted_elements, bool(accepted_text) or rebased)
+
+    def _rebase(self, rebase: dict) -> bool:
+        """把房间外对 Mermaid 代码的修改并入房间状态,并通知本地连接重新同步;状态有变化时返回 True"""
+        self.revision = rebase["revision"]
+        self.base_code = rebase["code"]
+        merged = merge_text(rebase["base"], self.mermaid_code, rebase["code"])
+        if merged is None:
+            logger.info("协作修改与外部修改冲突,以外部修改为准 (diagram=%s)", self.diagram_id)
+            merged = rebase["code"]
+        # 合并结果与数据库不同时,下一个间隔写回
+        self.dirty = merged != rebase["code"]
+        if merged == self.mermaid_code:
+            return False
+        self.mermaid_code = merged
+        self.seq += 1
+        for peer in list(self.peers.values()):
+            peer.send({"type": "resync", "op_id": None, "seq": self.seq, "mermaid_code": self.mermaid_code})
+        return True
+
+    async def _save_state(self, elements: List[dict], text_changed: bool):
+        """把已接受的修改写入 Redis,供其他 worker 上新建的副本加载"""
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                if elements:
+                    pipe.hset(self._elements_key, mapping={
+                        element["id"]: json.dumps(element, ensure_ascii=False) for element in elements
+                    })
+                    pipe.expire(self._elements_key, settings.COLLAB_STATE_TTL)
+                if text_changed:
+                    pipe.set(
+                        self._text_key,
+                        json.dumps({"seq": self.seq, "code": self.mermaid_code}, ensure_ascii=False),
+                        ex=settings.COLLAB_STATE_TTL
+                    )
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("保存协作状态失败 (diagram=%s): %s", self.diagram_id, e)
+
+    async def snapshot(self, force: bool = False):
+        """把房间状态写回 Diagram 表
+
+        多个 worker 持有同一房间时,通过 Redis 锁保证每个间隔只有一个 worker 写入。
+        """
+        client = get_redis()
+        if client is not None and not force:
+            try:
+                acquired = await client.set(
+                    f"collab:{self.diagram_id}:snapshot", self.hub.worker_id,
+                    nx=True, px=int(settings.COLLAB_SNAPSHOT_INTERVAL * 1000)
+                )
+                if not acquired:
+                    self.dirty = False
+                    return
+                # 房间仍在使用,延长协作状态的有效期
+                await client.expire(self._elements_key, settings.COLLAB_STATE_TTL)
+                await client.expire(self._text_key, settings.COLLAB_STATE_TTL)
+            except redis.RedisError as e:
+                logger.warning("获取协作写回锁失败 (diagram=%s): %s", self.diagram_id, e)
+
+        self.dirty = False
+        try:
+            async with AsyncSessionLocal() as db:
+                diagram = await db.get(Diagram, self.diagram_id)
+                if diagram is None or diagram.is_deleted:
+                    return
+                baseline = content_of(diagram)
+                if self.diagram_type == DiagramTypeEnum.MERMAID:
+                    stored = diagram.mermaid_code or ""
+                    if diagram.revision != self.revision and stored != self.base_code:
+                        # 房间加载后代码被其他请求修改: 不覆盖,广播变基后在下一个间隔写回合并结果
+                        self.dirty = True
+                        await self.hub.publish(self, {
+                            "origin": self.hub.worker_id,
+                            "rebase": {"revision": diagram.revision, "base": self.base_code, "code": stored},
+                        })
+                        return
+                    diagram.mermaid_code = self.mermaid_code
+                else:
+                    # 与数据库中的内容按元素合并,保留通过 REST 接口写入的修改
+                    diagram.excalidraw_data = upsert_elements(
+                        diagram.excalidraw_data or self.document, list(self.elements.values())
+                    )
+                if content_of(diagram) != baseline:
+                    await version_store.record(
+                        db, diagram, self.last_editor or diagram.user_id, "协同编辑",
+                        baseline=baseline,
+                        coalesce_window=settings.VERSION_AUTOSAVE_WINDOW
+                    )
+                    await db.commit()
+                saved = {"revision": diagram.revision, "code": diagram.mermaid_code or ""}
+            # 各副本以本次写入 (或已与房间一致) 的修订为基准,之后的修订变化才视为房间外的修改
+            if (saved["revision"], saved["code"]) != (self.revision, self.base_code):
+                self.revision, self.base_code = saved["revision"], saved["code"]
+                await self.hub.publish(self, {"origin": self.hub.worker_id, "saved": saved})
+        except (StaleDataError, IntegrityError) as e:
+            # 与其他写入冲突,下一个间隔重试
+            logger.info("协作状态写回冲突 (diagram=%s): %s", self.diagram_id, e)
+            self.dirty = True
+
+
+class CollabHub:
+    """管理本 worker 上的协作房间,并通过 Redis 频道与其他 worker 交换操作
+
+    未启用 Redis 时操作只在本 worker 内广播 (单进程部署)。
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.rooms: Dict[int, CollabRoom] = {}
+        self._lock = asyncio.Lock()
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        client = get_redis()
+        if client is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen(client), name="collab-listener")
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        async with self._lock:
+            rooms, self.rooms = list(self.rooms.values()), {}
+            for room in rooms:
+                await room.close()
+
+    async def _listen(self, client: redis.Redis):
+        """订阅所有协作频道,把操作分发给本 worker 上的房间"""
+        while True:
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    room = self.rooms.get(int(message["channel"][len(CHANNEL_PREFIX):]))
+                    if room is not None:
+                        await room.receive(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except redis.RedisError as e:
+                logger.warning("协作频道订阅中断,稍后重连: %s", e)
+                await asyncio.sleep(1)
+            except Exception:
+                logger.exception("处理协作消息失败")
+            finally:
+                try:
+                    await pubsub.aclose()
+                except redis.RedisError:
+                    pass
+
+    async def publish(self, room: CollabRoom, batch: dict):
+        """广播一批操作: 本副本经频道收到后应用;已从 hub 移除 (正在关闭) 的副本收不到频道消息,直接在本地应用"""
+        client = get_redis()
+        if client is not None and self._listener is not None:
+            try:
+                await client.publish(room.channel, json.dumps(batch, ensure_ascii=False))
+                if self.rooms.get(room.diagram_id) is room:
+                    return
+            except redis.RedisError as e:
+                logger.warning("发布协作操作失败,仅在本 worker 内广播: %s", e)
+        await room.receive(batch)
+
+    async def _join(self, diagram_id: int, peer: CollabPeer) -> Optional[CollabRoom]:
+        async with self._lock:
+            room = self.rooms.get(diagram_id)
+            if room is None:
+                room = CollabRoom(self, diagram_id)
+                if not await room.load():
+                    return None
+                self.rooms[diagram_id] = room
+            room.add(peer)
+            return room
+
+    async def _leave(self, room: CollabRoom, peer: CollabPeer):
+        async with self._lock:
+            room.remove(peer)
+            if not room.peers and self.rooms.get(room.diagram_id) is room:
+                del self.rooms[room.diagram_id]
+                await room.close()
+
+    async def _send_loop(self, peer: CollabPeer):
+        while True:
+            message = await peer.queue.get()
+            if message is None:
+                await peer.websocket.close(code=1013, reason="消息积压过多,请重新连接")
+                return
+            await peer.websocket.send_json(message)
+
+    async def serve(self, websocket: WebSocket, diagram_id: int, user: User, can_edit: bool):
+        """处理一个已接受的协作连接,直到客户端断开"""
+        peer = CollabPeer(websocket, user, can_edit)
+        room = await self._join(diagram_id, peer)
+        if room is None:
+            await websocket.close(code=4404, reason="图形不存在")
+            return
+
+        sender = asyncio.create_task(self._send_loop(peer))
+        try:
+            while not sender.done():
+                try:
+                    message = await websocket.receive_json()
+                except ValueError:
+                    peer.send({"type": "error", "detail": "消息不是有效的 JSON"})
+                    continue
+                try:
+                    room.submit(peer, message)
+                except PatchError as e:
+                    peer.send({"type": "error", "op_id": message.get("op_id") if isinstance(message, dict) else None, "detail": str(e)})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            await self._leave(room, peer)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if self._listener is not None else "memory",
+            "rooms": len(self.rooms),
+            "peers": sum(len(room.peers) for room in self.rooms.values()),
+        }
+
+
+# 全局协作中心
+collab_hub = CollabHub()
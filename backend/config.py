@@ -18,8 +18,35 @@ class Settings(BaseSettings):
     AIHUBMIX_MODEL: str = "gpt-5.1"
     AI_MAX_TOKENS: int = 128000
     AI_TEMPERATURE: float = 0.3
+    # 输出上限按图形类型与需求长度计算,再加上思考预留,不超过 AI_MAX_TOKENS
+    AI_REASONING_TOKEN_RESERVE: int = 8192
+    AI_OUTPUT_TOKENS_PER_PROMPT_TOKEN: int = 4
+    AI_MAX_INPUT_TOKENS: int = 8000
+    # 为 OpenAI 兼容接口附加 prompt_cache_key (需上游支持)
+    AI_PROMPT_CACHE_KEY: bool = False
+
+    # AI HTTP 连接池配置 (每个提供商一个长连接客户端)
+    AI_HTTP_MAX_CONNECTIONS: int = 100
+    AI_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    AI_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    AI_HTTP_HTTP2: bool = True
+    AI_HTTP_TIMEOUT: float = 60.0
+    AI_HTTP_CONNECT_TIMEOUT: float = 5.0
+    AI_HTTP_READ_TIMEOUT: float = 60.0
+    AI_HTTP_WRITE_TIMEOUT: float = 10.0
+    AI_HTTP_POOL_TIMEOUT: float = 5.0
     
-    # AI 提示词配置
+    # 上游重试与熔断配置 (连接错误与 5xx 重试;错误率过高时熔断并改道另一个提供商)
+    AI_RETRY_MAX_ATTEMPTS: int = 3
+    AI_RETRY_BASE_DELAY: float = 0.5
+    AI_RETRY_MAX_DELAY: float = 4.0
+    AI_BREAKER_ENABLED: bool = True
+    AI_BREAKER_WINDOW: float = 60.0
+    AI_BREAKER_MIN_REQUESTS: int = 10
+    AI_BREAKER_ERROR_RATE: float = 0.5
+    AI_BREAKER_OPEN_SECONDS: float = 30.0
+
+    # AI 提示词配置 (保持默认值时按图形类型拼接相关规则,见 prompts.py;自定义后整体使用)
     AI_MERMAID_SYSTEM_PROMPT: str = """你是一个专业的技术图形生成专家和业务流程分析师。
 你的任务是深入分析用户需求,充分思考业务逻辑,生成详细完整的 Mermaid.js 图形。
 
@@ -110,18 +137,111 @@ class Settings(BaseSettings):
     
     # 数据库配置
     DATABASE_URL: str = "sqlite:///./genai_flow.db"
+    # 异步驱动连接串,留空时根据 DATABASE_URL 自动推导 (aiosqlite / asyncmy)
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
     MYSQL_ROOT_PASSWORD: Optional[str] = None
     MYSQL_USER: Optional[str] = None
     MYSQL_PASSWORD: Optional[str] = None
     
     # Redis 配置
     REDIS_URL: str = "redis://localhost:6379/0"
+    REDIS_ENABLED: bool = False
+    REDIS_SOCKET_TIMEOUT: float = 2.0
+    
+    # AI 生成结果缓存配置
+    AI_CACHE_ENABLED: bool = True
+    AI_CACHE_TTL: int = 86400
+    AI_CACHE_MAX_ENTRIES: int = 1000
+    
+    # 并发相同请求合并配置 (跨 worker 合并需要启用 Redis)
+    AI_SINGLEFLIGHT_ENABLED: bool = True
+    AI_SINGLEFLIGHT_LOCK_TTL: float = 90.0
+    AI_SINGLEFLIGHT_WAIT_TIMEOUT: float = 90.0
+    
+    # AI 限流配置: 按用户/提供商的令牌桶,上游并发上限与提供商 429 退避
+    AI_RATE_LIMIT_ENABLED: bool = True
+    AI_USER_RATE_CAPACITY: float = 10
+    AI_USER_RATE_PER_SECOND: float = 0.2
+    AI_PROVIDER_RATE_CAPACITY: float = 60
+    AI_PROVIDER_RATE_PER_SECOND: float = 5
+    AI_UPSTREAM_MAX_CONCURRENCY: int = 32
+    AI_UPSTREAM_MAX_WAIT: float = 10.0
+    AI_BACKOFF_BASE: float = 1.0
+    AI_BACKOFF_MAX: float = 60.0
+    
+    # 批量生成: 单次请求的目标数上限,以及单个批量请求同时进行的上游调用数 (同时受 AI_UPSTREAM_MAX_CONCURRENCY 限制)
+    AI_BATCH_MAX_TARGETS: int = 6
+    AI_BATCH_MAX_CONCURRENCY: int = 3
+    
+    # 异步生成任务队列配置 (启用 Redis 时任务在各 worker 间共享)
+    JOB_WORKERS: int = 4
+    JOB_MAX_QUEUE_DEPTH: int = 200
+    JOB_MAX_PER_USER: int = 3
+    JOB_RESULT_TTL: int = 3600
+    JOB_TIMEOUT: float = 180.0
+    # 执行中的任务每 JOB_LEASE_TTL / 3 秒续期租约,租约过期 (进程退出) 的任务被回收
+    JOB_LEASE_TTL: float = 30.0
+    
+    # 对冲请求配置: 主提供商超过延迟分位数未返回时,向另一个提供商发起请求
+    AI_HEDGE_ENABLED: bool = False
+    AI_HEDGE_PERCENTILE: float = 0.9
+    AI_HEDGE_MIN_SAMPLES: int = 20
+    AI_HEDGE_DEFAULT_DELAY: float = 10.0
+    AI_HEDGE_MIN_DELAY: float = 2.0
+    AI_HEDGE_MAX_DELAY: float = 30.0
+    
+    # Mermaid 输出校验: 先做确定性修复,修复失败时最多重新请求模型的次数
+    AI_MERMAID_VALIDATE: bool = True
+    AI_MERMAID_REPAIR_RETRIES: int = 1
+    
+    # 增量修改: 补丁无法应用时重新请求模型的次数
+    AI_REFINE_RETRIES: int = 1
+    
+    # 版本历史: 每 VERSION_SNAPSHOT_INTERVAL 个版本保存一次完整快照,其余版本只保存增量;
+    # 每个图形保留最近 VERSION_MAX_COUNT 个版本,每新增 VERSION_COMPACT_EVERY 个版本在后台压缩一次;
+    # 同一用户在 VERSION_AUTOSAVE_WINDOW 秒内的自动保存合并为一个版本
+    VERSION_SNAPSHOT_INTERVAL: int = 20
+    VERSION_DELTA_MAX_RATIO: float = 0.5
+    VERSION_MAX_COUNT: int = 100
+    VERSION_COMPACT_EVERY: int = 20
+    VERSION_AUTOSAVE_WINDOW: int = 300
+    
+    # 实时协作: 客户端操作每 COLLAB_TICK_MS 毫秒合并广播一次,房间状态每 COLLAB_SNAPSHOT_INTERVAL 秒最多写回数据库一次
+    COLLAB_TICK_MS: int = 50
+    COLLAB_SNAPSHOT_INTERVAL: float = 5.0
+    COLLAB_STATE_TTL: int = 3600
+    COLLAB_SEND_QUEUE_SIZE: int = 256
+    
+    # Excalidraw 自动布局: 模型只输出节点与连线,坐标与连线路径由 layout.py 在线程中计算
+    # (仅在 AI_EXCALIDRAW_SYSTEM_PROMPT 保持默认值时生效;节点数上千时布局需要数秒,默认关闭)
+    AI_EXCALIDRAW_AUTO_LAYOUT: bool = False
+    LAYOUT_NODE_SPACING: int = 40
+    LAYOUT_RANK_SPACING: int = 80
+    LAYOUT_CROSSING_SWEEPS: int = 8
     
     # JWT 配置
     JWT_SECRET_KEY: str = "your-secret-key-change-this"
     JWT_ALGORITHM: str = "HS256"
     JWT_EXPIRE_MINUTES: int = 1440
     
+    # 密码哈希配置 (修改 BCRYPT_ROUNDS 后,用户下次登录时自动重新哈希)
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_CONCURRENCY: int = 16
+    
+    # 认证用户缓存配置 (进程内 TTL 较短,以限制其他 worker 更新用户后的不一致窗口)
+    USER_CACHE_ENABLED: bool = True
+    USER_CACHE_TTL: int = 30
+    USER_CACHE_REDIS_TTL: int = 300
+    USER_CACHE_MAX_ENTRIES: int = 10000
+
+    # 模板库: 模板目录常驻内存,每 TEMPLATE_CATALOG_REFRESH_INTERVAL 秒重新加载一次 (本进程内修改模板时立即失效);
+    # 使用次数在内存中累加,每 TEMPLATE_USAGE_FLUSH_INTERVAL 秒合并写回数据库
+    TEMPLATE_CATALOG_REFRESH_INTERVAL: float = 300.0
+    TEMPLATE_USAGE_FLUSH_INTERVAL: float = 10.0
+    
     # 服务配置
     BACKEND_HOST: str = "0.0.0.0"
     BACKEND_PORT: int = 8000
@@ -129,6 +249,14 @@ class Settings(BaseSettings):
     UPLOAD_DIR: str = "./uploads"
     MAX_FILE_SIZE: int = 10
     
+    # 导出配置 (PNG/PDF 在进程池中栅格化)
+    EXPORT_WORKERS: int = 2
+    EXPORT_MAX_CONCURRENCY: int = 4
+    EXPORT_MAX_SCALE: float = 4.0
+    EXPORT_MAX_PIXELS: int = 64_000_000  # 栅格化输出的像素数上限 (宽 × 高)
+    EXPORT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    THUMBNAIL_WIDTH: int = 320
+    
     # 应用配置
     DEBUG: Optional[bool] = False
     CORS_ORIGINS: Optional[str] = "http://localhost:8080"
@@ -1,8 +1,23 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config import settings
 
+
+def get_async_database_url(url: str) -> str:
+    """将同步驱动的连接串转换为对应的异步驱动"""
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("mysql+pymysql:"):
+        return url.replace("mysql+pymysql:", "mysql+asyncmy:", 1)
+    if url.startswith("mysql:"):
+        return url.replace("mysql:", "mysql+asyncmy:", 1)
+    return url
+
+
 # 创建数据库引擎
 # SQLite 需要特殊配置
 if settings.DATABASE_URL.startswith("sqlite"):
@@ -19,17 +34,32 @@ else:
         echo=False
     )
 
-# 创建会话工厂
+# 异步引擎: 路由中的数据库 I/O 不阻塞事件循环
+if settings.DATABASE_URL.startswith("sqlite"):
+    async_engine = create_async_engine(
+        get_async_database_url(settings.DATABASE_URL),
+        echo=False
+    )
+else:
+    async_engine = create_async_engine(
+        get_async_database_url(settings.DATABASE_URL),
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        echo=False
+    )
+
+# 创建会话工厂 (同步会话用于建表和脚本)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 提交后不过期对象,避免在异步上下文中触发隐式懒加载
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
 
 # 创建基类
 Base = declarative_base()
 
 
-# 依赖项:获取数据库会话
-def get_db():
-    db = SessionLocal()
-    try:
+# 依赖项:获取异步数据库会话
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
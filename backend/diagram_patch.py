@@ -0,0 +1,195 @@
+"""
+图形补丁 - 解析并应用 AI 返回或客户端提交的增量修改
+
+Mermaid 代码使用按行号的编辑操作,Excalidraw 数据使用 JSON Patch (RFC 6902) 的子集或按 id 的元素更新。
+"""
+import copy
+import json
+from typing import Any, List
+
+
+class PatchError(ValueError):
+    """补丁格式错误或无法应用"""
+
+
+def number_lines(code: str) -> str:
+    """为代码加上行号,供模型引用"""
+    return "\n".join(f"{index}| {line}" for index, line in enumerate(code.splitlines(), start=1))
+
+
+def parse_patch(text: str) -> List[dict]:
+    """解析模型输出的补丁,支持裸数组或 {"ops": [...]}"""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise PatchError(f"补丁不是有效的 JSON: {e.msg}")
+    if isinstance(data, dict):
+        data = data.get("ops")
+    if not isinstance(data, list) or not all(isinstance(op, dict) for op in data):
+        raise PatchError("补丁必须是操作对象数组")
+    return data
+
+
+def _line_number(op: dict, field: str, low: int, high: int) -> int:
+    value = op.get(field)
+    if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+        raise PatchError(f"{op.get('op')} 操作的 {field} 超出范围: {value}")
+    return value
+
+
+def _new_lines(op: dict) -> List[str]:
+    lines = op.get("lines", [])
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        raise PatchError(f"{op.get('op')} 操作的 lines 必须是字符串数组")
+    return lines
+
+
+def apply_line_patch(code: str, ops: List[dict]) -> str:
+    """按原始行号应用行级编辑
+
+    支持的操作 (行号从 1 开始,均指原始代码):
+    - {"op": "replace", "start": 3, "end": 4, "lines": [...]}
+    - {"op": "insert", "after": 5, "lines": [...]} (after 为 0 时插入到开头)
+    - {"op": "delete", "start": 3, "end": 3}
+    """
+    lines = code.splitlines()
+    total = len(lines)
+    edits = []
+    for op in ops:
+        kind = op.get("op")
+        if kind in ("replace", "delete"):
+            start = _line_number(op, "start", 1, total)
+            end = _line_number(op, "end", start, total) if "end" in op else start
+            edits.append((start - 1, end, _new_lines(op) if kind == "replace" else []))
+        elif kind == "insert":
+            after = _line_number(op, "after", 0, total)
+            edits.append((after, after, _new_lines(op)))
+        else:
+            raise PatchError(f"不支持的操作: {kind}")
+
+    # 从后往前应用,前面的行号不受影响;区间重叠说明补丁有歧义
+    edits.sort(key=lambda edit: (edit[0], edit[1]))
+    for previous, current in zip(edits, edits[1:]):
+        if current[0] < previous[1]:
+            raise PatchError("补丁中的修改区间重叠")
+    for start, end, new_lines in reversed(edits):
+        lines[start:end] = new_lines
+    return "\n".join(lines)
+
+
+def _parse_pointer(path: Any) -> List[str]:
+    if not isinstance(path, str) or (path and not path.startswith("/")):
+        raise PatchError(f"无效的 JSON Pointer: {path}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in path.split("/")[1:]]
+
+
+def _resolve_parent(doc: Any, parts: List[str]) -> Any:
+    target = doc
+    for part in parts[:-1]:
+        target = _child(target, part)
+    return target
+
+
+def _child(target: Any, part: str) -> Any:
+    if isinstance(target, dict):
+        if part not in target:
+            raise PatchError(f"路径不存在: {part}")
+        return target[part]
+    if isinstance(target, list):
+        return target[_index(target, part)]
+    raise PatchError(f"路径不存在: {part}")
+
+
+def _index(target: list, part: str, allow_end: bool = False) -> int:
+    if allow_end and part == "-":
+        return len(target)
+    if not part.isdigit():
+        raise PatchError(f"无效的数组下标: {part}")
+    index = int(part)
+    if index > len(target) or (index == len(target) and not allow_end):
+        raise PatchError(f"数组下标越界: {part}")
+    return index
+
+
+def apply_json_patch(doc: Any, ops: List[dict]) -> Any:
+    """应用 JSON Patch (add / remove / replace / test),返回新文档,不修改原文档"""
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        kind = op.get("op")
+        parts = _parse_pointer(op.get("path"))
+        if not parts:
+            if kind in ("add", "replace"):
+                doc = copy.deepcopy(op.get("value"))
+                continue
+            raise PatchError(f"{kind} 操作不能作用于根节点")
+
+        parent = _resolve_parent(doc, parts)
+        key = parts[-1]
+        if kind == "add":
+            if "value" not in op:
+                raise PatchError("add 操作缺少 value")
+            if isinstance(parent, list):
+                parent.insert(_index(parent, key, allow_end=True), copy.deepcopy(op["value"]))
+            elif isinstance(parent, dict):
+                parent[key] = copy.deepcopy(op["value"])
+            else:
+                raise PatchError(f"路径不存在: {op['path']}")
+        elif kind == "remove":
+            if isinstance(parent, list):
+                del parent[_index(parent, key)]
+            elif isinstance(parent, dict) and key in parent:
+                del parent[key]
+            else:
+                raise PatchError(f"路径不存在: {op['path']}")
+        elif kind == "replace":
+            if "value" not in op:
+                raise PatchError("replace 操作缺少 value")
+            if isinstance(parent, list):
+                parent[_index(parent, key)] = copy.deepcopy(op["value"])
+            elif isinstance(parent, dict) and key in parent:
+                parent[key] = copy.deepcopy(op["value"])
+            else:
+                raise PatchError(f"路径不存在: {op['path']}")
+        elif kind == "test":
+            if _child(parent, key) != op.get("value"):
+                raise PatchError(f"test 操作不匹配: {op['path']}")
+        else:
+            raise PatchError(f"不支持的操作: {kind}")
+    return doc
+
+
+def upsert_elements(doc: Any, elements: List[dict]) -> Any:
+    """按 id 更新或追加 Excalidraw 元素,返回新文档,不修改原文档
+
+    与 Excalidraw 的协同合并规则一致: 已有元素的 version 更高时保留已有元素;
+    删除元素由客户端以 isDeleted 标记表示。
+    """
+    if not isinstance(doc, dict):
+        doc = {}
+    doc = dict(doc)
+    current = list(doc.get("elements") or [])
+    positions = {
+        element.get("id"): index
+        for index, element in enumerate(current)
+        if isinstance(element, dict)
+    }
+    for element in elements:
+        element_id = element.get("id")
+        if not isinstance(element_id, str):
+            raise PatchError("元素缺少 id")
+        index = positions.get(element_id)
+        if index is None:
+            positions[element_id] = len(current)
+            current.append(copy.deepcopy(element))
+        elif element_version(element) >= element_version(current[index]):
+            current[index] = copy.deepcopy(element)
+    doc["elements"] = current
+    return doc
+
+
+def element_version(element: dict) -> int:
+    """Excalidraw 元素的版本号,缺失时视为 0"""
+    version = element.get("version")
+    return version if isinstance(version, int) and not isinstance(version, bool) else 0
@@ -0,0 +1,249 @@
+"""
+Excalidraw 输出解析 - 增量解析模型输出的 JSON 元素数组,逐个校验并产出完整元素
+
+支持的元素 (与 AI_EXCALIDRAW_SYSTEM_PROMPT 一致,另兼容 Excalidraw 原生写法):
+- rectangle / ellipse / diamond: x, y, width, height, 可选 label
+- arrow / line: startX, startY, endX, endY,或 x, y, points
+- text: x, y, text, 可选 fontSize
+输出被截断或个别元素格式错误时,保留其余所有有效元素。
+"""
+import json
+import math
+from typing import Any, Callable, Dict, List, Optional
+
+SHAPE_TYPES = ("rectangle", "ellipse", "diamond")
+LINEAR_TYPES = ("arrow", "line")
+
+# 各类元素保留的可选字段及其类型 (startId / endId 为连线两端形状的 id)
+STYLE_FIELDS: Dict[str, type] = {
+    "id": str,
+    "startId": str,
+    "endId": str,
+    "strokeColor": str,
+    "backgroundColor": str,
+    "fillStyle": str,
+    "strokeStyle": str,
+    "strokeWidth": float,
+    "roughness": float,
+    "opacity": float,
+    "angle": float,
+}
+TEXT_FIELDS: Dict[str, type] = {
+    "fontSize": float,
+    "fontFamily": float,
+    "textAlign": str,
+    "verticalAlign": str,
+}
+
+MAX_COORDINATE = 100000
+
+
+class ElementError(ValueError):
+    """元素不符合结构要求"""
+
+
+def _number(raw: dict, field: str, required: bool = True, positive: bool = False) -> Optional[float]:
+    value = raw.get(field)
+    if value is None:
+        if required:
+            raise ElementError(f"缺少 {field}")
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            raise ElementError(f"{field} 不是数字: {value!r}")
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ElementError(f"{field} 不是数字: {value!r}")
+    if abs(value) > MAX_COORDINATE:
+        raise ElementError(f"{field} 超出范围: {value}")
+    if positive and value <= 0:
+        raise ElementError(f"{field} 必须大于 0")
+    return int(value) if float(value).is_integer() else value
+
+
+def _text(raw: dict, field: str) -> Optional[str]:
+    value = raw.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ElementError(f"{field} 不是文本")
+    return str(value).strip() or None
+
+
+def _copy_fields(raw: dict, element: dict, fields: Dict[str, type]):
+    for field, kind in fields.items():
+        if field not in raw:
+            continue
+        if kind is str:
+            if isinstance(raw[field], str) and raw[field]:
+                element[field] = raw[field]
+        else:
+            value = _number(raw, field, required=False)
+            if value is not None:
+                element[field] = value
+
+
+def validate_element(raw: Any) -> dict:
+    """校验单个元素并返回规范化后的元素,只保留已知字段"""
+    if not isinstance(raw, dict):
+        raise ElementError("元素不是对象")
+    kind = raw.get("type")
+    kind = kind.strip().lower() if isinstance(kind, str) else None
+    element: Dict[str, Any] = {"type": kind}
+
+    if kind in SHAPE_TYPES:
+        element["x"] = _number(raw, "x")
+        element["y"] = _number(raw, "y")
+        element["width"] = _number(raw, "width", positive=True)
+        element["height"] = _number(raw, "height", positive=True)
+        label = _text(raw, "label")
+        if label:
+            element["label"] = label
+    elif kind in LINEAR_TYPES:
+        if all(field in raw for field in ("startX", "startY", "endX", "endY")):
+            for field in ("startX", "startY", "endX", "endY"):
+                element[field] = _number(raw, field)
+            if element["startX"] == element["endX"] and element["startY"] == element["endY"]:
+                raise ElementError("起点与终点相同")
+        else:
+            element["x"] = _number(raw, "x")
+            element["y"] = _number(raw, "y")
+            points = raw.get("points")
+            if not isinstance(points, list) or len(points) < 2:
+                raise ElementError("缺少起止坐标或 points")
+            element["points"] = []
+            for point in points:
+                if not isinstance(point, list) or len(point) != 2:
+                    raise ElementError("points 中的坐标必须是 [x, y]")
+                element["points"].append([_number({"p": value}, "p") for value in point])
+        label = _text(raw, "label")
+        if label:
+            element["label"] = label
+    elif kind == "text":
+        element["x"] = _number(raw, "x")
+        element["y"] = _number(raw, "y")
+        text = _text(raw, "text") or _text(raw, "label")
+        if not text:
+            raise ElementError("text 元素缺少文本")
+        element["text"] = text
+        _copy_fields(raw, element, TEXT_FIELDS)
+        if "fontSize" in element and element["fontSize"] <= 0:
+            del element["fontSize"]
+    else:
+        raise ElementError(f"不支持的元素类型: {raw.get('type')!r}")
+
+    _copy_fields(raw, element, STYLE_FIELDS)
+    return element
+
+
+class ElementStreamParser:
+    """增量解析 JSON 数组,数组中的每个对象闭合后立即解析并校验
+
+    只跟踪字符串与括号深度,不要求整体是合法 JSON:
+    数组前后的说明文字、元素间缺失或多余的逗号、被截断的结尾都不影响已闭合的元素。
+    兼容 {"elements": [...]} 形式的场景对象 (取第一个数组)。
+    validate 用于校验并规范化单个对象,抛出 ElementError 时丢弃该对象。
+    """
+
+    def __init__(self, validate: Callable[[Any], dict] = validate_element):
+        self.validate = validate
+        self.elements: List[dict] = []
+        self.errors: List[str] = []
+        self.found_array = False
+        self.complete = False
+        self._buffer: List[str] = []
+        self._depth = 0          # 数组内部的对象/数组嵌套深度
+        self._in_string = False
+        self._escaped = False
+        self._index = 0
+
+    def feed(self, chunk: str) -> List[dict]:
+        """输入一段文本,返回本段中新完成的有效元素"""
+        emitted = []
+        for ch in chunk:
+            if self.complete:
+                break
+            if not self.found_array:
+                if ch == "[":
+                    self.found_array = True
+                continue
+
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                elif ch == "]":
+                    self.complete = True
+                continue
+
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    element = self._finish("".join(self._buffer))
+                    self._buffer = []
+                    if element is not None:
+                        emitted.append(element)
+        return emitted
+
+    def _finish(self, text: str) -> Optional[dict]:
+        index = self._index
+        self._index += 1
+        try:
+            element = self.validate(json.loads(text))
+        except json.JSONDecodeError as e:
+            self.errors.append(f"元素 {index}: JSON 格式错误 ({e.msg})")
+            return None
+        except ElementError as e:
+            self.errors.append(f"元素 {index}: {e}")
+            return None
+        self.elements.append(element)
+        return element
+
+    @property
+    def truncated(self) -> bool:
+        """数组未闭合 (输出被截断)"""
+        return self.found_array and not self.complete
+
+
+class ParseResult:
+    """完整输出的解析结果"""
+
+    def __init__(self, parser: ElementStreamParser):
+        self.elements = parser.elements
+        self.errors = parser.errors
+        self.found_array = parser.found_array
+        self.truncated = parser.truncated
+
+    @property
+    def warnings(self) -> List[str]:
+        warnings = list(self.errors)
+        if self.truncated:
+            warnings.append("输出被截断,已保留完整的元素")
+        return warnings
+
+
+def parse_elements(text: str) -> ParseResult:
+    """解析完整的模型输出"""
+    parser = ElementStreamParser()
+    parser.feed(text)
+    return ParseResult(parser)
+
+
+def excalidraw_payload(text: str) -> Any:
+    """返回给客户端的 Excalidraw 数据: 找到元素数组时为元素列表,否则保留原文 (如模型返回了 Mermaid 代码)"""
+    result = parse_elements(text)
+    return result.elements if result.found_array else text
@@ -0,0 +1,118 @@
+"""
+导出缓存 - 按内容哈希缓存导出文件,存储在本地磁盘并按总大小做 LRU 淘汰
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Optional
+import aiofiles
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def export_cache_key(svg_content: str, export_format: str, scale: float, dpi: int) -> str:
+    """根据导出参数计算内容哈希,同时用作 ETag"""
+    digest = hashlib.sha256()
+    digest.update(svg_content.encode('utf-8'))
+    digest.update(f"\0{export_format}\0{scale:g}\0{dpi}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ExportCache:
+    """磁盘导出缓存
+
+    读取命中时刷新文件 mtime,淘汰时按 mtime 从旧到新删除,直到总大小低于上限。
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str, export_format: str) -> Path:
+        # 按哈希前两位分目录,避免单个目录文件过多
+        return self.directory / key[:2] / f"{key}.{export_format}"
+
+    async def get(self, key: str, export_format: str) -> Optional[bytes]:
+        """读取缓存文件"""
+        path = self._path(key, export_format)
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                content = await f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return content
+
+    async def put(self, key: str, export_format: str, content: bytes):
+        """写入缓存文件 (先写临时文件再原子替换)"""
+        path = self._path(key, export_format)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入导出缓存失败: %s", e)
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        async with self._lock:
+            if self._size is None:
+                self._size = await asyncio.to_thread(self._scan_size)
+            else:
+                self._size += len(content)
+            if self._size > self.max_bytes:
+                self._size = await asyncio.to_thread(self._evict)
+
+    def _scan_size(self) -> int:
+        return sum(path.stat().st_size for path in self.directory.rglob("*") if path.is_file())
+
+    def _evict(self) -> int:
+        """删除最久未使用的文件,返回淘汰后的总大小"""
+        files = []
+        for path in self.directory.rglob("*"):
+            try:
+                if path.is_file():
+                    stat = path.stat()
+                    files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in files)
+        # 淘汰到上限的 90%,避免每次写入都触发扫描
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                continue
+        return total
+
+    def stats(self) -> dict:
+        """缓存统计"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size_bytes": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# 全局导出缓存实例
+export_cache = ExportCache(Path(settings.UPLOAD_DIR) / "exports", settings.EXPORT_CACHE_MAX_BYTES)
@@ -1,20 +1,243 @@
 """
 导出服务 - 支持 SVG, PNG, PDF 格式导出
 """
-import base64
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from typing import Optional
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+import aiofiles
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
+from config import settings
+
+# cairosvg 依赖系统 cairo 库,缺失时导入会抛出 OSError
+try:
+    import cairosvg
+    CAIROSVG_AVAILABLE = True
+except (ImportError, OSError):
+    cairosvg = None
+    CAIROSVG_AVAILABLE = False
+
+MEDIA_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "pdf": "application/pdf",
+}
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+# SVG 长度单位换算为 96 dpi 下的像素
+SVG_UNITS = {"": 1.0, "px": 1.0, "pt": 4 / 3, "pc": 16.0, "mm": 96 / 25.4, "cm": 96 / 2.54, "in": 96.0}
+_SVG_TAG = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+_SVG_LENGTH = re.compile(r"\s*([0-9.]+(?:e[+-]?[0-9]+)?)\s*([a-z]*)\s*$", re.IGNORECASE)
+
+
+THUMBNAIL_DIR = Path(settings.UPLOAD_DIR) / "thumbnails"
+THUMBNAIL_URL_PREFIX = "/api/files/thumbnails"
+
+
+def rasterize_svg(
+    svg_bytes: bytes,
+    export_format: str,
+    scale: float = 1.0,
+    dpi: int = 96,
+    output_width: Optional[int] = None
+) -> bytes:
+    """将 SVG 转换为 PNG/PDF (在子进程中执行)
+
+    指定 output_width 时按宽度等比缩放,忽略 scale。
+    """
+    if export_format == "png":
+        return cairosvg.svg2png(
+            bytestring=svg_bytes, scale=scale, dpi=dpi, output_width=output_width, unsafe=False
+        )
+    if export_format == "pdf":
+        return cairosvg.svg2pdf(
+            bytestring=svg_bytes, scale=scale, dpi=dpi, output_width=output_width, unsafe=False
+        )
+    raise ValueError(f"不支持的导出格式: {export_format}")
+
+
+def _svg_attribute(tag: str, name: str) -> Optional[str]:
+    match = re.search(rf"""\s{name}\s*=\s*(['"])(.*?)\1""", tag)
+    return match.group(2) if match else None
+
+
+def _svg_length(value: Optional[str]) -> Optional[float]:
+    match = _SVG_LENGTH.match(value or "")
+    if not match or match.group(2).lower() not in SVG_UNITS:
+        return None
+    try:
+        return float(match.group(1)) * SVG_UNITS[match.group(2).lower()]
+    except ValueError:
+        return None
+
+
+def svg_pixel_size(svg_bytes: bytes) -> Optional[Tuple[float, float]]:
+    """根元素的宽高 (96 dpi 下的像素),取 width/height 属性,缺失或为百分比时取 viewBox;无法确定时返回 None"""
+    match = _SVG_TAG.search(svg_bytes[:64 * 1024])
+    if match is None:
+        return None
+    tag = match.group(0).decode("utf-8", "replace")
+    width = _svg_length(_svg_attribute(tag, "width"))
+    height = _svg_length(_svg_attribute(tag, "height"))
+    if width is None or height is None:
+        view_box = (_svg_attribute(tag, "viewBox") or "").replace(",", " ").split()
+        if len(view_box) != 4:
+            return None
+        try:
+            box_width, box_height = float(view_box[2]), float(view_box[3])
+        except ValueError:
+            return None
+        width = box_width if width is None else width
+        height = box_height if height is None else height
+    return width, height
+
+
+def output_pixels(
+    svg_bytes: bytes,
+    scale: float = 1.0,
+    dpi: int = 96,
+    output_width: Optional[int] = None
+) -> Optional[float]:
+    """栅格化结果的像素数,参数含义与 rasterize_svg 一致;无法确定尺寸时返回 None"""
+    size = svg_pixel_size(svg_bytes)
+    if size is None:
+        return None
+    width, height = size
+    if width <= 0 or height <= 0:
+        return None
+    factor = output_width / width if output_width else scale * dpi / 96
+    return width * height * factor * factor
+
+
+def iter_chunks(data: bytes) -> Iterator[bytes]:
+    """按块输出,避免一次性写出大文件"""
+    view = memoryview(data)
+    for start in range(0, len(view), STREAM_CHUNK_SIZE):
+        yield bytes(view[start:start + STREAM_CHUNK_SIZE])
 
 
 class ExportService:
-    """导出服务"""
-    
+    """导出服务
+
+    PNG/PDF 栅格化是 CPU 密集操作,在进程池中执行,不阻塞事件循环;
+    信号量限制同时进行的转换数量。输出像素数超过 EXPORT_MAX_PIXELS 时不提交转换;
+    子进程异常退出 (如内存不足) 导致进程池损坏时重建进程池。
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphore = asyncio.Semaphore(settings.EXPORT_MAX_CONCURRENCY)
+
+    @property
+    def rasterize_available(self) -> bool:
+        return CAIROSVG_AVAILABLE
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=settings.EXPORT_WORKERS)
+        return self._executor
+
+    async def _rasterize(self, *args) -> bytes:
+        """在进程池中执行 rasterize_svg;进程池损坏时重建并重试一次"""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    return await loop.run_in_executor(executor, rasterize_svg, *args)
+                except BrokenProcessPool:
+                    logger.warning("导出进程异常退出,重建进程池")
+                    if self._executor is executor:
+                        self._executor = None
+                        executor.shutdown(wait=False, cancel_futures=True)
+                    if attempt:
+                        raise HTTPException(status_code=503, detail="导出进程异常退出,请稍后重试")
+
+    def _within_pixel_limit(self, svg_bytes: bytes, *args) -> bool:
+        pixels = output_pixels(svg_bytes, *args)
+        return pixels is None or pixels <= settings.EXPORT_MAX_PIXELS
+
+    def shutdown(self):
+        """关闭转换进程池"""
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def render(self, svg_content: str, export_format: str, scale: float = 1.0, dpi: int = 96) -> bytes:
+        """生成导出文件内容"""
+        svg_bytes = svg_content.encode('utf-8')
+        if export_format == "svg":
+            return svg_bytes
+        if not self.rasterize_available:
+            raise HTTPException(status_code=501, detail="服务端未安装 cairosvg,无法转换为 PNG/PDF")
+        if len(svg_bytes) > settings.MAX_FILE_SIZE * 1024 * 1024:
+            raise HTTPException(status_code=413, detail="SVG 内容过大")
+
+        if not self._within_pixel_limit(svg_bytes, scale, dpi):
+            raise HTTPException(status_code=413, detail="导出尺寸过大,请降低缩放比例或 DPI")
+
+        return await self._rasterize(svg_bytes, export_format, scale, dpi)
+
+    async def render_thumbnail(self, svg_content: str) -> Optional[str]:
+        """生成 PNG 缩略图并返回访问地址,无法栅格化时返回 None
+
+        文件名取 SVG 内容哈希,内容相同的图形共享同一个缩略图。
+        """
+        if not self.rasterize_available:
+            return None
+        svg_bytes = svg_content.encode('utf-8')
+        if len(svg_bytes) > settings.MAX_FILE_SIZE * 1024 * 1024:
+            return None
+
+        if not self._within_pixel_limit(svg_bytes, 1.0, 96, settings.THUMBNAIL_WIDTH):
+            return None
+
+        name = f"{hashlib.sha256(svg_bytes).hexdigest()}.png"
+        path = THUMBNAIL_DIR / name
+        if not path.exists():
+            content = await self._rasterize(svg_bytes, "png", 1.0, 96, settings.THUMBNAIL_WIDTH)
+            THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{name}.{uuid.uuid4().hex}.tmp")
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(content)
+            os.replace(tmp_path, path)
+        return f"{THUMBNAIL_URL_PREFIX}/{name}"
+
+    def stream(
+        self,
+        content: bytes,
+        export_format: str,
+        filename: str,
+        etag: Optional[str] = None
+    ) -> StreamingResponse:
+        """以流的形式返回导出文件"""
+        headers = {
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Content-Length": str(len(content))
+        }
+        if etag:
+            headers["ETag"] = etag
+        return StreamingResponse(
+            iter_chunks(content),
+            media_type=MEDIA_TYPES[export_format],
+            headers=headers
+        )
+
     async def export_svg(self, svg_content: str, filename: str = "diagram.svg") -> StreamingResponse:
         """导出 SVG"""
         svg_bytes = svg_content.encode('utf-8')
-        
+
         return StreamingResponse(
             BytesIO(svg_bytes),
             media_type="image/svg+xml",
@@ -22,35 +245,28 @@ class ExportService:
                 "Content-Disposition": f"attachment; filename={filename}"
             }
         )
-    
+
     async def export_png(
         self,
         svg_content: str,
-        width: Optional[int] = None,
-        height: Optional[int] = None,
+        scale: float = 1.0,
+        dpi: int = 96,
         filename: str = "diagram.png"
     ) -> StreamingResponse:
-        """导出 PNG
-        
-        注意: 由于依赖较重的图像库,这里返回 SVG 供前端转换
-        生产环境建议使用 cairosvg 或 selenium + Chrome headless
-        """
-        # 简化实现: 返回 SVG,由前端 Canvas 转换
-        return await self.export_svg(svg_content, filename.replace('.png', '.svg'))
-    
+        """导出 PNG"""
+        content = await self.render(svg_content, "png", scale, dpi)
+        return self.stream(content, "png", filename)
+
     async def export_pdf(
         self,
         svg_content: str,
+        scale: float = 1.0,
+        dpi: int = 96,
         filename: str = "diagram.pdf"
     ) -> StreamingResponse:
-        """导出 PDF
-        
-        注意: 需要安装 weasyprint 或 reportlab
-        这里提供简化实现
-        """
-        # 简化实现: 返回 SVG,建议前端使用 jsPDF 转换
-        # 或后端使用 weasyprint: from weasyprint import HTML
-        return await self.export_svg(svg_content, filename.replace('.pdf', '.svg'))
+        """导出 PDF"""
+        content = await self.render(svg_content, "pdf", scale, dpi)
+        return self.stream(content, "pdf", filename)
 
 
 # 全局导出服务实例
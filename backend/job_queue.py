@@ -0,0 +1,446 @@
+"""
+异步任务队列 - AI 生成任务在后台 worker 中执行,客户端通过任务 ID 获取结果
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import redis.asyncio as redis
+from fastapi import HTTPException
+from config import settings
+from models import DiagramTypeEnum
+from redis_client import get_redis
+from ai_service import ai_service, generation_response
+from latency import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobQueue:
+    """有界 worker 池的任务队列
+
+    启用 Redis 时任务进入共享列表,任何 worker 进程都可以领取,
+    任务状态以 JSON 保存并在完成时通过频道通知;
+    领取的任务原子地移入处理列表,执行期间定期续期租约,完成后移出;
+    进程退出后租约过期的任务由回收任务处理: 尚未开始的重新排队,执行中的标记为失败并归还用户名额。
+    未启用 Redis 时使用进程内队列 (单进程部署与测试)。
+    每个用户同时排队/执行的任务数受限,超出时返回 429;队列过长时返回 503。
+    """
+
+    def __init__(self, namespace: str, handler: Callable[[dict], Awaitable[Any]]):
+        self.namespace = namespace
+        self.handler = handler
+        self._redis: Optional[redis.Redis] = None
+        self._workers: List[asyncio.Task] = []
+        self._reaper: Optional[asyncio.Task] = None
+        # 进程内后端
+        self._queue: Optional[asyncio.Queue] = None
+        self._jobs: Dict[str, dict] = {}
+        self._events: Dict[str, asyncio.Event] = {}
+        self._active: Dict[int, int] = {}
+        # 指标
+        self.running = 0
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time = LatencyHistogram()
+        self.run_time = LatencyHistogram()
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.namespace}:job:{job_id}"
+
+    def _active_key(self, user_id: int) -> str:
+        return f"{self.namespace}:active:{user_id}"
+
+    @property
+    def _queue_key(self) -> str:
+        return f"{self.namespace}:queue"
+
+    @property
+    def _processing_key(self) -> str:
+        return f"{self.namespace}:processing"
+
+    def _lease_key(self, job_id: str) -> str:
+        return f"{self.namespace}:lease:{job_id}"
+
+    @property
+    def _done_channel_prefix(self) -> str:
+        return f"{self.namespace}:done:"
+
+    async def start(self):
+        """启动 worker"""
+        if self._workers:
+            return
+        self._redis = get_redis()
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker_loop(), name=f"{self.namespace}-worker-{i}")
+            for i in range(settings.JOB_WORKERS)
+        ]
+        if self._redis is not None:
+            self._reaper = asyncio.create_task(self._reap_loop(), name=f"{self.namespace}-reaper")
+
+    async def stop(self):
+        """停止 worker,未完成的进程内任务会丢失"""
+        workers, self._workers = self._workers, []
+        if self._reaper is not None:
+            workers.append(self._reaper)
+            self._reaper = None
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._redis = None
+
+    # ===== 提交与查询 =====
+
+    async def submit(self, user_id: int, payload: dict) -> dict:
+        """提交任务,返回任务记录"""
+        depth = await self.queue_depth()
+        if depth >= settings.JOB_MAX_QUEUE_DEPTH:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="任务队列已满,请稍后重试", headers={"Retry-After": "5"})
+
+        if not await self._acquire_slot(user_id):
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"每个用户最多同时运行 {settings.JOB_MAX_PER_USER} 个生成任务",
+                headers={"Retry-After": "5"}
+            )
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "status": "queued",
+            "payload": payload,
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        try:
+            await self._save(job)
+            if self._redis is not None:
+                await self._redis.lpush(self._queue_key, job["id"])
+            else:
+                self._events[job["id"]] = asyncio.Event()
+                self._queue.put_nowait(job["id"])
+        except redis.RedisError as e:
+            await self._release_slot(user_id)
+            logger.warning("提交任务失败: %s", e)
+            raise HTTPException(status_code=503, detail="任务队列不可用")
+
+        self.submitted += 1
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        """读取任务记录,不存在或已过期时返回 None"""
+        if self._redis is None:
+            return self._jobs.get(job_id)
+        try:
+            raw = await self._redis.get(self._job_key(job_id))
+        except redis.RedisError as e:
+            logger.warning("读取任务失败: %s", e)
+            raise HTTPException(status_code=503, detail="任务队列不可用")
+        return json.loads(raw) if raw is not None else None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """等待任务结束,超时返回当前记录"""
+        if self._redis is None:
+            event = self._events.get(job_id)
+            if event is not None:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._jobs.get(job_id)
+
+        pubsub = self._redis.pubsub()
+        try:
+            await pubsub.subscribe(self._done_channel_prefix + job_id)
+            # 订阅前任务可能已完成
+            job = await self.get(job_id)
+            if job is None or job["status"] in TERMINAL_STATUSES:
+                return job
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while (remaining := deadline - loop.time()) > 0:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=min(remaining, 1.0)
+                )
+                if message is not None:
+                    break
+            return await self.get(job_id)
+        except redis.RedisError as e:
+            logger.warning("等待任务结果失败: %s", e)
+            return await self.get(job_id)
+        finally:
+            try:
+                await pubsub.aclose()
+            except redis.RedisError:
+                pass
+
+    async def queue_depth(self) -> int:
+        """排队中的任务数"""
+        if self._redis is None:
+            return self._queue.qsize() if self._queue is not None else 0
+        try:
+            return await self._redis.llen(self._queue_key)
+        except redis.RedisError:
+            return 0
+
+    # ===== 存储 =====
+
+    async def _save(self, job: dict):
+        if self._redis is None:
+            self._jobs[job["id"]] = job
+            return
+        await self._redis.set(
+            self._job_key(job["id"]), json.dumps(job, ensure_ascii=False), ex=settings.JOB_RESULT_TTL
+        )
+
+    async def _acquire_slot(self, user_id: int) -> bool:
+        """占用用户的并发名额"""
+        if self._redis is None:
+            if self._active.get(user_id, 0) >= settings.JOB_MAX_PER_USER:
+                return False
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            return True
+
+        key = self._active_key(user_id)
+        try:
+            count = await self._redis.incr(key)
+            # 进程崩溃时计数不会归还,过期兜底
+            await self._redis.expire(key, settings.JOB_RESULT_TTL)
+            if count > settings.JOB_MAX_PER_USER:
+                await self._redis.decr(key)
+                return False
+            return True
+        except redis.RedisError as e:
+            logger.warning("检查任务并发名额失败: %s", e)
+            raise HTTPException(status_code=503, detail="任务队列不可用")
+
+    async def _release_slot(self, user_id: int):
+        if self._redis is None:
+            remaining = self._active.get(user_id, 0) - 1
+            if remaining > 0:
+                self._active[user_id] = remaining
+            else:
+                self._active.pop(user_id, None)
+            return
+        try:
+            await self._redis.decr(self._active_key(user_id))
+        except redis.RedisError as e:
+            logger.warning("归还任务并发名额失败: %s", e)
+
+    def _prune_memory_jobs(self):
+        """清理进程内已过期的任务记录"""
+        expires_before = time.time() - settings.JOB_RESULT_TTL
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < expires_before
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._events.pop(job_id, None)
+
+    # ===== 执行 =====
+
+    async def _next_job_id(self) -> Optional[str]:
+        if self._redis is None:
+            return await self._queue.get()
+        try:
+            job_id = await self._redis.blmove(self._queue_key, self._processing_key, 1, "RIGHT", "LEFT")
+            if job_id is not None:
+                await self._renew_lease(job_id)
+        except redis.RedisError as e:
+            logger.warning("领取任务失败: %s", e)
+            await asyncio.sleep(1)
+            return None
+        return job_id
+
+    async def _renew_lease(self, job_id: str):
+        await self._redis.set(self._lease_key(job_id), "1", px=int(settings.JOB_LEASE_TTL * 1000))
+
+    async def _keep_lease(self, job_id: str):
+        """执行期间定期续期租约"""
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_TTL / 3)
+            try:
+                await self._renew_lease(job_id)
+            except redis.RedisError as e:
+                logger.warning("续期任务租约失败: %s", e)
+
+    async def _ack(self, job_id: str):
+        """任务处理结束,移出处理列表"""
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.lrem(self._processing_key, 1, job_id)
+                pipe.delete(self._lease_key(job_id))
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("移出处理列表失败: %s", e)
+
+    async def _worker_loop(self):
+        while True:
+            job_id = await self._next_job_id()
+            if job_id is None:
+                continue
+            lease = None
+            if self._redis is not None:
+                lease = asyncio.create_task(self._keep_lease(job_id))
+            try:
+                await self._execute(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("执行任务 %s 失败", job_id)
+            finally:
+                if lease is not None:
+                    lease.cancel()
+                    await self._ack(job_id)
+
+    async def _reap_loop(self):
+        suspects: Set[str] = set()
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_TTL)
+            try:
+                suspects = await self._reap(suspects)
+            except redis.RedisError as e:
+                logger.warning("回收任务失败: %s", e)
+            except Exception:
+                logger.exception("回收任务失败")
+
+    async def _reap(self, suspects: Set[str]) -> Set[str]:
+        """回收处理列表中租约已过期的任务,返回本次发现但尚未回收的任务
+
+        连续两次检查都没有租约才回收,避免与刚领取、尚未写入租约的 worker 竞争;
+        多个进程同时回收时以 LREM 的结果为准,只有一个进程处理。
+        """
+        job_ids = await self._redis.lrange(self._processing_key, 0, -1)
+        if not job_ids:
+            return set()
+        leases = await self._redis.mget([self._lease_key(job_id) for job_id in job_ids])
+        missing = {job_id for job_id, lease in zip(job_ids, leases) if lease is None}
+        for job_id in missing & suspects:
+            if await self._redis.lrem(self._processing_key, 1, job_id):
+                await self._recover(job_id)
+        return missing - suspects
+
+    async def _recover(self, job_id: str):
+        raw = await self._redis.get(self._job_key(job_id))
+        if raw is None:
+            return
+        job = json.loads(raw)
+        if job["status"] == "queued":
+            # 尚未开始执行,放回队列下一个被领取的位置
+            await self._redis.rpush(self._queue_key, job_id)
+            return
+        if job["status"] in TERMINAL_STATUSES:
+            return
+        logger.warning("任务 %s 的执行进程已退出,标记为失败", job_id)
+        job["status"] = "failed"
+        job["error"] = "执行任务的进程已退出,任务中断"
+        job["finished_at"] = time.time()
+        self.failed += 1
+        await self._finish(job)
+
+    async def _execute(self, job_id: str):
+        job = await self.get(job_id)
+        if job is None or job["status"] != "queued":
+            return
+
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        self.wait_time.observe(job["started_at"] - job["created_at"])
+        await self._save(job)
+
+        self.running += 1
+        try:
+            job["result"] = await asyncio.wait_for(self.handler(job["payload"]), settings.JOB_TIMEOUT)
+            job["status"] = "succeeded"
+            self.succeeded += 1
+        except asyncio.TimeoutError:
+            job["status"] = "failed"
+            job["error"] = "任务执行超时"
+            self.failed += 1
+        except asyncio.CancelledError:
+            job["status"] = "failed"
+            job["error"] = "服务关闭,任务中断"
+            self.failed += 1
+            raise
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            self.failed += 1
+        finally:
+            self.running -= 1
+            job["finished_at"] = time.time()
+            self.run_time.observe(job["finished_at"] - job["started_at"])
+            await self._finish(job)
+
+    async def _finish(self, job: dict):
+        await self._release_slot(job["user_id"])
+        if self._redis is None:
+            self._jobs[job["id"]] = job
+            event = self._events.get(job["id"])
+            if event is not None:
+                event.set()
+            self._prune_memory_jobs()
+            return
+        try:
+            await self._save(job)
+            await self._redis.publish(self._done_channel_prefix + job["id"], job["status"])
+        except redis.RedisError as e:
+            logger.warning("保存任务结果失败: %s", e)
+
+    async def stats(self) -> dict:
+        """队列指标 (执行与耗时统计为当前进程)"""
+        return {
+            "backend": "redis" if self._redis is not None else "memory",
+            "workers": len(self._workers),
+            "queue_depth": await self.queue_depth(),
+            "running": self.running,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_time": self.wait_time.snapshot(),
+            "run_time": self.run_time.snapshot(),
+        }
+
+
+def public_job(job: dict) -> dict:
+    """返回给客户端的任务视图"""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+
+async def run_generation_job(payload: dict) -> dict:
+    """执行 AI 生成任务,返回与 /api/ai/generate 相同结构的结果"""
+    diagram_type = DiagramTypeEnum(payload["diagram_type"])
+    result = await ai_service.generate_diagram(
+        prompt=payload["prompt"],
+        diagram_type=diagram_type,
+        model=payload["model"],
+        chart_type=payload["chart_type"],
+        use_cache=not payload["bypass_cache"]
+    )
+    return generation_response(diagram_type, result)
+
+
+# 全局 AI 生成任务队列
+ai_job_queue = JobQueue("ai:jobs", run_generation_job)
@@ -0,0 +1,55 @@
+"""
+延迟统计 - 记录各上游提供商的响应耗时分布
+"""
+import bisect
+from collections import deque
+from typing import Deque, List, Optional
+
+# 直方图桶上界 (秒),最后一个桶收集所有更慢的请求
+BUCKET_BOUNDS = (0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 45.0, 60.0)
+
+
+class LatencyHistogram:
+    """延迟直方图
+
+    累计分桶计数用于监控展示;分位数基于最近 window 个样本计算,
+    以便跟随提供商当前的真实状态变化。
+    """
+
+    def __init__(self, window: int = 500):
+        self.buckets: List[int] = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        """记录一次耗时"""
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self._recent.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """最近样本的分位数 (q 取 0~1),无样本时返回 None"""
+        if not self._recent:
+            return None
+        samples = sorted(self._recent)
+        index = min(len(samples) - 1, max(0, int(round(q * (len(samples) - 1)))))
+        return samples[index]
+
+    @property
+    def samples(self) -> int:
+        return len(self._recent)
+
+    def snapshot(self) -> dict:
+        """统计快照"""
+        labels = [f"le_{bound:g}" for bound in BUCKET_BOUNDS] + ["inf"]
+        percentiles = {q: self.percentile(q) for q in (0.5, 0.9, 0.99)}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "p50": round(percentiles[0.5], 3) if self.samples else None,
+            "p90": round(percentiles[0.9], 3) if self.samples else None,
+            "p99": round(percentiles[0.99], 3) if self.samples else None,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
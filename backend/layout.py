@@ -0,0 +1,436 @@
+"""
+自动布局 - 模型只输出节点与连线,由分层布局 (Sugiyama) 计算 Excalidraw 元素坐标与连线路径
+
+步骤: 去环 → 最长路径分层 → 长边插入虚拟节点 → 重心法减少交叉 → 层内坐标分配 → 连线路由。
+分层、交叉计数与坐标分配按层以 NumPy 数组批量计算,节点数较多时也能快速完成。
+"""
+import math
+from typing import Any, Dict, List, Tuple
+import numpy as np
+from config import settings
+from excalidraw_parser import (
+    SHAPE_TYPES,
+    ElementError,
+    ElementStreamParser,
+    ParseResult,
+    validate_element,
+)
+from mermaid_validator import label_width, repair_label
+
+DIRECTIONS = ("TB", "BT", "LR", "RL")
+
+# 节点尺寸按标签宽度估算,与前端绑定文本的字号 (14px) 一致
+LABEL_FONT_SIZE = 14
+NODE_HEIGHT = 60
+NODE_MIN_WIDTH = 120
+NODE_PADDING = 40
+# 虚拟节点 (长边经过的拐点) 在层内占用的宽度
+DUMMY_BREADTH = 20
+EDGE_LABEL_FONT_SIZE = 14
+# 交叉计数时每次比较的连线数,限制临时矩阵的内存
+CROSSING_BLOCK = 256
+
+
+def _node_id(value: Any) -> str:
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ElementError(f"节点 id 无效: {value!r}")
+    node_id = str(value).strip()
+    if not node_id:
+        raise ElementError("节点 id 为空")
+    return node_id
+
+
+def validate_topology_item(raw: Any) -> dict:
+    """校验拓扑输出中的单项,按字段区分节点、连线、方向与已布局的元素
+
+    - 节点: {"id": "a", "label": "用户登录", "shape": "rectangle|ellipse|diamond"}
+    - 连线: {"from": "a", "to": "b", "label": "是"}
+    - 方向: {"direction": "TB|LR"}
+    - 带坐标的对象视为已布局的元素 (如缓存中的结果),按元素结构校验后原样保留
+    """
+    if not isinstance(raw, dict):
+        raise ElementError("拓扑项不是对象")
+    if "x" in raw or "startX" in raw:
+        return {"kind": "element", "element": validate_element(raw)}
+    if "from" in raw or "to" in raw:
+        item = {"kind": "edge", "from": _node_id(raw.get("from")), "to": _node_id(raw.get("to"))}
+        label = raw.get("label")
+        if isinstance(label, (str, int, float)) and not isinstance(label, bool):
+            label = repair_label(str(label).strip())
+            if label:
+                item["label"] = label
+        return item
+    if "id" in raw:
+        node_id = _node_id(raw["id"])
+        label = raw.get("label")
+        if not isinstance(label, (str, int, float)) or isinstance(label, bool):
+            label = node_id
+        shape = raw.get("shape", raw.get("type"))
+        shape = shape.strip().lower() if isinstance(shape, str) else "rectangle"
+        return {
+            "kind": "node",
+            "id": node_id,
+            "label": repair_label(str(label).strip()) or node_id,
+            "shape": shape if shape in SHAPE_TYPES else "rectangle",
+        }
+    if "direction" in raw:
+        direction = str(raw["direction"]).strip().upper()
+        direction = {"TD": "TB"}.get(direction, direction)
+        if direction not in DIRECTIONS:
+            raise ElementError(f"不支持的布局方向: {raw['direction']!r}")
+        return {"kind": "direction", "direction": direction}
+    raise ElementError("无法识别的拓扑项")
+
+
+def text_size(text: str, font_size: float = LABEL_FONT_SIZE) -> Tuple[float, float]:
+    """估算文本宽高: 中日韩字符约为一个字号宽,其余字符约为半个字号,支持多行"""
+    lines = text.split("\n") or [""]
+    width = max(label_width(line) for line in lines) * font_size * 0.5
+    return width, len(lines) * font_size * 1.25
+
+
+def node_size(label: str, shape: str) -> Tuple[float, float]:
+    """节点宽高: 矩形按标签宽度加内边距,椭圆与菱形的内切区域更小,需要放大"""
+    text_width, text_height = text_size(label)
+    # 前端绑定文本按测量宽度的 1.3 倍留白
+    width = max(NODE_MIN_WIDTH, math.ceil(text_width * 1.3) + NODE_PADDING)
+    height = max(NODE_HEIGHT, math.ceil(text_height) + NODE_PADDING)
+    if shape == "ellipse":
+        width, height = width * 1.2, height * 1.2
+    elif shape == "diamond":
+        width, height = width * 1.5, height * 1.5
+    return float(round(width)), float(round(height))
+
+
+def _acyclic(count: int, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """深度优先搜索找出回边,返回需要反向的连线标记"""
+    adjacency: List[List[int]] = [[] for _ in range(count)]
+    for edge, source in enumerate(src.tolist()):
+        adjacency[source].append(edge)
+    reverse = np.zeros(len(src), dtype=bool)
+    state = [0] * count  # 0 未访问, 1 在栈中, 2 已完成
+    targets = dst.tolist()
+    for root in range(count):
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, iter(adjacency[root]))]
+        while stack:
+            node, edges = stack[-1]
+            for edge in edges:
+                target = targets[edge]
+                if state[target] == 1:
+                    reverse[edge] = True
+                elif state[target] == 0:
+                    state[target] = 1
+                    stack.append((target, iter(adjacency[target])))
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+    return reverse
+
+
+def _assign_ranks(count: int, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """最长路径分层: 每条连线的终点至少比起点低一层,再把只有出边的节点下移到紧贴其后继"""
+    rank = np.zeros(count, dtype=np.int64)
+    for _ in range(count):
+        updated = rank.copy()
+        np.maximum.at(updated, dst, rank[src] + 1)
+        if np.array_equal(updated, rank):
+            break
+        rank = updated
+
+    has_incoming = np.zeros(count, dtype=bool)
+    has_incoming[dst] = True
+    sources = ~has_incoming
+    if len(src):
+        nearest = np.full(count, np.iinfo(np.int64).max)
+        np.minimum.at(nearest, src, rank[dst])
+        movable = sources & (nearest < np.iinfo(np.int64).max)
+        rank[movable] = nearest[movable] - 1
+    return rank
+
+
+def _split_long_edges(
+    count: int, src: np.ndarray, dst: np.ndarray, rank: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """跨越多层的连线拆分为相邻层之间的线段,中间插入虚拟节点
+
+    返回 (各顶点所在层, 线段上端, 线段下端, 线段所属连线),线段按连线顺序排列。
+    """
+    extra = rank[dst] - rank[src] - 1
+    total = int(extra.sum())
+    offsets = np.cumsum(extra) - extra
+    dummy_edge = np.repeat(np.arange(len(src)), extra)
+    dummy_rank = rank[src][dummy_edge] + (np.arange(total) - offsets[dummy_edge]) + 1
+    dummies = count + np.arange(total)
+
+    segments = extra + 1
+    starts = np.cumsum(segments) - segments
+    seg_edge = np.repeat(np.arange(len(src)), segments)
+    first = np.zeros(len(seg_edge), dtype=bool)
+    first[starts] = True
+    last = np.zeros(len(seg_edge), dtype=bool)
+    last[starts + segments - 1] = True
+
+    upper = np.empty(len(seg_edge), dtype=np.int64)
+    upper[first] = src
+    upper[~first] = dummies
+    lower = np.empty(len(seg_edge), dtype=np.int64)
+    lower[last] = dst
+    lower[~last] = dummies
+    return np.concatenate([rank, dummy_rank]), upper, lower, seg_edge
+
+
+def _count_inversions(values: np.ndarray) -> int:
+    total = 0
+    indices = np.arange(len(values))
+    for start in range(0, len(values), CROSSING_BLOCK):
+        block = values[start:start + CROSSING_BLOCK]
+        later = values[start:]
+        after = indices[:len(later)][None, :] > indices[:len(block)][:, None]
+        total += int(np.count_nonzero((block[:, None] > later[None, :]) & after))
+    return total
+
+
+def _crossings(order: np.ndarray, upper: np.ndarray, lower: np.ndarray, bounds: np.ndarray) -> int:
+    """相邻两层之间的连线交叉数: 按上端位置排序后,下端位置的逆序对数"""
+    total = 0
+    for layer in range(len(bounds) - 1):
+        if bounds[layer + 1] - bounds[layer] < 2:
+            continue
+        segs = slice(bounds[layer], bounds[layer + 1])
+        top, bottom = order[upper[segs]], order[lower[segs]]
+        total += _count_inversions(bottom[np.lexsort((bottom, top))])
+    return total
+
+
+def _reorder(
+    order: np.ndarray,
+    members: np.ndarray,
+    slot: np.ndarray,
+    fixed: np.ndarray,
+    moving: np.ndarray,
+) -> None:
+    """按相邻层邻居位置的重心重排一层,没有邻居的顶点保持原位置
+
+    slot 为各顶点在所在层 members 中的下标,重心按层内下标累加,临时数组只与本层大小相关。
+    """
+    local = slot[moving]
+    weight = np.bincount(local, minlength=len(members))
+    barycenter = np.bincount(local, weights=order[fixed], minlength=len(members))
+    current = order[members].astype(float)
+    key = np.where(weight > 0, barycenter / np.maximum(weight, 1), current)
+    ranked = members[np.lexsort((current, key))]
+    order[ranked] = np.arange(len(ranked))
+
+
+def _minimize_crossings(
+    vertex_rank: np.ndarray, upper: np.ndarray, lower: np.ndarray, layers: List[np.ndarray]
+) -> np.ndarray:
+    """重心法上下交替扫描,保留交叉数最少的排列"""
+    order = np.zeros(len(vertex_rank), dtype=np.int64)
+    for members in layers:
+        order[members] = np.arange(len(members))
+    slot = order.copy()
+
+    seg_layer = vertex_rank[upper]
+    by_layer = np.argsort(seg_layer, kind="stable")
+    upper, lower = upper[by_layer], lower[by_layer]
+    bounds = np.searchsorted(seg_layer[by_layer], np.arange(len(layers) + 1))
+
+    best = order.copy()
+    best_crossings = _crossings(order, upper, lower, bounds)
+    for sweep in range(settings.LAYOUT_CROSSING_SWEEPS):
+        if best_crossings == 0:
+            break
+        if sweep % 2 == 0:
+            for layer in range(1, len(layers)):
+                segs = slice(bounds[layer - 1], bounds[layer])
+                _reorder(order, layers[layer], slot, upper[segs], lower[segs])
+        else:
+            for layer in range(len(layers) - 2, -1, -1):
+                segs = slice(bounds[layer], bounds[layer + 1])
+                _reorder(order, layers[layer], slot, lower[segs], upper[segs])
+        crossings = _crossings(order, upper, lower, bounds)
+        if crossings < best_crossings:
+            best, best_crossings = order.copy(), crossings
+    return best
+
+
+def _pack(target: np.ndarray, breadth: np.ndarray, spacing: float) -> np.ndarray:
+    """在保持顺序与最小间距的前提下,让一层内各顶点中心尽量接近目标位置
+
+    从左、从右各压缩一次取平均,两侧约束都满足时结果仍满足最小间距。
+    """
+    gaps = (breadth[:-1] + breadth[1:]) / 2 + spacing
+    offset = np.concatenate([[0.0], np.cumsum(gaps)])
+    shifted = target - offset
+    left = np.maximum.accumulate(shifted) + offset
+    right = np.minimum.accumulate(shifted[::-1])[::-1] + offset
+    return (left + right) / 2
+
+
+def _assign_positions(
+    order: np.ndarray,
+    breadth: np.ndarray,
+    upper: np.ndarray,
+    lower: np.ndarray,
+    layers: List[np.ndarray],
+) -> np.ndarray:
+    """层内坐标: 先紧密排列,再交替向上下层邻居的平均位置靠拢"""
+    spacing = settings.LAYOUT_NODE_SPACING
+    position = np.zeros(len(order))
+    ranked_layers = [members[np.argsort(order[members])] for members in layers]
+    for members in ranked_layers:
+        position[members] = _pack(np.zeros(len(members)), breadth[members], spacing)
+
+    size = len(order)
+    for sweep in range(4):
+        neighbors, own = (upper, lower) if sweep % 2 == 0 else (lower, upper)
+        weight = np.bincount(own, minlength=size)
+        total = np.bincount(own, weights=position[neighbors], minlength=size)
+        target = np.where(weight > 0, total / np.maximum(weight, 1), position)
+        for members in ranked_layers:
+            position[members] = _pack(target[members], breadth[members], spacing)
+    return position
+
+
+def layout_graph(nodes: List[dict], edges: List[dict], direction: str = "TB") -> List[dict]:
+    """计算节点与连线的 Excalidraw 元素 (形状带 label,连线为折线箭头,连线标签为独立文本)
+
+    节点可以通过 size 指定 (宽, 高),否则按标签估算;连线的 startId / endId 为两端形状的 id。
+    """
+    if not nodes:
+        return []
+    index = {node["id"]: i for i, node in enumerate(nodes)}
+    count = len(nodes)
+    pairs = [
+        (index[edge["from"]], index[edge["to"]], edge.get("label"))
+        for edge in edges
+        if edge["from"] != edge["to"]
+    ]
+    src = np.array([pair[0] for pair in pairs], dtype=np.int64)
+    dst = np.array([pair[1] for pair in pairs], dtype=np.int64)
+
+    sizes = np.array([node.get("size") or node_size(node["label"], node["shape"]) for node in nodes], dtype=float)
+    horizontal = direction in ("LR", "RL")
+    # breadth 为层内方向的尺寸,depth 为层间方向的尺寸
+    breadth, depth = (sizes[:, 1], sizes[:, 0]) if horizontal else (sizes[:, 0], sizes[:, 1])
+
+    reverse = _acyclic(count, src, dst)
+    top, bottom = np.where(reverse, dst, src), np.where(reverse, src, dst)
+    rank = _assign_ranks(count, top, bottom)
+    vertex_rank, upper, lower, seg_edge = _split_long_edges(count, top, bottom, rank)
+    vertex_breadth = np.concatenate([breadth, np.full(len(vertex_rank) - count, DUMMY_BREADTH)])
+
+    layer_count = int(vertex_rank.max()) + 1
+    by_rank = np.argsort(vertex_rank, kind="stable")
+    layers = np.split(by_rank, np.searchsorted(vertex_rank[by_rank], np.arange(1, layer_count)))
+
+    order = _minimize_crossings(vertex_rank, upper, lower, layers)
+    along = _assign_positions(order, vertex_breadth, upper, lower, layers)
+
+    layer_depth = np.zeros(layer_count)
+    np.maximum.at(layer_depth, rank, depth)
+    layer_start = np.concatenate([[0.0], np.cumsum(layer_depth + settings.LAYOUT_RANK_SPACING)[:-1]])
+    across = layer_start[vertex_rank] + layer_depth[vertex_rank] / 2
+    if direction in ("BT", "RL"):
+        across = -across
+    center_x, center_y = (across, along) if horizontal else (along, across)
+
+    half_w, half_h = sizes[:, 0] / 2, sizes[:, 1] / 2
+    shift_x = float((center_x[:count] - half_w).min())
+    shift_y = float((center_y[:count] - half_h).min())
+    center_x, center_y = center_x - shift_x, center_y - shift_y
+
+    elements: List[Dict[str, Any]] = []
+    for i, node in enumerate(nodes):
+        element = {
+            "type": node["shape"],
+            "id": f"node-{i}",
+            "x": round(float(center_x[i] - half_w[i])),
+            "y": round(float(center_y[i] - half_h[i])),
+            "width": int(sizes[i, 0]),
+            "height": int(sizes[i, 1]),
+        }
+        if node["label"]:
+            element["label"] = node["label"]
+        elements.append(element)
+
+    # 每条连线的顶点序列: 起点, 各虚拟节点, 终点
+    seg_starts = np.searchsorted(seg_edge, np.arange(len(pairs)))
+    seg_ends = np.searchsorted(seg_edge, np.arange(len(pairs)), side="right")
+    sign = -1 if direction in ("BT", "RL") else 1
+    for edge, (source, target, label) in enumerate(pairs):
+        chain = [int(upper[seg_starts[edge]])] + lower[seg_starts[edge]:seg_ends[edge]].tolist()
+        points = []
+        for position, vertex in enumerate(chain):
+            x, y = float(center_x[vertex]), float(center_y[vertex])
+            if vertex < count:
+                # 端点落在节点朝向连线的边缘中点;反向的连线错开四分之一宽度,避免与正向连线重叠
+                offset = sign * (1 if position == 0 else -1)
+                nudge = breadth[vertex] / 4 if reverse[edge] else 0
+                if horizontal:
+                    x += offset * half_w[vertex]
+                    y += nudge
+                else:
+                    y += offset * half_h[vertex]
+                    x += nudge
+            points.append((round(x), round(y)))
+        if reverse[edge]:
+            points.reverse()
+        x0, y0 = points[0]
+        elements.append({
+            "type": "arrow",
+            "id": f"edge-{edge}",
+            "x": x0,
+            "y": y0,
+            "points": [[x - x0, y - y0] for x, y in points],
+            "startId": f"node-{source}",
+            "endId": f"node-{target}",
+        })
+        if label:
+            middle = len(points) // 2
+            (ax, ay), (bx, by) = points[middle - 1], points[middle]
+            elements.append({
+                "type": "text",
+                "id": f"edge-label-{edge}",
+                "x": round((ax + bx) / 2 + 6),
+                "y": round((ay + by) / 2 - EDGE_LABEL_FONT_SIZE),
+                "text": label,
+                "fontSize": EDGE_LABEL_FONT_SIZE,
+            })
+    return elements
+
+
+def layout_topology(text: str) -> ParseResult:
+    """解析模型输出的拓扑并完成布局,返回与元素解析相同结构的结果
+
+    连线引用了未声明的节点时自动补充该节点 (输出截断时节点可能缺失);重复的连线只保留一条。
+    """
+    parser = ElementStreamParser(validate_topology_item)
+    parser.feed(text)
+    result = ParseResult(parser)
+
+    nodes: Dict[str, dict] = {}
+    edges: Dict[Tuple[str, str], dict] = {}
+    placed: List[dict] = []
+    direction = "TB"
+    for item in parser.elements:
+        kind = item["kind"]
+        if kind == "node":
+            nodes.setdefault(item["id"], item)
+        elif kind == "edge":
+            edges.setdefault((item["from"], item["to"]), item)
+        elif kind == "direction":
+            direction = item["direction"]
+        else:
+            placed.append(item["element"])
+    for edge in edges.values():
+        for node_id in (edge["from"], edge["to"]):
+            nodes.setdefault(node_id, {"id": node_id, "label": repair_label(node_id) or node_id, "shape": "rectangle"})
+
+    result.elements = placed + layout_graph(list(nodes.values()), list(edges.values()), direction)
+    return result
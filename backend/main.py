@@ -1,33 +1,82 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, BackgroundTasks, Depends, Header, HTTPException, Query, Response, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
-from sqlalchemy.orm import Session
-from datetime import timedelta
+from fastapi.staticfiles import StaticFiles
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from typing import List, Optional
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 import uvicorn
+import asyncio
 import base64
-from io import BytesIO
+import hashlib
+import json
+import logging
 
 from config import settings
-from database import get_db, Base, engine
-from models import User, Diagram, DiagramTypeEnum
+from database import get_db, async_engine, AsyncSessionLocal
+from models import (
+    User, Diagram, DiagramTypeEnum, DiagramVersion, DiagramPermission, TeamMember,
+    EntityTypeEnum, PermissionEnum
+)
 from auth import (
-    get_password_hash,
-    verify_password,
+    get_password_hash_async,
+    verify_password_async,
+    password_needs_rehash,
+    shutdown_password_executor,
     create_access_token,
+    authenticate_token,
     get_current_active_user
 )
-from ai_service import ai_service
+from ai_service import ai_service, generation_response
+from excalidraw_parser import ElementStreamParser, ParseResult
+from prompts import excalidraw_auto_layout
+from mermaid_converter import ConversionError, mermaid_to_elements, to_scene
+from mermaid_validator import detect_chart_type
+from export_service import export_service, THUMBNAIL_DIR, THUMBNAIL_URL_PREFIX
+from export_cache import export_cache, export_cache_key
+from ai_cache import ai_cache
+from rate_limit import user_rate_limiter, rate_limited
+from job_queue import ai_job_queue, public_job, TERMINAL_STATUSES
+from diagram_patch import PatchError, apply_json_patch, upsert_elements
+from version_store import version_store, content_of, diff_json, unified_diff
+from collab import collab_hub
+from template_catalog import template_catalog
+from redis_client import close_redis
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期: 启动时创建共享资源,关闭时释放"""
+    await ai_service.startup()
+    await ai_job_queue.start()
+    await collab_hub.start()
+    await template_catalog.start()
+    try:
+        yield
+    finally:
+        await template_catalog.stop()
+        await collab_hub.stop()
+        await ai_job_queue.stop()
+        await ai_service.shutdown()
+        await close_redis()
+        await async_engine.dispose()
+        shutdown_password_executor()
+        export_service.shutdown()
 
-# 创建数据库表
-Base.metadata.create_all(bind=engine)
 
 # 创建 FastAPI 应用
 app = FastAPI(
     title="AI Graphics Flow API",
     description="AI 图形生成应用后端 API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置 CORS
@@ -51,8 +100,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# 图形缩略图 (文件名为内容哈希,可长期缓存)
+THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+app.mount(THUMBNAIL_URL_PREFIX, StaticFiles(directory=THUMBNAIL_DIR), name="thumbnails")
+
 
 # ===== Pydantic 模型 =====
 
@@ -87,6 +141,7 @@ class DiagramCreate(BaseModel):
     diagram_type: DiagramTypeEnum
     mermaid_code: Optional[str] = None
     excalidraw_data: Optional[dict] = None
+    svg_content: Optional[str] = None  # 前端渲染的 SVG,用于生成缩略图
 
 
 class DiagramResponse(BaseModel):
@@ -96,24 +151,135 @@ class DiagramResponse(BaseModel):
     render_engine: DiagramTypeEnum
     mermaid_code: Optional[str]
     excalidraw_data: Optional[dict]
-    created_at: str
-    updated_at: Optional[str]
+    thumbnail_url: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime]
+    revision: int
+    
+    class Config:
+        from_attributes = True
+
+
+class DiagramUpdate(BaseModel):
+    """部分更新: 只修改请求中出现的字段
+    
+    Excalidraw 数据可以整体替换 (excalidraw_data),也可以只提交变化部分:
+    excalidraw_patch 为 JSON Patch,elements 为按 id 更新或追加的元素。
+    """
+    title: Optional[str] = Field(None, min_length=1, max_length=200)
+    description: Optional[str] = None
+    tags: Optional[list] = None
+    is_public: Optional[bool] = None
+    mermaid_code: Optional[str] = None
+    excalidraw_data: Optional[dict] = None
+    excalidraw_patch: Optional[List[dict]] = None
+    elements: Optional[List[dict]] = None
+    svg_content: Optional[str] = None  # 前端渲染的 SVG,用于重新生成缩略图
+    change_description: Optional[str] = Field(None, max_length=500)
+
+
+class DiagramRefineRequest(BaseModel):
+    instruction: str = Field(..., min_length=1)
+    model: str = "gemini-3-pro"
+
+
+class DiagramRefineResponse(BaseModel):
+    diagram: DiagramResponse
+    version_number: int
+    patch: List[dict]
+
+
+class MermaidConvertRequest(BaseModel):
+    mermaid_code: str = Field(..., min_length=1)
+
+
+class MermaidConvertResponse(BaseModel):
+    chart_type: str
+    excalidraw_data: dict
+
+
+class TemplateInstantiateRequest(BaseModel):
+    title: Optional[str] = Field(None, min_length=1, max_length=200)  # 默认使用模板名称
+
+
+class DiagramVersionItem(BaseModel):
+    """版本列表项,不包含内容"""
+    version_number: int
+    is_snapshot: bool
+    changed_by: int
+    change_description: Optional[str]
+    created_at: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
+
+
+class DiagramVersionListResponse(BaseModel):
+    items: List[DiagramVersionItem]
+    next_before: Optional[int]
+
+
+class DiagramVersionDetail(BaseModel):
+    version_number: int
+    mermaid_code: Optional[str]
+    excalidraw_data: Optional[dict]
+
+
+class DiagramRestoreResponse(BaseModel):
+    diagram: DiagramResponse
+    version_number: int
+
+
+class DiagramListItem(BaseModel):
+    """列表视图的轻量投影,不包含 mermaid_code / excalidraw_data"""
+    id: int
+    title: str
+    diagram_type: DiagramTypeEnum
+    render_engine: DiagramTypeEnum
+    thumbnail_url: Optional[str]
+    description: Optional[str]
+    tags: Optional[list]
+    is_public: Optional[bool]
+    created_at: datetime
+    updated_at: Optional[datetime]
     
     class Config:
         from_attributes = True
 
 
+class DiagramListResponse(BaseModel):
+    items: List[DiagramListItem]
+    next_cursor: Optional[str]
+    total_estimate: Optional[int]
+
+
 class AIGenerateRequest(BaseModel):
     prompt: str
     diagram_type: DiagramTypeEnum
     model: str = "gemini-3-pro"
     chart_type: Optional[str] = "flowchart"
+    bypass_cache: bool = False
+
+
+class AIBatchTarget(BaseModel):
+    diagram_type: DiagramTypeEnum = DiagramTypeEnum.MERMAID
+    chart_type: Optional[str] = "flowchart"
+    model: Optional[str] = None  # 缺省时使用请求中的 model
+
+
+class AIBatchGenerateRequest(BaseModel):
+    prompt: str
+    targets: List[AIBatchTarget] = Field(..., min_length=1, max_length=settings.AI_BATCH_MAX_TARGETS)
+    model: str = "gemini-3-pro"
+    bypass_cache: bool = False
 
 
 class ExportRequest(BaseModel):
     svg_content: str
     format: str  # 'svg', 'png', 'pdf'
     filename: Optional[str] = None
+    scale: float = Field(1.0, gt=0, le=settings.EXPORT_MAX_SCALE)
+    dpi: int = Field(96, ge=36, le=600)
 
 
 # ===== API 路由 =====
@@ -125,17 +291,17 @@ async def root():
 
 
 @app.post("/api/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
     """用户注册"""
     # 检查用户是否已存在
-    if db.query(User).filter(User.email == user_data.email).first():
+    if await db.scalar(select(User.id).where(User.email == user_data.email)):
         raise HTTPException(status_code=400, detail="邮箱已被注册")
     
-    if db.query(User).filter(User.username == user_data.username).first():
+    if await db.scalar(select(User.id).where(User.username == user_data.username)):
         raise HTTPException(status_code=400, detail="用户名已被使用")
     
     # 创建新用户
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     new_user = User(
         username=user_data.username,
         email=user_data.email,
@@ -143,23 +309,28 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     
     return new_user
 
 
 @app.post("/api/auth/login", response_model=Token)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """用户登录"""
-    user = db.query(User).filter(User.email == user_data.email).first()
+    user = await db.scalar(select(User).where(User.email == user_data.email))
     
-    if not user or not verify_password(user_data.password, user.password_hash):
+    if not user or not await verify_password_async(user_data.password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="邮箱或密码错误"
         )
     
+    # cost 因子调整后,借助本次已验证的明文密码透明地重新哈希
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = await get_password_hash_async(user_data.password)
+        await db.commit()
+    
     # 创建访问令牌
     access_token_expires = timedelta(minutes=settings.JWT_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -176,10 +347,19 @@ async def get_current_user_info(current_user: User = Depends(get_current_active_
     return current_user
 
 
+async def check_ai_rate_limit(current_user: User = Depends(get_current_active_user)) -> User:
+    """AI 生成接口的按用户限流"""
+    if settings.AI_RATE_LIMIT_ENABLED:
+        wait = await user_rate_limiter.acquire(str(current_user.id))
+        if wait > 0:
+            raise rate_limited(wait, "请求过于频繁,请稍后重试")
+    return current_user
+
+
 @app.post("/api/ai/generate")
 async def generate_diagram(
     request: AIGenerateRequest,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(check_ai_rate_limit)
 ):
     """AI 生成图形"""
     try:
@@ -188,14 +368,13 @@ async def generate_diagram(
             prompt=request.prompt,
             diagram_type=request.diagram_type,
             model=request.model,
-            chart_type=request.chart_type
+            chart_type=request.chart_type,
+            use_cache=not request.bypass_cache
         )
         
-        return {
-            "success": True,
-            "diagram_type": request.diagram_type.value,
-            "code" if request.diagram_type == DiagramTypeEnum.MERMAID else "data": result
-        }
+        return generation_response(request.diagram_type, result)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -203,13 +382,287 @@ async def generate_diagram(
         )
 
 
+def _sse_event(event: str, data: dict) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_error(exc: BaseException) -> dict:
+    """error 事件的内容,被限流时附带 status 与 retry_after"""
+    if isinstance(exc, HTTPException):
+        return {
+            "detail": exc.detail,
+            "status": exc.status_code,
+            "retry_after": (exc.headers or {}).get("Retry-After")
+        }
+    return {"detail": f"AI 生成失败: {str(exc)}"}
+
+
+@app.post("/api/ai/generate/stream")
+async def generate_diagram_stream(
+    request: AIGenerateRequest,
+    current_user: User = Depends(check_ai_rate_limit)
+):
+    """AI 流式生成图形 (SSE)
+    
+    事件类型:
+    - delta: 增量文本 {"text": "..."}
+    - element: Excalidraw 元素完整且校验通过后立即下发 {"element": {...}};
+      自动布局模式下坐标需要完整拓扑才能计算,不下发该事件
+    - done: 生成完成 {"diagram_type": "...", "content": "完整内容 (Mermaid 已做确定性修复,修复后仍无效时下发 error)"};
+      Excalidraw 的 content 为有效元素列表,并附带 warnings (丢弃的元素、输出截断)
+    - error: 开始输出后生成失败 {"detail": "..."},被限流时附带 status 与 retry_after
+    
+    输出第一段内容之前的失败 (需求过长、熔断、限流、上游错误) 直接返回对应的 HTTP 状态码与 Retry-After。
+    """
+    chunks = ai_service.stream_diagram(
+        prompt=request.prompt,
+        diagram_type=request.diagram_type,
+        model=request.model,
+        chart_type=request.chart_type,
+        use_cache=not request.bypass_cache
+    )
+    try:
+        first = [await chunks.__anext__()]
+    except StopAsyncIteration:
+        first = []
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI 生成失败: {str(e)}")
+    
+    async def stream_chunks():
+        for text in first:
+            yield text
+        async for text in chunks:
+            yield text
+    
+    async def event_stream():
+        parts = []
+        parser = None
+        if request.diagram_type == DiagramTypeEnum.EXCALIDRAW and not excalidraw_auto_layout():
+            parser = ElementStreamParser()
+        try:
+            async for text in stream_chunks():
+                parts.append(text)
+                yield _sse_event("delta", {"text": text})
+                if parser is not None:
+                    for element in parser.feed(text):
+                        yield _sse_event("element", {"element": element})
+            
+            content = "".join(parts)
+            done = {"diagram_type": request.diagram_type.value, "content": content}
+            # 流结束后对完整代码做确定性修复,前端以 done 事件中的内容为准
+            if request.diagram_type == DiagramTypeEnum.MERMAID:
+                check = ai_service.check_mermaid(content, request.chart_type)
+                if check is not None:
+                    # 流式输出无法重新请求模型,确定性修复后仍无效时按生成失败处理
+                    if not check.valid:
+                        raise HTTPException(status_code=502, detail="AI 生成失败,未返回有效内容")
+                    done["content"] = check.code
+            else:
+                result = ParseResult(parser) if parser is not None else await ai_service.parse_excalidraw_async(content)
+                if result.found_array:
+                    if not result.elements:
+                        raise HTTPException(status_code=502, detail="AI 未返回有效的 Excalidraw 元素")
+                    done["content"] = result.elements
+                    if result.warnings:
+                        done["warnings"] = result.warnings
+            
+            yield _sse_event("done", done)
+        except Exception as e:
+            yield _sse_event("error", _sse_error(e))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # 关闭 nginx 代理缓冲,保证分片即时下发
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@app.post("/api/ai/generate/batch")
+async def generate_diagram_batch(
+    request: AIBatchGenerateRequest,
+    current_user: User = Depends(get_current_active_user)
+):
+    """同一需求批量生成多种图形 (SSE),各目标并发执行,按完成顺序下发
+    
+    事件类型:
+    - result: 单个目标完成 {"index": 目标下标, "chart_type": "...", "model": "...", 其余字段与 /api/ai/generate 相同}
+    - error: 单个目标失败 {"index": ..., "detail": "..."},不影响其他目标;没有 index 时整个批次失败
+    - done: 全部完成 {"succeeded": n, "failed": n}
+    按目标数计入用户限流。
+    """
+    if settings.AI_RATE_LIMIT_ENABLED:
+        wait = await user_rate_limiter.acquire(str(current_user.id), cost=len(request.targets))
+        if wait > 0:
+            raise rate_limited(wait, "请求过于频繁,请稍后重试")
+    targets = [
+        (target.diagram_type, target.model or request.model, target.chart_type)
+        for target in request.targets
+    ]
+    
+    async def event_stream():
+        succeeded = failed = 0
+        try:
+            async for index, result, error in ai_service.generate_batch(
+                request.prompt, targets, use_cache=not request.bypass_cache
+            ):
+                diagram_type, model, chart_type = targets[index]
+                target = {"index": index, "chart_type": chart_type, "model": model}
+                if error is None:
+                    succeeded += 1
+                    yield _sse_event("result", {**target, **generation_response(diagram_type, result)})
+                else:
+                    failed += 1
+                    yield _sse_event("error", {**target, **_sse_error(error)})
+            yield _sse_event("done", {"succeeded": succeeded, "failed": failed})
+        except Exception as e:
+            yield _sse_event("error", _sse_error(e))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@app.get("/api/ai/cache/stats")
+async def get_ai_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """AI 生成缓存命中与请求合并统计"""
+    return {**ai_cache.stats(), "singleflight": ai_service.singleflight.stats()}
+
+
+@app.get("/api/ai/providers/stats")
+async def get_ai_provider_stats(current_user: User = Depends(get_current_active_user)):
+    """AI 提供商延迟分布与对冲请求统计"""
+    return ai_service.provider_stats()
+
+
+@app.post("/api/ai/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_generate_job(
+    request: AIGenerateRequest,
+    current_user: User = Depends(check_ai_rate_limit)
+):
+    """提交异步 AI 生成任务,立即返回任务 ID
+    
+    结果通过 GET /api/ai/jobs/{job_id} (可长轮询) 或 /api/ai/jobs/{job_id}/events (SSE) 获取。
+    """
+    job = await ai_job_queue.submit(current_user.id, {
+        "prompt": request.prompt,
+        "diagram_type": request.diagram_type.value,
+        "model": request.model,
+        "chart_type": request.chart_type,
+        "bypass_cache": request.bypass_cache
+    })
+    return public_job(job)
+
+
+@app.get("/api/ai/jobs/stats")
+async def get_ai_job_stats(current_user: User = Depends(get_current_active_user)):
+    """任务队列深度与执行统计"""
+    return await ai_job_queue.stats()
+
+
+async def _get_user_job(job_id: str, user: User) -> dict:
+    """读取当前用户的任务,不存在时返回 404"""
+    job = await ai_job_queue.get(job_id)
+    if job is None or job["user_id"] != user.id:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+
+@app.get("/api/ai/jobs/{job_id}")
+async def get_generate_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=30),
+    current_user: User = Depends(get_current_active_user)
+):
+    """查询任务状态,wait > 0 时最多等待 wait 秒直到任务结束"""
+    job = await _get_user_job(job_id, current_user)
+    if wait > 0 and job["status"] not in TERMINAL_STATUSES:
+        job = await ai_job_queue.wait(job_id, wait) or job
+    return public_job(job)
+
+
+@app.get("/api/ai/jobs/{job_id}/events")
+async def get_generate_job_events(
+    job_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """以 SSE 推送任务结果
+    
+    事件类型:
+    - status: 当前状态 (连接建立时发送一次)
+    - done: 任务结束,数据与 GET /api/ai/jobs/{job_id} 相同
+    - error: 任务记录已过期或被删除 {"detail": "..."}
+    """
+    job = await _get_user_job(job_id, current_user)
+    
+    async def event_stream():
+        current = job
+        yield _sse_event("status", public_job(current))
+        while current["status"] not in TERMINAL_STATUSES:
+            current = await ai_job_queue.wait(job_id, 15)
+            if current is None:
+                yield _sse_event("error", {"detail": "任务不存在或已过期"})
+                return
+            if current["status"] not in TERMINAL_STATUSES:
+                # 心跳,防止代理因空闲关闭连接
+                yield ": keepalive\n\n"
+        yield _sse_event("done", public_job(current))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+async def generate_diagram_thumbnail(diagram_id: int, revision: int, svg_content: str):
+    """后台生成缩略图并写入 thumbnail_url
+    
+    只在图形仍是安排任务时的修订号时写入,先后提交的两次修改即使缩略图乱序完成,也不会用旧内容的缩略图覆盖。
+    """
+    try:
+        thumbnail_url = await export_service.render_thumbnail(svg_content)
+    except Exception as e:
+        logger.warning("生成缩略图失败 (diagram=%s): %s", diagram_id, e)
+        return
+    if thumbnail_url is None:
+        return
+    
+    async with AsyncSessionLocal() as db:
+        # 显式保留 updated_at,缩略图不算作内容修改
+        await db.execute(
+            update(Diagram)
+            .where(Diagram.id == diagram_id, Diagram.revision == revision)
+            .values(thumbnail_url=thumbnail_url, updated_at=Diagram.updated_at)
+        )
+        await db.commit()
+
+
 @app.post("/api/diagrams", response_model=DiagramResponse, status_code=status.HTTP_201_CREATED)
 async def create_diagram(
     diagram_data: DiagramCreate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """创建图形"""
+    """创建图形
+    
+    提供 svg_content 时在响应返回后异步生成缩略图。
+    """
     new_diagram = Diagram(
         user_id=current_user.id,
         title=diagram_data.title,
@@ -220,96 +673,660 @@ async def create_diagram(
     )
     
     db.add(new_diagram)
-    db.commit()
-    db.refresh(new_diagram)
+    await db.commit()
+    await db.refresh(new_diagram)
+    
+    if diagram_data.svg_content:
+        background_tasks.add_task(
+            generate_diagram_thumbnail, new_diagram.id, new_diagram.revision, diagram_data.svg_content
+        )
     
     return new_diagram
 
 
-@app.get("/api/diagrams", response_model=List[DiagramResponse])
+def _encode_cursor(updated_at: datetime, diagram_id: int) -> str:
+    """编码分页游标"""
+    raw = json.dumps([updated_at.isoformat(), diagram_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str):
+    """解码分页游标,格式错误时返回 400"""
+    try:
+        updated_at, diagram_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(updated_at), int(diagram_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+
+@app.get("/api/diagrams", response_model=DiagramListResponse)
 async def get_diagrams(
-    skip: int = 0,
-    limit: int = 20,
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """获取用户的图形列表"""
-    diagrams = db.query(Diagram).filter(
+    """获取用户的图形列表
+    
+    按最近更新时间倒序,使用 (updated_at, id) 游标分页;
+    仅返回列表所需字段,总数只在首页计算。
+    """
+    conditions = [
         Diagram.user_id == current_user.id,
         Diagram.is_deleted == False
-    ).offset(skip).limit(limit).all()
+    ]
+    
+    query = select(
+        Diagram.id,
+        Diagram.title,
+        Diagram.diagram_type,
+        Diagram.render_engine,
+        Diagram.thumbnail_url,
+        Diagram.description,
+        Diagram.tags,
+        Diagram.is_public,
+        Diagram.created_at,
+        Diagram.updated_at
+    ).where(*conditions)
+    
+    if cursor:
+        cursor_updated_at, cursor_id = _decode_cursor(cursor)
+        query = query.where(or_(
+            Diagram.updated_at < cursor_updated_at,
+            and_(Diagram.updated_at == cursor_updated_at, Diagram.id < cursor_id)
+        ))
+    
+    # 多取一条用于判断是否还有下一页
+    result = await db.execute(
+        query.order_by(Diagram.updated_at.desc(), Diagram.id.desc()).limit(limit + 1)
+    )
+    rows = result.all()
     
-    return diagrams
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].updated_at, rows[-1].id)
+    
+    total_estimate = None
+    if not cursor:
+        total_estimate = await db.scalar(select(func.count(Diagram.id)).where(*conditions))
+    
+    return {
+        "items": rows,
+        "next_cursor": next_cursor,
+        "total_estimate": total_estimate
+    }
+
+
+async def _get_user_diagram(db: AsyncSession, diagram_id: int, user: User) -> Diagram:
+    diagram = await db.scalar(
+        select(Diagram).where(
+            Diagram.id == diagram_id,
+            Diagram.user_id == user.id,
+            Diagram.is_deleted == False
+        )
+    )
+    if not diagram:
+        raise HTTPException(status_code=404, detail="图形不存在")
+    return diagram
+
+
+def _diagram_etag(diagram: Diagram) -> str:
+    """图形 ETag: 修订号标识内容版本;缩略图在后台生成且不改变修订号,单独计入以便 If-None-Match 感知更新"""
+    thumbnail = hashlib.sha256((diagram.thumbnail_url or "").encode()).hexdigest()[:8]
+    return f'"{diagram.id}-{diagram.revision}-{thumbnail}"'
+
+
+def _revision_matches(if_match: str, diagram: Diagram) -> bool:
+    """If-Match 只比较图形 id 与修订号,缩略图更新不会使客户端持有的 ETag 失效"""
+    prefix = f'"{diagram.id}-{diagram.revision}'
+    tags = [tag.strip().removeprefix("W/") for tag in if_match.split(',')]
+    return '*' in tags or any(tag == f'{prefix}"' or tag.startswith(f"{prefix}-") for tag in tags)
 
 
 @app.get("/api/diagrams/{diagram_id}", response_model=DiagramResponse)
 async def get_diagram(
     diagram_id: int,
-    db: Session = Depends(get_db),
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取单个图形
+    
+    ETag 由图形修订号与缩略图地址生成,作为 PATCH 的 If-Match 条件 (只比较修订号);
+    携带 If-None-Match 且未修改时返回 304。
+    """
+    diagram = await _get_user_diagram(db, diagram_id, current_user)
+    
+    etag = _diagram_etag(diagram)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return diagram
+
+
+async def _commit_diagram(db: AsyncSession, diagram: Diagram):
+    """提交图形修改;修订号已变化或并发保存同一版本时返回 412 / 409"""
+    try:
+        await db.commit()
+    except StaleDataError:
+        await db.rollback()
+        raise HTTPException(status_code=412, detail="图形已被其他请求修改,请刷新后重试")
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="图形已被修改,请刷新后重试")
+    await db.refresh(diagram)
+
+
+async def _save_version(
+    db: AsyncSession,
+    diagram: Diagram,
+    user_id: int,
+    description: str,
+    baseline: dict,
+    background_tasks: BackgroundTasks,
+    autosave: bool = False
+) -> int:
+    """把图形的修改与新版本一起提交,返回版本号"""
+    version_number = await version_store.record(
+        db, diagram, user_id, description,
+        baseline=baseline,
+        coalesce_window=settings.VERSION_AUTOSAVE_WINDOW if autosave else None
+    )
+    await _commit_diagram(db, diagram)
+    
+    if version_store.needs_compaction(version_number):
+        background_tasks.add_task(version_store.compact, diagram.id)
+    return version_number
+
+
+@app.patch("/api/diagrams/{diagram_id}", response_model=DiagramResponse)
+async def update_diagram(
+    diagram_id: int,
+    request: DiagramUpdate,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    autosave: bool = Query(False, description="自动保存: 同一时间窗口内的保存合并为一个版本"),
+    if_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """获取单个图形"""
-    diagram = db.query(Diagram).filter(
+    """部分更新图形
+    
+    携带 If-Match 时需与当前 ETag 一致,否则返回 412;读取与写入之间被其他请求修改时同样返回 412。
+    内容有变化时记录新版本,只修改元数据时不记录。
+    """
+    changes = request.model_dump(exclude_unset=True)
+    if "excalidraw_data" in changes and ("excalidraw_patch" in changes or "elements" in changes):
+        raise HTTPException(status_code=400, detail="excalidraw_data 不能与 excalidraw_patch / elements 同时提交")
+    for field in ("title", "tags", "is_public"):
+        if field in changes and changes[field] is None:
+            raise HTTPException(status_code=400, detail=f"{field} 不能为空")
+    
+    diagram = await _get_user_diagram(db, diagram_id, current_user)
+    if if_match is not None and not _revision_matches(if_match, diagram):
+        raise HTTPException(status_code=412, detail="图形已被修改,请刷新后重试")
+    
+    baseline = content_of(diagram)
+    excalidraw_data = changes.get("excalidraw_data", diagram.excalidraw_data)
+    try:
+        if request.excalidraw_patch:
+            excalidraw_data = apply_json_patch(excalidraw_data, request.excalidraw_patch)
+        if request.elements:
+            excalidraw_data = upsert_elements(excalidraw_data, request.elements)
+    except PatchError as e:
+        raise HTTPException(status_code=422, detail=f"补丁无法应用: {e}")
+    if excalidraw_data is not None and not isinstance(excalidraw_data, dict):
+        raise HTTPException(status_code=422, detail="excalidraw_data 必须是对象")
+    
+    # 只赋值有变化的字段,UPDATE 语句只包含这些列
+    for field in ("title", "description", "tags", "is_public", "mermaid_code"):
+        if field in changes and changes[field] != getattr(diagram, field):
+            setattr(diagram, field, changes[field])
+    if excalidraw_data != diagram.excalidraw_data:
+        diagram.excalidraw_data = excalidraw_data
+    
+    if content_of(diagram) != baseline:
+        description = request.change_description or ("自动保存" if autosave else "更新内容")
+        await _save_version(
+            db, diagram, current_user.id, description, baseline, background_tasks, autosave=autosave
+        )
+    elif db.is_modified(diagram):
+        await _commit_diagram(db, diagram)
+    
+    if request.svg_content:
+        background_tasks.add_task(generate_diagram_thumbnail, diagram.id, diagram.revision, request.svg_content)
+    
+    response.headers["ETag"] = _diagram_etag(diagram)
+    return diagram
+
+
+@app.post("/api/diagrams/{diagram_id}/refine", response_model=DiagramRefineResponse)
+async def refine_diagram(
+    diagram_id: int,
+    request: DiagramRefineRequest,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(check_ai_rate_limit)
+):
+    """按修改指令增量修改图形
+    
+    模型只返回补丁 (Mermaid 为行级编辑,Excalidraw 为 JSON Patch),在服务端校验并应用,
+    修改结果保存为新版本。AI 调用期间不占用数据库连接,期间图形被修改时返回 409。
+    """
+    conditions = (
         Diagram.id == diagram_id,
         Diagram.user_id == current_user.id,
         Diagram.is_deleted == False
-    ).first()
-    
+    )
+    diagram = await db.scalar(select(Diagram).where(*conditions))
     if not diagram:
         raise HTTPException(status_code=404, detail="图形不存在")
     
+    diagram_type = diagram.render_engine
+    mermaid_code = diagram.mermaid_code
+    excalidraw_data = diagram.excalidraw_data
+    if diagram_type == DiagramTypeEnum.MERMAID and not mermaid_code:
+        raise HTTPException(status_code=400, detail="图形没有可修改的 Mermaid 代码")
+    if diagram_type == DiagramTypeEnum.EXCALIDRAW and excalidraw_data is None:
+        raise HTTPException(status_code=400, detail="图形没有可修改的 Excalidraw 数据")
+    # 结束读事务以归还连接
+    await db.rollback()
+    
+    try:
+        content, patch = await ai_service.refine_diagram(
+            diagram_type,
+            request.instruction,
+            mermaid_code=mermaid_code,
+            excalidraw_data=excalidraw_data,
+            model=request.model
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI 修改失败: {str(e)}")
+    
+    diagram = await db.scalar(select(Diagram).where(*conditions))
+    if not diagram or diagram.mermaid_code != mermaid_code or diagram.excalidraw_data != excalidraw_data:
+        raise HTTPException(status_code=409, detail="图形已被修改,请刷新后重试")
+    
+    baseline = content_of(diagram)
+    if diagram_type == DiagramTypeEnum.MERMAID:
+        diagram.mermaid_code = content
+    else:
+        diagram.excalidraw_data = content
+    version_number = await _save_version(db, diagram, current_user.id, request.instruction, baseline, background_tasks)
+    
+    return {"diagram": diagram, "version_number": version_number, "patch": patch}
+
+
+async def _get_version_content(db: AsyncSession, diagram_id: int, version_number: int) -> dict:
+    content = await version_store.reconstruct(db, diagram_id, version_number)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"版本 {version_number} 不存在")
+    return content
+
+
+@app.get("/api/diagrams/{diagram_id}/versions", response_model=DiagramVersionListResponse)
+async def get_diagram_versions(
+    diagram_id: int,
+    before: Optional[int] = Query(None, ge=1, description="只返回小于该版本号的版本"),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取图形的版本列表 (按版本号倒序,只含元数据)"""
+    await _get_user_diagram(db, diagram_id, current_user)
+    
+    query = select(
+        DiagramVersion.version_number,
+        DiagramVersion.is_snapshot,
+        DiagramVersion.changed_by,
+        DiagramVersion.change_description,
+        DiagramVersion.created_at
+    ).where(DiagramVersion.diagram_id == diagram_id)
+    if before is not None:
+        query = query.where(DiagramVersion.version_number < before)
+    rows = (await db.execute(
+        query.order_by(DiagramVersion.version_number.desc()).limit(limit + 1)
+    )).all()
+    
+    next_before = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before = rows[-1].version_number
+    return {"items": rows, "next_before": next_before}
+
+
+@app.get("/api/diagrams/{diagram_id}/versions/{version_number}", response_model=DiagramVersionDetail)
+async def get_diagram_version(
+    diagram_id: int,
+    version_number: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取指定版本的完整内容 (由最近的快照与增量重建)"""
+    await _get_user_diagram(db, diagram_id, current_user)
+    content = await _get_version_content(db, diagram_id, version_number)
+    return {"version_number": version_number, **content}
+
+
+@app.get("/api/diagrams/{diagram_id}/versions/{version_number}/diff")
+async def get_diagram_version_diff(
+    diagram_id: int,
+    version_number: int,
+    base: Optional[int] = Query(None, ge=1, description="对比的版本号,默认为上一版本"),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """对比两个版本: Mermaid 代码返回统一 diff 文本,Excalidraw 数据返回 JSON Patch"""
+    await _get_user_diagram(db, diagram_id, current_user)
+    base = base if base is not None else version_number - 1
+    old = await _get_version_content(db, diagram_id, base)
+    new = await _get_version_content(db, diagram_id, version_number)
+    
+    return {
+        "base": base,
+        "version_number": version_number,
+        "mermaid_diff": unified_diff(
+            old["mermaid_code"], new["mermaid_code"], f"v{base}", f"v{version_number}"
+        ),
+        "excalidraw_patch": diff_json(old["excalidraw_data"], new["excalidraw_data"]),
+    }
+
+
+@app.post("/api/diagrams/{diagram_id}/versions/{version_number}/restore", response_model=DiagramRestoreResponse)
+async def restore_diagram_version(
+    diagram_id: int,
+    version_number: int,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """把图形恢复到指定版本的内容,恢复操作本身记录为新版本"""
+    diagram = await _get_user_diagram(db, diagram_id, current_user)
+    content = await _get_version_content(db, diagram_id, version_number)
+    
+    baseline = content_of(diagram)
+    diagram.mermaid_code = content["mermaid_code"]
+    diagram.excalidraw_data = content["excalidraw_data"]
+    new_version = await _save_version(
+        db, diagram, current_user.id, f"恢复到版本 {version_number}", baseline, background_tasks
+    )
+    
+    return {"diagram": diagram, "version_number": new_version}
+
+
+async def _convert_mermaid(code: str) -> dict:
+    try:
+        # 分层布局为 CPU 密集计算,在线程中执行
+        return await asyncio.to_thread(lambda: to_scene(mermaid_to_elements(code)))
+    except ConversionError as e:
+        raise HTTPException(status_code=422, detail=f"Mermaid 代码无法转换: {e}")
+
+
+@app.post("/api/convert/mermaid-to-excalidraw", response_model=MermaidConvertResponse)
+async def convert_mermaid_to_excalidraw(
+    request: MermaidConvertRequest,
+    current_user: User = Depends(get_current_active_user)
+):
+    """把 Mermaid 代码确定性转换为 Excalidraw 场景 (流程图、状态图、时序图),不调用模型"""
+    excalidraw_data = await _convert_mermaid(request.mermaid_code)
+    return {"chart_type": detect_chart_type(request.mermaid_code), "excalidraw_data": excalidraw_data}
+
+
+@app.post("/api/diagrams/{diagram_id}/convert", response_model=DiagramResponse)
+async def convert_diagram_to_excalidraw(
+    diagram_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    if_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """把图形保存的 Mermaid 代码转换为 Excalidraw 数据,并切换为 Excalidraw 渲染
+    
+    Mermaid 代码保持不变;Excalidraw 数据有变化时记录新版本。
+    """
+    diagram = await _get_user_diagram(db, diagram_id, current_user)
+    if if_match is not None and not _revision_matches(if_match, diagram):
+        raise HTTPException(status_code=412, detail="图形已被修改,请刷新后重试")
+    if not diagram.mermaid_code:
+        raise HTTPException(status_code=400, detail="图形没有可转换的 Mermaid 代码")
+    
+    excalidraw_data = await _convert_mermaid(diagram.mermaid_code)
+    baseline = content_of(diagram)
+    if excalidraw_data != diagram.excalidraw_data:
+        diagram.excalidraw_data = excalidraw_data
+    if diagram.render_engine != DiagramTypeEnum.EXCALIDRAW:
+        diagram.render_engine = DiagramTypeEnum.EXCALIDRAW
+    
+    if content_of(diagram) != baseline:
+        await _save_version(db, diagram, current_user.id, "从 Mermaid 转换", baseline, background_tasks)
+    elif db.is_modified(diagram):
+        await _commit_diagram(db, diagram)
+    
+    response.headers["ETag"] = _diagram_etag(diagram)
     return diagram
 
 
+def _cached_json(body, if_none_match: Optional[str]) -> Response:
+    """返回预先序列化的 JSON 响应体;If-None-Match 命中 ETag 时返回 304"""
+    if _etag_matches(if_none_match, body.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": body.etag})
+    return Response(content=body.body, media_type="application/json", headers={"ETag": body.etag})
+
+
+@app.get("/api/templates")
+async def get_templates(
+    category: Optional[str] = None,
+    featured: Optional[bool] = None,
+    q: Optional[str] = Query(None, max_length=100),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_active_user)
+):
+    """模板列表 (不包含模板内容),精选优先、按使用次数排序
+    
+    响应体在内存中预先序列化,ETag 为内容哈希;q 按名称/描述/分类搜索,可在输入提示词时直接推荐模板。
+    """
+    body = await template_catalog.listing(category, featured, q)
+    return _cached_json(body, if_none_match)
+
+
+@app.get("/api/templates/stats")
+async def get_template_stats(current_user: User = Depends(get_current_active_user)):
+    """模板目录与使用次数统计"""
+    return template_catalog.stats()
+
+
+@app.get("/api/templates/{template_id}")
+async def get_template(
+    template_id: int,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_active_user)
+):
+    """模板详情 (包含 Mermaid 代码 / Excalidraw 数据)"""
+    body = await template_catalog.detail(template_id)
+    if body is None:
+        raise HTTPException(status_code=404, detail="模板不存在")
+    return _cached_json(body, if_none_match)
+
+
+@app.post("/api/templates/{template_id}/instantiate", response_model=DiagramResponse, status_code=status.HTTP_201_CREATED)
+async def instantiate_template(
+    template_id: int,
+    request: Optional[TemplateInstantiateRequest] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """以模板内容创建新图形,使用次数异步累加"""
+    template = await template_catalog.get(template_id)
+    if template is None:
+        raise HTTPException(status_code=404, detail="模板不存在")
+    
+    excalidraw_data = template["excalidraw_data"]
+    if isinstance(excalidraw_data, list):
+        # 图形的 Excalidraw 数据为场景对象,模板中只保存了元素列表时补全
+        excalidraw_data = {"elements": excalidraw_data}
+    
+    new_diagram = Diagram(
+        user_id=current_user.id,
+        title=request.title if request and request.title else template["name"][:200],
+        diagram_type=DiagramTypeEnum(template["diagram_type"]),
+        render_engine=DiagramTypeEnum(template["render_engine"]),
+        mermaid_code=template["mermaid_code"],
+        excalidraw_data=excalidraw_data,
+        thumbnail_url=template["thumbnail_url"],
+        description=template["description"]
+    )
+    
+    db.add(new_diagram)
+    await db.commit()
+    await db.refresh(new_diagram)
+    
+    template_catalog.record_use(template_id)
+    return new_diagram
+
+
+async def _collab_access(db: AsyncSession, diagram_id: int, user: User) -> Optional[bool]:
+    """协作权限: 所有者及拥有编辑权限的用户/团队可编辑 (True),只有查看权限时只读 (False),无权限返回 None"""
+    owner_id = await db.scalar(
+        select(Diagram.user_id).where(Diagram.id == diagram_id, Diagram.is_deleted == False)
+    )
+    if owner_id is None:
+        return None
+    if owner_id == user.id:
+        return True
+    
+    team_ids = select(TeamMember.team_id).where(TeamMember.user_id == user.id)
+    permissions = (await db.scalars(
+        select(DiagramPermission.permission).where(
+            DiagramPermission.diagram_id == diagram_id,
+            or_(
+                and_(DiagramPermission.entity_type == EntityTypeEnum.USER, DiagramPermission.entity_id == user.id),
+                and_(DiagramPermission.entity_type == EntityTypeEnum.TEAM, DiagramPermission.entity_id.in_(team_ids))
+            )
+        )
+    )).all()
+    if not permissions:
+        return None
+    return PermissionEnum.EDIT in permissions
+
+
+@app.websocket("/api/diagrams/{diagram_id}/ws")
+async def diagram_collab(websocket: WebSocket, diagram_id: int, token: str = Query(...)):
+    """实时协作
+    
+    浏览器无法为 WebSocket 设置请求头,访问令牌通过 token 查询参数传递。
+    客户端消息: {"type": "elements", "elements": [...]} (Excalidraw)、
+    {"type": "text", "op_id": ..., "base": 序号, "edits": [[start, end, lines], ...]} (Mermaid)、
+    {"type": "cursor", "x": ..., "y": ..., "element_id": ...}。
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await authenticate_token(token, db)
+        except HTTPException:
+            await websocket.close(code=4401, reason="无法验证凭证")
+            return
+        if not user.is_active:
+            await websocket.close(code=4403, reason="用户已被禁用")
+            return
+        can_edit = await _collab_access(db, diagram_id, user)
+    if can_edit is None:
+        await websocket.close(code=4404, reason="图形不存在")
+        return
+    
+    await websocket.accept()
+    await collab_hub.serve(websocket, diagram_id, user, can_edit)
+
+
+@app.get("/api/collab/stats")
+async def get_collab_stats(current_user: User = Depends(get_current_active_user)):
+    """协作房间统计 (当前进程)"""
+    return collab_hub.stats()
+
+
 @app.delete("/api/diagrams/{diagram_id}")
 async def delete_diagram(
     diagram_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """删除图形"""
-    diagram = db.query(Diagram).filter(
-        Diagram.id == diagram_id,
-        Diagram.user_id == current_user.id
-    ).first()
+    diagram = await db.scalar(
+        select(Diagram).where(
+            Diagram.id == diagram_id,
+            Diagram.user_id == current_user.id
+        )
+    )
     
     if not diagram:
         raise HTTPException(status_code=404, detail="图形不存在")
     
     diagram.is_deleted = True
-    db.commit()
+    await db.commit()
     
     return {"success": True, "message": "图形已删除"}
 
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match 是否命中 ETag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+
 @app.post("/api/export")
 async def export_diagram(
     request: ExportRequest,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_active_user)
 ):
-    """导出图表为 SVG/PNG/PDF"""
-    try:
-        svg_content = request.svg_content
-        export_format = request.format.lower()
-        filename = request.filename or f"diagram.{export_format}"
-        
-        if export_format == 'svg':
-            svg_bytes = svg_content.encode('utf-8')
-            return StreamingResponse(
-                BytesIO(svg_bytes),
-                media_type="image/svg+xml",
-                headers={"Content-Disposition": f"attachment; filename={filename}"}
+    """导出图表为 SVG/PNG/PDF
+    
+    PNG/PDF 在服务端进程池中栅格化并以流的形式返回;
+    服务端未安装 cairosvg 时保持原有行为,由前端转换。
+    结果按 (svg_content, format, scale, dpi) 的哈希缓存在磁盘上,
+    哈希同时作为 ETag,客户端携带 If-None-Match 时可直接返回 304。
+    """
+    export_format = request.format.lower()
+    if export_format not in ('svg', 'png', 'pdf'):
+        raise HTTPException(status_code=400, detail="不支持的导出格式")
+    
+    if export_format != 'svg' and not export_service.rasterize_available:
+        return {"success": True, "message": f"请使用前端转换为 {export_format.upper()}"}
+    
+    cache_key = export_cache_key(request.svg_content, export_format, request.scale, request.dpi)
+    etag = f'"{cache_key}"'
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    filename = request.filename or f"diagram.{export_format}"
+    content = None
+    if export_format != 'svg':
+        content = await export_cache.get(cache_key, export_format)
+    
+    if content is None:
+        try:
+            content = await export_service.render(
+                request.svg_content, export_format, request.scale, request.dpi
             )
-        elif export_format == 'png':
-            # 返回 SVG,由前端使用 html2canvas 转换
-            return {"success": True, "message": "请使用前端转换为 PNG"}
-        elif export_format == 'pdf':
-            # 返回 SVG,由前端使用 jsPDF 转换
-            return {"success": True, "message": "请使用前端转换为 PDF"}
-        else:
-            raise HTTPException(status_code=400, detail="不支持的导出格式")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"导出失败: {str(e)}")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"导出失败: {str(e)}")
+        if export_format != 'svg':
+            await export_cache.put(cache_key, export_format, content)
+    
+    return export_service.stream(content, export_format, filename, etag=etag)
+
+
+@app.get("/api/export/cache/stats")
+async def get_export_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """导出缓存命中统计"""
+    return export_cache.stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,480 @@
+"""
+Mermaid → Excalidraw 转换 - 确定性解析 Mermaid 代码并布局,无需再次调用模型
+
+支持: graph/flowchart (分层自动布局), stateDiagram-v2 (分层自动布局), sequenceDiagram (参与者横排、消息纵排)。
+mermaid_to_elements 返回与 AI 输出相同结构的简化元素,to_scene 将其展开为可直接保存的 Excalidraw 场景。
+"""
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+from config import settings
+from layout import DIRECTIONS, layout_graph, node_size, text_size
+from mermaid_validator import (
+    FLOWCHART_DIRECTIVES,
+    FLOWCHART_SHAPES,
+    NODE_ID_RE,
+    SEQUENCE_PARTICIPANT_RE,
+    detect_chart_type,
+    find_shape_close,
+)
+
+CONVERTIBLE_CHART_TYPES = ("flowchart", "state", "sequence")
+
+# 流程图节点形状 -> Excalidraw 形状 (圆角、圆柱、平行四边形等按矩形处理)
+SHAPE_MAP = {
+    "(((": "ellipse", "((": "ellipse", "([": "ellipse",
+    "{{": "diamond", "{": "diamond",
+}
+# 连线: 带文字的写法 'A -- 文字 --> B' 与普通写法 'A -->|文字| B'
+FLOW_TEXT_LINK_RE = re.compile(
+    r"<?(?:--|==|-\.)\s+(?P<text>[^|]+?)\s+(?:-{2,}[>ox]|-{3,}|={2,}[>ox]|={3,}|\.-+[>ox]?)"
+)
+FLOW_LINK_RE = re.compile(r"<?(?:-{2,}|={2,}|-\.+-|~{3})[>ox]?")
+FLOW_LINK_LABEL_RE = re.compile(r"\s*\|(?P<label>[^|]*)\|")
+CLASS_SUFFIX_RE = re.compile(r":::[\w-]+")
+LINE_BREAK_RE = re.compile(r"<br\s*/?>", re.IGNORECASE)
+
+STATE_TRANSITION_RE = re.compile(r"^(?P<src>\S+)\s*-->\s*(?P<dst>[^:]+?)\s*(?::\s*(?P<label>.*))?$")
+STATE_ALIAS_RE = re.compile(r'^state\s+"(?P<label>[^"]*)"\s+as\s+(?P<id>[\w-]+)')
+STATE_DECL_RE = re.compile(r"^state\s+(?P<id>[\w-]+)\s*(?P<kind><<\w+>>)?\s*(?P<block>\{)?$")
+STATE_DESC_RE = re.compile(r"^(?P<id>[\w-]+)\s*:\s*(?P<label>.+)$")
+# 开始/结束伪状态的尺寸
+PSEUDO_STATE_SIZE = (30.0, 30.0)
+
+SEQUENCE_MESSAGE_RE = re.compile(
+    r"^(?P<src>[^\s:]+?)\s*(?P<arrow><<-->>|<<->>|-->>|->>|-->|->|--x|-x|--\)|-\))[+-]?\s*"
+    r"(?P<dst>[^\s:]+?)\s*(?::\s*(?P<text>.*))?$"
+)
+SEQUENCE_NOTE_RE = re.compile(r"^note\s+(?P<place>left of|right of|over)\s+(?P<targets>[^:]+?)\s*:\s*(?P<text>.*)$", re.IGNORECASE)
+SEQUENCE_ROW_HEIGHT = 50
+SEQUENCE_SELF_WIDTH = 40
+SEQUENCE_FONT_SIZE = 14
+NOTE_COLOR = "#fff5ad"
+# 写入场景文件的 source 字段
+SCENE_SOURCE = "genai-flow"
+
+
+class ConversionError(ValueError):
+    """Mermaid 代码无法转换"""
+
+
+def _statements(code: str) -> List[str]:
+    lines = []
+    for line in code.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith("%%"):
+            lines.append(stripped)
+    return lines
+
+
+def _clean_label(label: str) -> str:
+    label = label.strip()
+    if len(label) >= 2 and label[0] == label[-1] and label[0] in "\"'`":
+        label = label[1:-1]
+    return LINE_BREAK_RE.sub("\n", label).strip()
+
+
+# ===== 流程图 =====
+
+def _parse_flow_node(line: str, i: int, nodes: Dict[str, dict]) -> Tuple[Optional[str], int]:
+    match = NODE_ID_RE.match(line, i)
+    if not match:
+        return None, i
+    node_id = match.group()
+    i = match.end()
+    shape = next((s for s in FLOWCHART_SHAPES if line.startswith(s[0], i)), None)
+    node = nodes.setdefault(node_id, {"id": node_id, "label": node_id, "shape": "rectangle"})
+    if shape is not None:
+        close = find_shape_close(line, i + len(shape[0]), shape[1])
+        if close < 0:
+            raise ConversionError(f"节点 {node_id} 的标签括号未闭合")
+        node["label"] = _clean_label(line[i + len(shape[0]):close]) or node_id
+        node["shape"] = SHAPE_MAP.get(shape[0], "rectangle")
+        i = close + len(shape[1])
+    class_suffix = CLASS_SUFFIX_RE.match(line, i)
+    return node_id, class_suffix.end() if class_suffix else i
+
+
+def _parse_flow_statement(line: str, nodes: Dict[str, dict], edges: List[dict]):
+    """解析一条流程图语句: 节点组 (以 & 连接) 与连线交替出现,如 'A & B -->|是| C --> D'"""
+    previous: List[str] = []
+    label: Optional[str] = None
+    i = 0
+    while i < len(line):
+        group = []
+        while True:
+            while i < len(line) and line[i].isspace():
+                i += 1
+            node_id, i = _parse_flow_node(line, i, nodes)
+            if node_id is None:
+                return
+            group.append(node_id)
+            while i < len(line) and line[i].isspace():
+                i += 1
+            if not line.startswith("&", i):
+                break
+            i += 1
+
+        for source in previous:
+            for target in group:
+                edge = {"from": source, "to": target}
+                if label:
+                    edge["label"] = label
+                edges.append(edge)
+
+        match = FLOW_TEXT_LINK_RE.match(line, i)
+        if match:
+            label = _clean_label(match.group("text"))
+        else:
+            match = FLOW_LINK_RE.match(line, i)
+            if not match:
+                return
+            label = None
+        i = match.end()
+        pipe = FLOW_LINK_LABEL_RE.match(line, i)
+        if pipe:
+            label = _clean_label(pipe.group("label"))
+            i = pipe.end()
+        previous = group
+
+
+def _flowchart_elements(lines: List[str]) -> List[dict]:
+    header = lines[0].split()
+    direction = header[1].rstrip(";").upper() if len(header) > 1 else "TB"
+    direction = "TB" if direction == "TD" or direction not in DIRECTIONS else direction
+
+    nodes: Dict[str, dict] = {}
+    edges: List[dict] = []
+    for line in lines[1:]:
+        if line.startswith(FLOWCHART_DIRECTIVES) or line in ("end", "end;") or line.startswith("subgraph"):
+            continue
+        for statement in line.split(";"):
+            if statement.strip():
+                _parse_flow_statement(statement.strip(), nodes, edges)
+    if not nodes:
+        raise ConversionError("流程图没有任何节点")
+    return layout_graph(list(nodes.values()), edges, direction)
+
+
+# ===== 状态图 =====
+
+def _state_elements(lines: List[str]) -> List[dict]:
+    nodes: Dict[str, dict] = {}
+    edges: List[dict] = []
+    scopes: List[str] = [""]
+    direction = "TB"
+    in_note = False
+
+    def state(node_id: str, is_source: bool) -> str:
+        if node_id != "[*]":
+            return nodes.setdefault(node_id, {"id": node_id, "label": node_id, "shape": "rectangle"})["id"]
+        # 每个复合状态内的 [*] 是独立的开始/结束伪状态
+        pseudo = f"{scopes[-1]}[*]{'start' if is_source else 'end'}"
+        nodes.setdefault(pseudo, {"id": pseudo, "label": "", "shape": "ellipse", "size": PSEUDO_STATE_SIZE})
+        return pseudo
+
+    for line in lines[1:]:
+        if in_note:
+            in_note = not line.lower().startswith("end note")
+            continue
+        if line.lower().startswith("note "):
+            in_note = ":" not in line
+            continue
+        if line.startswith(("classDef ", "class ", "--", "hide ", "scale ")):
+            continue
+        if line.startswith("direction "):
+            value = line.split()[1].upper()
+            if value in DIRECTIONS:
+                direction = value
+            continue
+        if line == "}":
+            if len(scopes) > 1:
+                scopes.pop()
+            continue
+
+        match = STATE_ALIAS_RE.match(line)
+        if match:
+            state(match.group("id"), True)
+            nodes[match.group("id")]["label"] = _clean_label(match.group("label")) or match.group("id")
+            if line.endswith("{"):
+                scopes.append(match.group("id"))
+            continue
+        match = STATE_DECL_RE.match(line)
+        if match:
+            state(match.group("id"), True)
+            if match.group("kind") == "<<choice>>":
+                nodes[match.group("id")].update(shape="diamond", label="")
+            if match.group("block"):
+                scopes.append(match.group("id"))
+            continue
+        match = STATE_TRANSITION_RE.match(line)
+        if match:
+            edge = {"from": state(match.group("src"), True), "to": state(match.group("dst").strip(), False)}
+            if match.group("label"):
+                edge["label"] = _clean_label(match.group("label"))
+            edges.append(edge)
+            continue
+        match = STATE_DESC_RE.match(line)
+        if match:
+            state(match.group("id"), True)
+            nodes[match.group("id")]["label"] = _clean_label(match.group("label"))
+    if not nodes:
+        raise ConversionError("状态图没有任何状态")
+    return layout_graph(list(nodes.values()), edges, direction)
+
+
+# ===== 时序图 =====
+
+def _sequence_elements(lines: List[str]) -> List[dict]:
+    participants: Dict[str, str] = {}
+    messages: List[Tuple[str, str, str, bool]] = []
+    notes: List[Tuple[List[str], str, str]] = []
+    rows: List[Tuple[str, int]] = []
+
+    def participant(name: str) -> str:
+        participants.setdefault(name, name)
+        return name
+
+    for line in lines[1:]:
+        match = SEQUENCE_PARTICIPANT_RE.match(line)
+        if match:
+            participants[match.group(2)] = _clean_label(match.group(3) or match.group(2))
+            continue
+        match = SEQUENCE_NOTE_RE.match(line)
+        if match:
+            targets = [participant(name.strip()) for name in match.group("targets").split(",") if name.strip()]
+            rows.append(("note", len(notes)))
+            notes.append((targets, match.group("place").lower(), _clean_label(match.group("text"))))
+            continue
+        match = SEQUENCE_MESSAGE_RE.match(line)
+        if match:
+            rows.append(("message", len(messages)))
+            messages.append((
+                participant(match.group("src")),
+                participant(match.group("dst")),
+                _clean_label(match.group("text") or ""),
+                match.group("arrow").startswith("--") or "-->" in match.group("arrow"),
+            ))
+    if not participants:
+        raise ConversionError("时序图没有任何参与者")
+
+    names = list(participants)
+    sizes = [node_size(participants[name], "rectangle") for name in names]
+    column = {name: index for index, name in enumerate(names)}
+    # 参与者中心间距: 至少容纳两侧的方框,相邻参与者之间的消息文字也要放得下
+    gaps = [
+        (sizes[i][0] + sizes[i + 1][0]) / 2 + settings.LAYOUT_NODE_SPACING
+        for i in range(len(names) - 1)
+    ]
+    for source, target, text, _ in messages:
+        low, high = sorted((column[source], column[target]))
+        if high - low == 1:
+            gaps[low] = max(gaps[low], text_size(text, SEQUENCE_FONT_SIZE)[0] + settings.LAYOUT_NODE_SPACING)
+    centers = [sizes[0][0] / 2]
+    for gap in gaps:
+        centers.append(centers[-1] + gap)
+    header = max(height for _, height in sizes)
+
+    elements: List[dict] = []
+    for index, name in enumerate(names):
+        width, height = sizes[index]
+        elements.append({
+            "type": "rectangle",
+            "id": f"participant-{index}",
+            "x": round(centers[index] - width / 2),
+            "y": 0,
+            "width": int(width),
+            "height": int(header),
+            "label": participants[name],
+        })
+
+    y = header + SEQUENCE_ROW_HEIGHT
+    for kind, position in rows:
+        if kind == "message":
+            source, target, text, dashed = messages[position]
+            start, end = centers[column[source]], centers[column[target]]
+            arrow = {"type": "arrow", "id": f"message-{position}", "x": round(start), "y": round(y)}
+            if source == target:
+                arrow["points"] = [[0, 0], [SEQUENCE_SELF_WIDTH, 0], [SEQUENCE_SELF_WIDTH, 20], [0, 20]]
+                text_x = start + SEQUENCE_SELF_WIDTH + 6
+            else:
+                arrow["points"] = [[0, 0], [round(end - start), 0]]
+                text_x = (start + end) / 2 - text_size(text, SEQUENCE_FONT_SIZE)[0] / 2
+            if dashed:
+                arrow["strokeStyle"] = "dashed"
+            elements.append(arrow)
+            if text:
+                elements.append({
+                    "type": "text",
+                    "id": f"message-{position}-label",
+                    "x": round(text_x),
+                    "y": round(y - SEQUENCE_FONT_SIZE * 1.5),
+                    "text": text,
+                    "fontSize": SEQUENCE_FONT_SIZE,
+                })
+            y += SEQUENCE_ROW_HEIGHT + (20 if source == target else 0)
+        else:
+            targets, place, text = notes[position]
+            width, height = node_size(text, "rectangle")
+            spots = [centers[column[name]] for name in targets]
+            if place == "over":
+                width = max(width, max(spots) - min(spots) + width / 2)
+                left = (max(spots) + min(spots)) / 2 - width / 2
+            elif place == "left of":
+                left = min(spots) - width - 10
+            else:
+                left = max(spots) + 10
+            elements.append({
+                "type": "rectangle",
+                "id": f"note-{position}",
+                "x": round(left),
+                "y": round(y - SEQUENCE_ROW_HEIGHT / 2),
+                "width": int(width),
+                "height": int(height),
+                "label": text,
+                "backgroundColor": NOTE_COLOR,
+            })
+            y += height + SEQUENCE_ROW_HEIGHT / 2
+
+    # 生命线放在最前面,绘制在方框与消息下方
+    lifelines = [
+        {
+            "type": "line",
+            "id": f"lifeline-{index}",
+            "x": round(centers[index]),
+            "y": round(header),
+            "points": [[0, 0], [0, round(y - header)]],
+            "strokeStyle": "dashed",
+        }
+        for index in range(len(names))
+    ]
+    return lifelines + elements
+
+
+CONVERTERS = {
+    "flowchart": _flowchart_elements,
+    "state": _state_elements,
+    "sequence": _sequence_elements,
+}
+
+
+def mermaid_to_elements(code: str) -> List[dict]:
+    """解析 Mermaid 代码并布局,返回简化元素列表"""
+    chart_type = detect_chart_type(code or "")
+    if chart_type not in CONVERTERS:
+        raise ConversionError(f"不支持转换的图形类型: {chart_type or '未知'}")
+    return CONVERTERS[chart_type](_statements(code))
+
+
+# ===== Excalidraw 场景 =====
+
+def _seed(element_id: str) -> int:
+    # 由 id 确定随机种子,相同输入得到相同场景
+    return zlib.crc32(element_id.encode()) & 0x7fffffff
+
+
+def _base(element_id: str, kind: str, x: float, y: float, width: float, height: float, source: dict) -> dict:
+    return {
+        "id": element_id,
+        "type": kind,
+        "x": x,
+        "y": y,
+        "width": width,
+        "height": height,
+        "angle": 0,
+        "strokeColor": source.get("strokeColor", "#1e1e1e"),
+        "backgroundColor": source.get("backgroundColor", "transparent"),
+        "fillStyle": source.get("fillStyle", "solid"),
+        "strokeWidth": source.get("strokeWidth", 2),
+        "strokeStyle": source.get("strokeStyle", "solid"),
+        "roughness": source.get("roughness", 1),
+        "opacity": source.get("opacity", 100),
+        "groupIds": [],
+        "frameId": None,
+        "roundness": None,
+        "seed": _seed(element_id),
+        "version": 1,
+        "versionNonce": _seed(element_id + "#"),
+        "isDeleted": False,
+        "boundElements": None,
+        "updated": 1,
+        "link": None,
+        "locked": False,
+    }
+
+
+def _text(element_id: str, text: str, x: float, y: float, font_size: float, container: Optional[dict]) -> dict:
+    width, height = text_size(text, font_size)
+    element = _base(element_id, "text", x, y, width, height, {})
+    element.update({
+        "text": text,
+        "originalText": text,
+        "fontSize": font_size,
+        "fontFamily": 1,
+        "textAlign": "center" if container else "left",
+        "verticalAlign": "middle" if container else "top",
+        "containerId": container["id"] if container else None,
+        "lineHeight": 1.25,
+        "autoResize": True,
+    })
+    if container:
+        element["x"] = container["x"] + (container["width"] - width) / 2
+        element["y"] = container["y"] + (container["height"] - height) / 2
+        container["boundElements"] = (container["boundElements"] or []) + [{"type": "text", "id": element_id}]
+    return element
+
+
+def to_scene(elements: List[dict]) -> dict:
+    """把简化元素展开为完整的 Excalidraw 场景: 形状标签为绑定文本,连线按 startId / endId 绑定两端形状"""
+    scene: List[dict] = []
+    shapes: Dict[str, dict] = {}
+    for index, source in enumerate(elements):
+        element_id = source.get("id") or f"element-{index}"
+        kind = source["type"]
+        if kind == "text":
+            scene.append(_text(
+                element_id, source["text"], source["x"], source["y"], source.get("fontSize", 20), None
+            ))
+            continue
+
+        if kind in ("arrow", "line"):
+            if "points" in source:
+                x, y, points = source["x"], source["y"], source["points"]
+            else:
+                x, y = source["startX"], source["startY"]
+                points = [[0, 0], [source["endX"] - x, source["endY"] - y]]
+            xs, ys = [point[0] for point in points], [point[1] for point in points]
+            element = _base(element_id, kind, x, y, max(xs) - min(xs), max(ys) - min(ys), source)
+            element.update({
+                "points": points,
+                "lastCommittedPoint": None,
+                "startBinding": None,
+                "endBinding": None,
+                "startArrowhead": None,
+                "endArrowhead": "arrow" if kind == "arrow" else None,
+            })
+            if len(points) > 2 and kind == "arrow":
+                element["roundness"] = {"type": 2}
+            for field, binding in (("startId", "startBinding"), ("endId", "endBinding")):
+                shape = shapes.get(source.get(field))
+                if shape is not None:
+                    element[binding] = {"elementId": shape["id"], "focus": 0, "gap": 1}
+                    shape["boundElements"] = (shape["boundElements"] or []) + [{"type": "arrow", "id": element_id}]
+            scene.append(element)
+        else:
+            element = _base(element_id, kind, source["x"], source["y"], source["width"], source["height"], source)
+            if kind == "rectangle":
+                element["roundness"] = {"type": 3}
+            shapes[element_id] = element
+            scene.append(element)
+        if source.get("label"):
+            scene.append(_text(f"{element_id}-label", source["label"], 0, 0, 16, element))
+
+    return {
+        "type": "excalidraw",
+        "version": 2,
+        "source": SCENE_SOURCE,
+        "elements": scene,
+        "appState": {"viewBackgroundColor": "#ffffff", "gridSize": None},
+        "files": {},
+    }
@@ -0,0 +1,545 @@
+"""
+Mermaid 校验与自动修复 - 在返回 AI 输出前检查语法并修复常见违规
+
+支持: graph/flowchart, sequenceDiagram, classDiagram, stateDiagram-v2,
+erDiagram, gantt, pie, journey, architecture-beta
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+# chart_type -> 可接受的起始关键字 (第一个为缺失时补全使用的默认值)
+CHART_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "flowchart": ("graph TD", "graph", "flowchart"),
+    "sequence": ("sequenceDiagram",),
+    "class": ("classDiagram",),
+    "state": ("stateDiagram-v2", "stateDiagram"),
+    "er": ("erDiagram",),
+    "gantt": ("gantt",),
+    "pie": ("pie",),
+    "journey": ("journey",),
+    "architecture": ("architecture-beta",),
+}
+
+# 节点标签长度限制: 中文按 2 个字符计算,总宽度不超过 16 (即 8 个汉字)
+MAX_LABEL_WIDTH = 16
+
+# 标签中禁止出现的中文标点
+CJK_PUNCTUATION = "，、？：；！。“”‘’《》"
+
+# 标签中的括号补充说明,如 '展示订单确认页(订单号、金额)'
+BRACKETED_SUFFIX_RE = re.compile(r"[(（\[【{][^()（）\[\]【】{}]*[)）\]】}]")
+BRACKET_CHARS_RE = re.compile(r"[()（）\[\]【】{}]")
+
+# 流程图节点形状: 开始符号 -> 结束符号,长符号优先匹配
+FLOWCHART_SHAPES = (
+    ("(((", ")))"), ("((", "))"), ("([", "])"), ("[[", "]]"), ("[(", ")]"),
+    ("[/", "/]"), ("[\\", "\\]"), ("{{", "}}"), ("[", "]"), ("(", ")"),
+    ("{", "}"), (">", "]"),
+)
+FLOWCHART_DIRECTIVES = ("classDef ", "class ", "style ", "linkStyle ", "click ", "direction ")
+NODE_ID_RE = re.compile(r"\w+")
+
+SEQUENCE_MESSAGE_RE = re.compile(
+    r"^[^\s:]+?\s*(?:<<-->>|<<->>|-->>|->>|-->|->|--x|-x|--\)|-\))[+-]?\s*[^\s:]+?\s*(?::.*)?$"
+)
+SEQUENCE_PARTICIPANT_RE = re.compile(r"^(participant|actor)\s+(\S+)(?:\s+as\s+(.+))?$")
+SEQUENCE_KEYWORDS = {
+    "note", "Note", "loop", "alt", "else", "opt", "par", "and", "critical", "option",
+    "break", "rect", "end", "box", "activate", "deactivate", "autonumber", "title",
+    "create", "destroy", "links", "link",
+}
+
+ER_RELATION_RE = re.compile(
+    r"^(?P<left>[\w-]+)\s*(?P<rel>[|}o][|o](?:--|\.\.)[|o][|{o])\s*(?P<right>[\w-]+)\s*:\s*(?P<label>.+)$"
+)
+ER_ENTITY_RE = re.compile(r"^[\w-]+(?:\[[^\]]*\])?\s*(?P<block>\{)?$")
+
+GANTT_KEYWORDS = (
+    "title", "dateFormat", "axisFormat", "tickInterval", "excludes", "includes",
+    "todayMarker", "section", "weekday", "displayMode", "inclusiveEndDates",
+)
+
+PIE_ITEM_RE = re.compile(r'^(?P<label>"[^"]*"|[^:"]+?)\s*:\s*"?(?P<value>[-+]?\d+(?:\.\d+)?)"?$')
+
+JOURNEY_TASK_RE = re.compile(r"^(?P<name>[^:]+):\s*(?P<score>[-+]?\d+(?:\.\d+)?)\s*(?::(?P<actors>.*))?$")
+
+ARCH_DECL_RE = re.compile(
+    r"^(?P<kind>group|service)\s+(?P<id>[\w-]+)\s*(?:\((?P<icon>[^)]*)\))?\s*"
+    r"(?:\[(?P<title>.*)\])?\s*(?:in\s+(?P<parent>[\w-]+))?$"
+)
+ARCH_JUNCTION_RE = re.compile(r"^junction\s+(?P<id>[\w-]+)(?:\s+in\s+(?P<parent>[\w-]+))?$")
+ARCH_EDGE_RE = re.compile(
+    r"^(?P<src>[\w-]+?)(?P<src_group>\{group\})?\s*:\s*(?P<src_dir>[LRTB])\s*"
+    r"(?P<arrow><?-->?)\s*"
+    r"(?P<dst_dir>[LRTB])\s*:\s*(?P<dst>[\w-]+?)(?P<dst_group>\{group\})?$"
+)
+
+
+class ValidationResult:
+    """校验结果"""
+
+    def __init__(self, code: str, errors: List[str], fixes: List[str], warnings: List[str]):
+        self.code = code
+        self.errors = errors
+        self.fixes = fixes
+        self.warnings = warnings
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+    @property
+    def repaired(self) -> bool:
+        return bool(self.fixes)
+
+
+def label_width(text: str) -> int:
+    """标签宽度: 中日韩字符按 2 计算"""
+    return sum(2 if _is_wide(ch) else 1 for ch in text)
+
+
+def _is_wide(ch: str) -> bool:
+    return "⺀" <= ch <= "鿿" or "豈" <= ch <= "﫿" or "＀" <= ch <= "￯"
+
+
+def repair_label(label: str, max_width: Optional[int] = MAX_LABEL_WIDTH) -> str:
+    """按提示词规则修复标签: 去除括号说明与中文标点,并截断过长内容"""
+    quoted = len(label) >= 2 and label[0] == '"' and label[-1] == '"'
+    text = label[1:-1] if quoted else label
+
+    previous = None
+    while previous != text:
+        previous = text
+        text = BRACKETED_SUFFIX_RE.sub("", text)
+    text = BRACKET_CHARS_RE.sub("", text)
+    text = text.translate({ord(ch): None for ch in CJK_PUNCTUATION})
+    text = " ".join(text.split())
+
+    if max_width is not None and label_width(text) > max_width:
+        width = 0
+        for index, ch in enumerate(text):
+            width += 2 if _is_wide(ch) else 1
+            if width > max_width:
+                text = text[:index].rstrip()
+                break
+
+    if not text:
+        # 全部内容都是补充说明时保留原文,交由校验报告
+        return label
+    return f'"{text}"' if quoted else text
+
+
+def detect_chart_type(code: str) -> Optional[str]:
+    """根据起始关键字识别图形类型"""
+    header = _first_statement(code.splitlines())
+    if header is None:
+        return None
+    return _chart_type_of(header[1])
+
+
+def _chart_type_of(line: str) -> Optional[str]:
+    word = line.split()[0] if line.split() else ""
+    for chart_type, keywords in CHART_KEYWORDS.items():
+        if any(word == keyword.split()[0] for keyword in keywords):
+            return chart_type
+    return None
+
+
+def _first_statement(lines: List[str]) -> Optional[Tuple[int, str]]:
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and not stripped.startswith("%%"):
+            return index, stripped
+    return None
+
+
+def validate_mermaid(code: str, chart_type: Optional[str] = "flowchart") -> ValidationResult:
+    """校验并修复 Mermaid 代码
+
+    可确定性修复的问题直接修复并记录到 fixes,无法修复的问题记录到 errors
+    """
+    errors: List[str] = []
+    fixes: List[str] = []
+    warnings: List[str] = []
+    lines = code.strip().splitlines()
+
+    # 定位起始关键字,去除其前面的说明文字
+    header_index = next(
+        (i for i, line in enumerate(lines) if _chart_type_of(line.strip()) is not None),
+        None
+    )
+    if header_index is None:
+        if chart_type not in CHART_KEYWORDS:
+            return ValidationResult(code, errors, fixes, ["未识别的图形类型,跳过校验"])
+        lines.insert(0, CHART_KEYWORDS[chart_type][0])
+        header_index = 0
+        fixes.append(f"补充起始关键字 {CHART_KEYWORDS[chart_type][0]}")
+    elif any(line.strip() and not line.strip().startswith("%%") for line in lines[:header_index]):
+        fixes.append("移除起始关键字前的多余文本")
+    lines = lines[header_index:]
+
+    detected = _chart_type_of(lines[0].strip())
+    if chart_type in CHART_KEYWORDS and detected != chart_type:
+        errors.append(f"图形类型不符: 期望 {CHART_KEYWORDS[chart_type][0]},实际为 {lines[0].strip()}")
+
+    validator = VALIDATORS.get(detected)
+    if validator is not None:
+        lines = validator(lines, errors, fixes, warnings)
+
+    return ValidationResult("\n".join(lines), errors, fixes, warnings)
+
+
+def _check_braces(lines: List[str], errors: List[str]):
+    depth = 0
+    for line in lines:
+        depth += line.count("{") - line.count("}")
+        if depth < 0:
+            break
+    if depth != 0:
+        errors.append("花括号 {} 不匹配")
+
+
+# ===== 各图形类型的校验器 =====
+
+def _validate_flowchart(lines: List[str], errors, fixes, warnings) -> List[str]:
+    header = lines[0].split()
+    if len(header) < 2 or header[1].rstrip(";") not in ("TD", "TB", "LR", "RL", "BT"):
+        lines[0] = f"{header[0]} TD"
+        fixes.append("补充流程图方向 TD")
+
+    result = [lines[0]]
+    statements = 0
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%") or stripped.startswith(FLOWCHART_DIRECTIVES) or stripped == "end":
+            result.append(line)
+            continue
+        repaired, error = _repair_flowchart_line(line)
+        if error:
+            errors.append(f"第{number}行: {error}")
+        elif repaired != line:
+            fixes.append(f"第{number}行: 修复节点标签")
+        statements += 1
+        result.append(repaired)
+
+    if statements == 0:
+        errors.append("流程图没有任何节点")
+    return result
+
+
+def _repair_flowchart_line(line: str) -> Tuple[str, Optional[str]]:
+    """逐字符扫描一行流程图,修复节点标签与连线标签"""
+    out = []
+    i = 0
+    length = len(line)
+    while i < length:
+        ch = line[i]
+        if ch == "|":
+            end = line.find("|", i + 1)
+            if end < 0:
+                return line, "连线标签 | 未闭合"
+            out.append("|" + repair_label(line[i + 1:end].strip()) + "|")
+            i = end + 1
+            continue
+
+        match = NODE_ID_RE.match(line, i)
+        if match and (i == 0 or not (line[i - 1].isalnum() or line[i - 1] == "_")):
+            end_of_id = match.end()
+            shape = next((s for s in FLOWCHART_SHAPES if line.startswith(s[0], end_of_id)), None)
+            if shape is not None:
+                close = find_shape_close(line, end_of_id + len(shape[0]), shape[1])
+                if close < 0:
+                    return line, f"节点 {match.group()} 的标签括号未闭合"
+                label = line[end_of_id + len(shape[0]):close].strip()
+                out.append(match.group() + shape[0] + repair_label(label) + shape[1])
+                i = close + len(shape[1])
+                continue
+            out.append(match.group())
+            i = end_of_id
+            continue
+
+        out.append(ch)
+        i += 1
+    return "".join(out), None
+
+
+def find_shape_close(line: str, start: int, close: str) -> int:
+    """查找节点形状的结束符号,跳过标签中嵌套的括号与引号"""
+    depth = 0
+    i = start
+    while i < len(line):
+        ch = line[i]
+        if ch == '"':
+            end = line.find('"', i + 1)
+            if end < 0:
+                return -1
+            i = end + 1
+            continue
+        if depth == 0 and line.startswith(close, i):
+            return i
+        if ch in "([{（【":
+            depth += 1
+        elif ch in ")]}）】" and depth > 0:
+            depth -= 1
+        i += 1
+    return -1
+
+
+def _validate_sequence(lines: List[str], errors, fixes, warnings) -> List[str]:
+    result = [lines[0]]
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%") or stripped.split()[0] in SEQUENCE_KEYWORDS:
+            result.append(line)
+            continue
+        participant = SEQUENCE_PARTICIPANT_RE.match(stripped)
+        if participant:
+            if participant.group(3):
+                alias = repair_label(participant.group(3), max_width=None)
+                if alias != participant.group(3):
+                    fixes.append(f"第{number}行: 修复参与者名称")
+                    line = line[:len(line) - len(line.lstrip())] + f"{participant.group(1)} {participant.group(2)} as {alias}"
+            result.append(line)
+            continue
+        if not SEQUENCE_MESSAGE_RE.match(stripped):
+            errors.append(f"第{number}行: 无法识别的时序图语句")
+        result.append(line)
+    return result
+
+
+def _validate_class(lines: List[str], errors, fixes, warnings) -> List[str]:
+    _check_braces(lines, errors)
+    return lines
+
+
+def _validate_state(lines: List[str], errors, fixes, warnings) -> List[str]:
+    _check_braces(lines, errors)
+    result = [lines[0]]
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        # 转换标签 / 状态描述: 'A --> B : 标签' 或 'A : 描述'
+        if ":" in stripped and not stripped.startswith(("note", "%%", "state ")):
+            head, _, label = line.rpartition(":")
+            repaired = repair_label(label.strip())
+            if repaired != label.strip():
+                fixes.append(f"第{number}行: 修复状态标签")
+                line = f"{head.rstrip()} : {repaired}"
+        result.append(line)
+    return result
+
+
+def _validate_er(lines: List[str], errors, fixes, warnings) -> List[str]:
+    # 关系符号 (如 ||--o{) 本身包含花括号,因此按实体块单独跟踪而非整体计数
+    result = [lines[0]]
+    in_entity = False
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%"):
+            result.append(line)
+            continue
+        if in_entity:
+            if stripped == "}":
+                in_entity = False
+            result.append(line)
+            continue
+        entity = ER_ENTITY_RE.match(stripped)
+        if entity:
+            in_entity = entity.group("block") is not None
+            result.append(line)
+            continue
+        relation = ER_RELATION_RE.match(stripped)
+        if relation is None:
+            errors.append(f"第{number}行: 无法识别的 ER 图语句")
+            result.append(line)
+            continue
+        label = relation.group("label").strip()
+        repaired = repair_label(label, max_width=None)
+        if " " in repaired and not repaired.startswith('"'):
+            repaired = f'"{repaired}"'
+        if repaired != label:
+            fixes.append(f"第{number}行: 修复关系标签")
+            indent = line[:len(line) - len(line.lstrip())]
+            line = f"{indent}{relation.group('left')} {relation.group('rel')} {relation.group('right')} : {repaired}"
+        result.append(line)
+    if in_entity:
+        errors.append("实体属性块缺少结束的 '}'")
+    return result
+
+
+def _validate_gantt(lines: List[str], errors, fixes, warnings) -> List[str]:
+    result = [lines[0]]
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%") or stripped.split()[0] in GANTT_KEYWORDS:
+            result.append(line)
+            continue
+        if ":" not in stripped:
+            errors.append(f"第{number}行: 甘特图任务缺少 ':'")
+            result.append(line)
+            continue
+        name, _, spec = line.partition(":")
+        repaired = repair_label(name.strip(), max_width=None)
+        if repaired != name.strip():
+            fixes.append(f"第{number}行: 修复任务名称")
+            indent = line[:len(line) - len(line.lstrip())]
+            line = f"{indent}{repaired} :{spec}"
+        result.append(line)
+    return result
+
+
+def _validate_pie(lines: List[str], errors, fixes, warnings) -> List[str]:
+    result = [lines[0]]
+    items = 0
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("%%", "title", "showData")):
+            result.append(line)
+            continue
+        item = PIE_ITEM_RE.match(stripped)
+        if item is None:
+            errors.append(f"第{number}行: 无法识别的饼图数据")
+            result.append(line)
+            continue
+        items += 1
+        label = item.group("label").strip()
+        if not label.startswith('"'):
+            label = f'"{label}"'
+        if float(item.group("value")) < 0:
+            errors.append(f"第{number}行: 饼图数值不能为负数")
+        fixed = f"{label} : {item.group('value')}"
+        if fixed != stripped:
+            fixes.append(f"第{number}行: 规范饼图数据格式")
+        result.append("    " + fixed)
+    if items == 0:
+        errors.append("饼图没有任何数据")
+    return result
+
+
+def _validate_journey(lines: List[str], errors, fixes, warnings) -> List[str]:
+    result = [lines[0]]
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("%%", "title", "section")):
+            result.append(line)
+            continue
+        task = JOURNEY_TASK_RE.match(stripped)
+        if task is None:
+            errors.append(f"第{number}行: 旅程图任务格式应为 '任务: 分数: 参与者'")
+            result.append(line)
+            continue
+        score = int(round(float(task.group("score"))))
+        clamped = min(5, max(1, score))
+        if str(clamped) != task.group("score"):
+            fixes.append(f"第{number}行: 旅程图分数修正为 {clamped}")
+        indent = line[:len(line) - len(line.lstrip())]
+        actors = f": {task.group('actors').strip()}" if task.group("actors") else ""
+        result.append(f"{indent}{task.group('name').strip()}: {clamped}{actors}")
+    return result
+
+
+def _validate_architecture(lines: List[str], errors, fixes, warnings) -> List[str]:
+    groups: Dict[str, Optional[str]] = {}
+    services: Dict[str, Optional[str]] = {}
+    junctions = set()
+    parsed: List[Tuple[int, str, Optional[re.Match]]] = []
+
+    def normalize_id(identifier: str) -> str:
+        return identifier.replace("-", "_")
+
+    # 第一遍: 收集声明
+    for number, line in enumerate(lines[1:], start=2):
+        stripped = line.strip()
+        if (match := ARCH_DECL_RE.match(stripped)):
+            target = groups if match.group("kind") == "group" else services
+            target[normalize_id(match.group("id"))] = (
+                normalize_id(match.group("parent")) if match.group("parent") else None
+            )
+            parsed.append((number, "decl", match))
+        elif (match := ARCH_JUNCTION_RE.match(stripped)):
+            junctions.add(normalize_id(match.group("id")))
+            parsed.append((number, "junction", match))
+        elif (match := ARCH_EDGE_RE.match(stripped)):
+            parsed.append((number, "edge", match))
+        elif not stripped or stripped.startswith("%%"):
+            parsed.append((number, "raw", None))
+        else:
+            errors.append(f"第{number}行: 无法识别的架构图语句")
+            parsed.append((number, "raw", None))
+
+    def first_service_in(group_id: str) -> Optional[str]:
+        for service_id, parent in services.items():
+            current = parent
+            while current is not None:
+                if current == group_id:
+                    return service_id
+                current = groups.get(current)
+        return None
+
+    # 第二遍: 规范化并修复
+    result = [lines[0]]
+    for (number, kind, match), line in zip(parsed, lines[1:]):
+        indent = line[:len(line) - len(line.lstrip())] or "    "
+        if kind == "decl":
+            identifier = normalize_id(match.group("id"))
+            if identifier != match.group("id"):
+                fixes.append(f"第{number}行: ID {match.group('id')} 中的 '-' 替换为 '_'")
+            title = match.group("title")
+            if title is not None:
+                repaired = repair_label(title, max_width=None)
+                if repaired != title:
+                    fixes.append(f"第{number}行: 修复显示名称")
+                    title = repaired
+                if any(_is_wide(ch) for ch in title):
+                    warnings.append(f"第{number}行: 显示名称包含中文")
+            statement = f"{match.group('kind')} {identifier}"
+            if match.group("icon") is not None:
+                statement += f"({match.group('icon')})"
+            if title is not None:
+                statement += f"[{title}]"
+            if match.group("parent"):
+                statement += f" in {normalize_id(match.group('parent'))}"
+            result.append(indent + statement)
+        elif kind == "edge":
+            endpoints = []
+            for side in ("src", "dst"):
+                identifier = normalize_id(match.group(side))
+                if identifier in groups and identifier not in services and identifier not in junctions:
+                    replacement = first_service_in(identifier)
+                    if replacement is None:
+                        identifier = None
+                    else:
+                        fixes.append(f"第{number}行: 连线端点 {identifier} 是分组,改为其中的服务 {replacement}")
+                        identifier = replacement
+                elif identifier not in services and identifier not in junctions:
+                    errors.append(f"第{number}行: 连线端点 {identifier} 未声明")
+                endpoints.append(identifier)
+            if None in endpoints or endpoints[0] == endpoints[1]:
+                fixes.append(f"第{number}行: 移除无法修复的分组连线")
+                continue
+            src_group = match.group("src_group") or ""
+            dst_group = match.group("dst_group") or ""
+            result.append(
+                f"{indent}{endpoints[0]}{src_group}:{match.group('src_dir')} "
+                f"{match.group('arrow')} {match.group('dst_dir')}:{endpoints[1]}{dst_group}"
+            )
+        elif kind == "junction":
+            statement = f"junction {normalize_id(match.group('id'))}"
+            if match.group("parent"):
+                statement += f" in {normalize_id(match.group('parent'))}"
+            result.append(indent + statement)
+        else:
+            result.append(line)
+    return result
+
+
+VALIDATORS = {
+    "flowchart": _validate_flowchart,
+    "sequence": _validate_sequence,
+    "class": _validate_class,
+    "state": _validate_state,
+    "er": _validate_er,
+    "gantt": _validate_gantt,
+    "pie": _validate_pie,
+    "journey": _validate_journey,
+    "architecture": _validate_architecture,
+}
@@ -0,0 +1,57 @@
+"""
+数据库迁移 - 部署时在启动服务之前运行一次: python migrate.py
+
+建表、为已存在的表补建列与索引、回填旧数据。应用导入时不执行任何 DDL,
+多个 worker 同时启动时不会并发修改表结构或重复执行全表回填。
+各步骤均可重复执行,已是最新结构时不做修改。
+"""
+import logging
+from sqlalchemy import inspect, text, update
+from database import Base, engine
+from models import Diagram, DiagramVersion
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(table):
+    """create_all 不会为已存在的表补建列,按模型定义补充 (新列均可为空或带有服务端默认值)"""
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+            if column.server_default is not None:
+                default = column.server_default.arg
+                default = f"'{default}'" if isinstance(default, str) else default.compile(dialect=engine.dialect)
+                ddl += f" DEFAULT {default}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+            conn.execute(text(ddl))
+            logger.info("已补建列 %s.%s", table.name, column.name)
+
+
+def migrate():
+    """把数据库结构升级到当前模型定义"""
+    # 创建数据库表
+    Base.metadata.create_all(bind=engine)
+
+    # 旧版本记录均为完整内容,补建的 is_snapshot 默认为真;旧图形的 revision 从 1 开始
+    add_missing_columns(Diagram.__table__)
+    add_missing_columns(DiagramVersion.__table__)
+
+    # create_all 不会为已存在的表补建索引;旧数据的 updated_at 为空,按 created_at 回填以支持游标分页
+    for index in (*Diagram.__table__.indexes, *DiagramVersion.__table__.indexes):
+        index.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(Diagram).where(Diagram.updated_at.is_(None)).values(updated_at=Diagram.created_at)
+        )
+        if result.rowcount:
+            logger.info("已回填 %s 个图形的 updated_at", result.rowcount)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    migrate()
+    logger.info("数据库迁移完成")
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Enum, JSON
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Enum, JSON, Index
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.sql import func, true
 from sqlalchemy.orm import relationship
 from database import Base
 import enum
@@ -26,6 +27,12 @@ class EntityTypeEnum(str, enum.Enum):
     TEAM = "team"
 
 
+# SQLite 的 CURRENT_TIMESTAMP 不含微秒,绑定参数需使用相同的存储格式才能正确比较 (游标分页)
+SQLITE_SECOND_DATETIME = sqlite.DATETIME(
+    storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"
+)
+
+
 class User(Base):
     __tablename__ = "users"
     
@@ -46,6 +53,10 @@ class User(Base):
 
 class Diagram(Base):
     __tablename__ = "diagrams"
+    __table_args__ = (
+        # 图形列表按 (updated_at, id) 游标分页
+        Index("ix_diagrams_user_list", "user_id", "is_deleted", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
@@ -60,9 +71,17 @@ class Diagram(Base):
     tags = Column(JSON, nullable=True)
     is_public = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    updated_at = Column(
+        DateTime(timezone=True).with_variant(SQLITE_SECOND_DATETIME, "sqlite"),
+        server_default=func.now(),
+        onupdate=func.now()
+    )
     is_deleted = Column(Boolean, default=False)
     deleted_at = Column(DateTime(timezone=True), nullable=True)
+    # 每次通过 ORM 更新时递增,UPDATE 语句带上原值作为条件 (乐观并发控制,即 ETag)
+    revision = Column(Integer, nullable=False, server_default="1")
+    
+    __mapper_args__ = {"version_id_col": revision}
     
     # 关系
     owner = relationship("User", back_populates="diagrams")
@@ -115,12 +134,19 @@ class DiagramPermission(Base):
 
 class DiagramVersion(Base):
     __tablename__ = "diagram_versions"
+    __table_args__ = (
+        # 同一图形的版本号唯一,并发保存同一版本时后提交者失败
+        Index("ix_diagram_versions_number", "diagram_id", "version_number", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     diagram_id = Column(Integer, ForeignKey("diagrams.id"), nullable=False, index=True)
     version_number = Column(Integer, nullable=False)
+    # 快照版本保存完整内容;增量版本内容列为空,delta 为相对上一版本的差异
+    is_snapshot = Column(Boolean, nullable=False, default=True, server_default=true())
     mermaid_code = Column(Text, nullable=True)
     excalidraw_data = Column(JSON, nullable=True)
+    delta = Column(JSON, nullable=True)
     changed_by = Column(Integer, ForeignKey("users.id"), nullable=False)
     change_description = Column(String(500), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
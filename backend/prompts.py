@@ -0,0 +1,245 @@
+"""
+提示词组装 - 按图形类型只拼接相关规则,并估算 token 数以确定输出上限
+"""
+import re
+from functools import lru_cache
+from typing import Dict, Tuple
+from config import Settings, settings
+from models import DiagramTypeEnum
+
+# 通用部分放在最前面,同一图形类型的系统提示词完全一致,便于提供商做前缀缓存
+MERMAID_BASE = """你是一个专业的技术图形生成专家和业务流程分析师。
+你的任务是深入分析用户需求,充分思考业务逻辑,生成详细完整的 Mermaid.js 图形。
+
+生成规则:
+1. 只返回纯 Mermaid 代码,不要包含 markdown 代码块标记
+2. 确保语法严格遵循 Mermaid 标准
+3. 不要添加任何解释说明"""
+
+ANALYSIS_RULES = """核心要求:
+1. 深入分析: 仔细分析用户描述的场景,挖掘所有可能的业务分支、异常处理、边界情况
+2. 完整性: 确保图形包含所有关键步骤和关键元素
+3. 详细性: 不要过度简化,每个重要环节都要体现
+4. 专业性: 遵循行业最佳实践,考虑实际业务场景"""
+
+LABEL_RULES = """【重要】标签规则:
+- 使用中文标签,但文本必须简洁,避免使用特殊符号
+- 标签中禁止使用中文标点符号(逗号、顿号、问号、冒号等)
+- 标签中禁止使用括号()、中括号[]、花括号{}等特殊字符,也不要用括号补充说明
+- 中文标签严格不超过8个汉字,英文标签严格不超过16个字符,中文算2个字符
+- 如果描述过长,使用更简短的同义词或缩写;如需表达复杂信息,拆分为多个元素"""
+
+FLOWCHART_DETAIL = """详细化指导:
+- 必须包含开始、所有处理步骤、所有判断分支(成功/失败)、异常处理、结束节点
+- 对于注册登录场景: 必须包含输入验证、数据校验、成功路径、失败路径、异常处理等
+- 对于业务流程: 必须包含正常流程、异常流程、边界情况、回退机制
+- 使用判断节点({})表示条件分支,清晰标注各分支条件
+- 判断节点文本必须简洁明了,如'是否通过验证'而非'是否满足条件?(库存,限购,账户状态)'
+
+示例思考方式:
+用户说'用户登录流程',你应该思考:
+- 登录入口在哪?需要输入什么信息?如何验证输入格式和用户凭证?
+- 登录成功后做什么?
+- 登录失败有哪些情况?(密码错误、账号不存在、账号被锁定等)
+- 是否需要验证码?是否有记住登录功能?异常情况如何处理?"""
+
+ARCHITECTURE_RULES = """【关键规则】:
+1. 必须以 'architecture-beta' 开头
+2. 使用 group 定义分组: group groupId(icon)[DisplayName]
+3. 使用 service 定义服务: service serviceId(icon)[DisplayName] in groupId
+   - 'in groupId' 指定服务所属分组
+4. 使用连接符定义关系,**只能在 service 之间建立连接,不能连接到 group**:
+   - serviceA:L -- R:serviceB  (左到右)
+   - serviceA:T -- B:serviceB  (上到下)
+   - L=Left, R=Right, T=Top, B=Bottom
+5. 常用图标: cloud, server, disk, database, internet, users
+6. 所有 ID 必须是单个单词(使用下划线连接,不含空格和中划线)
+7. **显示名称必须使用英文,不要使用中文** (例如: [Web Server] 而不是 [Web应用])
+
+示例:
+architecture-beta
+    group aws(cloud)[AWS Cloud]
+
+    service elb(internet)[Load Balancer] in aws
+    service ec2_1(server)[Web Server 1] in aws
+    service api(server)[API Gateway] in aws
+    service rds(database)[MySQL Database] in aws
+
+    elb:B -- T:ec2_1
+    ec2_1:R -- L:api
+    api:B -- T:rds"""
+
+# 各图形类型: (显示名, 起始关键字, 类型专属语法提示)
+CHART_SPECS: Dict[str, Tuple[str, str, str]] = {
+    "flowchart": ("流程图", "graph TD", "也可以使用 'graph LR' 表示从左到右的布局。"),
+    "sequence": ("时序图", "sequenceDiagram", "先用 participant 声明参与者,消息使用 ->> 或 -->> 表示,可使用 alt/opt/loop 块表达分支与循环。"),
+    "class": ("类图", "classDiagram", "类成员写在 class 名称后的花括号中,关系使用 <|-- *-- o-- --> 等符号。"),
+    "state": ("状态图", "stateDiagram-v2", "使用 [*] 表示开始与结束状态,转换写作 状态A --> 状态B : 事件。"),
+    "er": ("ER图", "erDiagram", "实体属性写在花括号中,每行 '类型 名称',关系使用 ||--o{ 等基数符号并附带关系标签。"),
+    "gantt": ("甘特图", "gantt", "先写 dateFormat YYYY-MM-DD 与 title,使用 section 分组,任务格式为 任务名 :id, 开始日期, 持续时间。"),
+    "pie": ("饼图", "pie", "可选 title,每行一个扇区,格式为 \"标签\" : 数值,标签简短。"),
+    "journey": ("旅程图", "journey", "先写 title,使用 section 划分阶段,任务格式为 任务名: 分数1-5: 参与者。"),
+    "architecture": ("架构图", "architecture-beta", ""),
+}
+
+# 各图形类型需要的通用规则
+CHART_SECTIONS: Dict[str, Tuple[str, ...]] = {
+    "flowchart": (ANALYSIS_RULES, LABEL_RULES, FLOWCHART_DETAIL),
+    "sequence": (ANALYSIS_RULES, LABEL_RULES),
+    "class": (ANALYSIS_RULES, LABEL_RULES),
+    "state": (ANALYSIS_RULES, LABEL_RULES),
+    "er": (ANALYSIS_RULES, LABEL_RULES),
+    "gantt": (LABEL_RULES,),
+    "pie": (),
+    "journey": (LABEL_RULES,),
+    "architecture": (ANALYSIS_RULES, ARCHITECTURE_RULES),
+}
+
+# Excalidraw 自动布局模式: 模型只输出节点与连线,坐标由 layout.py 计算
+EXCALIDRAW_TOPOLOGY_BASE = """你是一个专业的图形设计专家。
+你的任务是把用户需求整理为图形的节点与连线,元素坐标与连线路径由系统自动布局。
+
+输出格式: 一个严格有效的 JSON 数组,每个对象是以下三种之一:
+- 布局方向 (可选,放在最前面): {"direction": "TB"}  TB 为从上到下, LR 为从左到右
+- 节点: {"id": "a", "label": "文本", "shape": "rectangle"}  shape 为 rectangle / ellipse / diamond,默认 rectangle
+- 连线: {"from": "a", "to": "b", "label": "文本"}  label 可省略
+
+生成规则:
+1. 只返回 JSON 数组,不要包含 markdown 代码块标记或任何解释
+2. 先列出全部节点,再列出全部连线
+3. id 使用简短的英文字母或数字,不要输出坐标、尺寸或颜色
+4. 开始与结束节点使用 ellipse,判断节点使用 diamond,判断分支的连线用 label 标注条件"""
+
+REFINE_MERMAID_PROMPT = """你是一个 Mermaid.js 图形编辑助手。用户会提供带行号的现有代码和一条修改指令。
+只输出实现该修改所需的最小补丁,不要输出完整代码。
+
+补丁格式: JSON 数组,每个元素是一个操作,行号均指原始代码 (从 1 开始):
+- {"op": "replace", "start": 3, "end": 4, "lines": ["新的第3行", "新的第4行"]}
+- {"op": "insert", "after": 5, "lines": ["插入的行"]}  (after 为 0 表示插入到开头)
+- {"op": "delete", "start": 7, "end": 7}
+
+规则:
+1. 只返回 JSON 数组,不要包含 markdown 代码块标记或任何解释
+2. lines 中不要包含行号前缀
+3. 修改后的代码必须保持 Mermaid 语法正确,节点 ID 与现有代码保持一致
+4. 标签保持简洁: 中文不超过8个汉字,英文不超过16个字符,不使用括号"""
+
+REFINE_EXCALIDRAW_PROMPT = """你是一个 Excalidraw 图形编辑助手。用户会提供现有的 JSON 数据和一条修改指令。
+只输出实现该修改所需的最小 JSON Patch (RFC 6902),不要输出完整数据。
+
+补丁格式: JSON 数组,支持的操作:
+- {"op": "replace", "path": "/elements/2/text", "value": "新文本"}
+- {"op": "add", "path": "/elements/-", "value": {...}}  (- 表示追加到数组末尾)
+- {"op": "remove", "path": "/elements/5"}
+
+规则:
+1. 只返回 JSON 数组,不要包含 markdown 代码块标记或任何解释
+2. 数组下标按操作顺序依次生效,删除多个元素时从后往前删除
+3. 新增元素的字段与现有元素保持一致,文本保持简洁且不使用括号"""
+
+# 补丁输出的 token 上限,与图形大小无关
+REFINE_OUTPUT_TOKEN_CAP = 2048
+
+# 各图形类型输出代码的 token 上限 (不含模型思考所需的预留)
+OUTPUT_TOKEN_CAPS: Dict[str, int] = {
+    "flowchart": 4096,
+    "sequence": 4096,
+    "class": 4096,
+    "state": 3072,
+    "er": 4096,
+    "gantt": 3072,
+    "pie": 1024,
+    "journey": 2048,
+    "architecture": 3072,
+}
+EXCALIDRAW_OUTPUT_TOKEN_CAP = 16384
+# 只输出节点与连线时,每个元素约 10-20 个 token
+EXCALIDRAW_TOPOLOGY_OUTPUT_TOKEN_CAP = 4096
+
+# 中日韩字符与全角标点通常各占约 1 个 token,其余字符约 4 个占 1 个 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数,用于预算控制而非计费"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def normalize_chart_type(chart_type: str) -> str:
+    """未知图形类型按流程图处理"""
+    return chart_type if chart_type in CHART_SPECS else "flowchart"
+
+
+def _chart_block(chart_type: str) -> str:
+    name, keyword, hint = CHART_SPECS[chart_type]
+    block = f"【重要】用户选择的图形类型: {name} ({chart_type})\n你必须严格使用 '{keyword}' 作为图形起始关键字。"
+    return f"{block}\n{hint}" if hint else block
+
+
+def excalidraw_auto_layout() -> bool:
+    """Excalidraw 是否使用自动布局模式 (通过环境变量自定义提示词时仍由模型输出坐标)"""
+    return (
+        settings.AI_EXCALIDRAW_AUTO_LAYOUT
+        and settings.AI_EXCALIDRAW_SYSTEM_PROMPT == Settings.model_fields["AI_EXCALIDRAW_SYSTEM_PROMPT"].default
+    )
+
+
+@lru_cache(maxsize=64)
+def _build_system_prompt(
+    diagram_type: DiagramTypeEnum,
+    chart_type: str,
+    custom_prompt: str,
+    excalidraw_prompt: str,
+    auto_layout: bool
+) -> str:
+    if diagram_type != DiagramTypeEnum.MERMAID:
+        if auto_layout:
+            return "\n\n".join((EXCALIDRAW_TOPOLOGY_BASE, ANALYSIS_RULES, LABEL_RULES))
+        return excalidraw_prompt
+
+    chart_type = normalize_chart_type(chart_type)
+    if custom_prompt != Settings.model_fields["AI_MERMAID_SYSTEM_PROMPT"].default:
+        # 通过环境变量自定义了完整提示词时,保持原有的拼接方式
+        return f"{custom_prompt}\n\n{_chart_block(chart_type)}"
+    return "\n\n".join((MERMAID_BASE, *CHART_SECTIONS[chart_type], _chart_block(chart_type)))
+
+
+def build_system_prompt(diagram_type: DiagramTypeEnum, chart_type: str = "flowchart") -> str:
+    """按图形类型组装系统提示词"""
+    return _build_system_prompt(
+        diagram_type,
+        chart_type or "flowchart",
+        settings.AI_MERMAID_SYSTEM_PROMPT,
+        settings.AI_EXCALIDRAW_SYSTEM_PROMPT,
+        excalidraw_auto_layout(),
+    )
+
+
+def max_output_tokens(diagram_type: DiagramTypeEnum, chart_type: str, prompt: str) -> int:
+    """根据图形类型与需求长度确定输出 token 上限
+
+    需求描述越长,图形通常越大;另为模型思考预留 AI_REASONING_TOKEN_RESERVE,
+    结果不超过 AI_MAX_TOKENS。
+    """
+    if diagram_type == DiagramTypeEnum.MERMAID:
+        base = OUTPUT_TOKEN_CAPS[normalize_chart_type(chart_type)]
+    elif excalidraw_auto_layout():
+        base = EXCALIDRAW_TOPOLOGY_OUTPUT_TOKEN_CAP
+    else:
+        base = EXCALIDRAW_OUTPUT_TOKEN_CAP
+    budget = base + settings.AI_OUTPUT_TOKENS_PER_PROMPT_TOKEN * estimate_tokens(prompt)
+    return min(settings.AI_MAX_TOKENS, settings.AI_REASONING_TOKEN_RESERVE + budget)
+
+
+def build_refine_prompt(diagram_type: DiagramTypeEnum) -> str:
+    """增量修改使用的系统提示词"""
+    return REFINE_MERMAID_PROMPT if diagram_type == DiagramTypeEnum.MERMAID else REFINE_EXCALIDRAW_PROMPT
+
+
+def refine_max_output_tokens(instruction: str) -> int:
+    """增量修改的输出上限,只随修改指令的长度增长"""
+    budget = REFINE_OUTPUT_TOKEN_CAP + settings.AI_OUTPUT_TOKENS_PER_PROMPT_TOKEN * estimate_tokens(instruction)
+    return min(settings.AI_MAX_TOKENS, settings.AI_REASONING_TOKEN_RESERVE + budget)
@@ -0,0 +1,232 @@
+"""
+限流 - 按用户与提供商的令牌桶,以及上游调用的并发控制与 429 自适应退避
+"""
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+import redis.asyncio as redis
+from fastapi import HTTPException
+from config import settings
+from redis_client import get_redis
+from ai_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# 原子地补充并尝试取出令牌,返回需要等待的秒数 (0 表示已取得)
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+def rate_limited(retry_after: float, detail: str) -> HTTPException:
+    """构造带 Retry-After 的 429 响应"""
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class TokenBucketLimiter:
+    """令牌桶限流
+
+    启用 Redis 时桶状态保存在 Redis 中,由 Lua 脚本原子更新,各 worker 共享;
+    未启用或 Redis 出错时使用进程内的桶。
+    """
+
+    def __init__(self, namespace: str, capacity: float, rate: float):
+        self.namespace = namespace
+        self.capacity = capacity
+        self.rate = rate
+        # 桶补满所需时间之后的状态与新桶相同,可以直接淘汰
+        self.memory = LRUCache(100000, math.ceil(capacity / rate))
+        self.allowed = 0
+        self.throttled = 0
+
+    async def acquire(self, key: str, cost: float = 1.0) -> float:
+        """尝试取出令牌,成功返回 0,否则返回需要等待的秒数"""
+        wait = None
+        client = get_redis()
+        if client is not None:
+            try:
+                wait = float(await client.eval(
+                    TOKEN_BUCKET_SCRIPT, 1, f"rl:{self.namespace}:{key}",
+                    self.capacity, self.rate, time.time(), cost
+                ))
+            except redis.RedisError as e:
+                logger.warning("Redis 限流失败,使用进程内限流: %s", e)
+        if wait is None:
+            wait = self._acquire_local(key, cost)
+
+        if wait > 0:
+            self.throttled += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def _acquire_local(self, key: str, cost: float) -> float:
+        now = time.monotonic()
+        tokens, ts = self.memory.get(key) or (self.capacity, now)
+        tokens = min(self.capacity, tokens + (now - ts) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self.memory.set(key, (tokens, now))
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "rate_per_second": self.rate,
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+        }
+
+
+class UpstreamGovernor:
+    """上游模型调用调度
+
+    每次调用前依次检查: 提供商 429 冷却期、进程内并发信号量、提供商令牌桶。
+    总等待时间不超过 AI_UPSTREAM_MAX_WAIT 时排队等待,否则直接返回 429。
+    提供商返回 429 时按 Retry-After 或指数退避进入冷却期,冷却期通过 Redis 在 worker 间共享。
+    """
+
+    def __init__(self):
+        self.buckets = TokenBucketLimiter(
+            "provider", settings.AI_PROVIDER_RATE_CAPACITY, settings.AI_PROVIDER_RATE_PER_SECOND
+        )
+        self._semaphore = asyncio.Semaphore(settings.AI_UPSTREAM_MAX_CONCURRENCY)
+        self._backoff: Dict[str, float] = {}
+        self._cooldown_until: Dict[str, float] = {}
+        self.active = 0
+        self.waits = 0
+        self.rejected = 0
+        self.provider_429s = 0
+
+    async def _cooldown_remaining(self, provider: str) -> float:
+        remaining = self._cooldown_until.get(provider, 0.0) - time.time()
+        client = get_redis()
+        if client is not None:
+            try:
+                ttl_ms = await client.pttl(f"rl:cooldown:{provider}")
+                if ttl_ms and ttl_ms > 0:
+                    remaining = max(remaining, ttl_ms / 1000)
+            except redis.RedisError as e:
+                logger.warning("读取提供商冷却状态失败: %s", e)
+        return max(0.0, remaining)
+
+    async def _wait(self, deadline: float, delay: float, detail: str):
+        """等待 delay 秒,超过截止时间时返回 429"""
+        loop = asyncio.get_running_loop()
+        if loop.time() + delay > deadline:
+            self.rejected += 1
+            raise rate_limited(delay, detail)
+        self.waits += 1
+        await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def slot(self, provider: str) -> AsyncIterator[None]:
+        """占用一个上游调用名额"""
+        if not settings.AI_RATE_LIMIT_ENABLED:
+            yield
+            return
+
+        deadline = asyncio.get_running_loop().time() + settings.AI_UPSTREAM_MAX_WAIT
+        cooldown = await self._cooldown_remaining(provider)
+        if cooldown > 0:
+            await self._wait(deadline, cooldown, "AI 提供商限流中,请稍后重试")
+
+        try:
+            timeout = max(0.0, deadline - asyncio.get_running_loop().time())
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise rate_limited(settings.AI_UPSTREAM_MAX_WAIT, "AI 服务繁忙,请稍后重试")
+
+        # 取得并发名额后再取令牌,排队超时的请求不会消耗提供商配额
+        try:
+            while (wait := await self.buckets.acquire(provider)) > 0:
+                await self._wait(deadline, wait, "AI 提供商请求过于频繁,请稍后重试")
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    async def throttled(self, provider: str, retry_after: Optional[str] = None) -> float:
+        """记录提供商返回的 429,返回冷却时间 (秒)"""
+        self.provider_429s += 1
+        backoff = min(
+            settings.AI_BACKOFF_MAX,
+            max(settings.AI_BACKOFF_BASE, self._backoff.get(provider, 0.0) * 2)
+        )
+        self._backoff[provider] = backoff
+        delay = backoff
+        if retry_after:
+            try:
+                delay = max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+
+        self._cooldown_until[provider] = time.time() + delay
+        client = get_redis()
+        if client is not None and delay > 0:
+            try:
+                await client.set(f"rl:cooldown:{provider}", "1", px=int(delay * 1000))
+            except redis.RedisError as e:
+                logger.warning("写入提供商冷却状态失败: %s", e)
+        logger.warning("%s 返回 429,冷却 %.1f 秒", provider, delay)
+        return delay
+
+    def succeeded(self, provider: str):
+        """上游调用成功,逐步缩短退避时间"""
+        if provider in self._backoff:
+            backoff = self._backoff[provider] / 2
+            if backoff < settings.AI_BACKOFF_BASE:
+                del self._backoff[provider]
+            else:
+                self._backoff[provider] = backoff
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.AI_RATE_LIMIT_ENABLED,
+            "max_concurrency": settings.AI_UPSTREAM_MAX_CONCURRENCY,
+            "active": self.active,
+            "waits": self.waits,
+            "rejected": self.rejected,
+            "provider_429s": self.provider_429s,
+            "backoff": dict(self._backoff),
+            "buckets": self.buckets.stats(),
+        }
+
+
+# 全局限流实例
+user_rate_limiter = TokenBucketLimiter("user", settings.AI_USER_RATE_CAPACITY, settings.AI_USER_RATE_PER_SECOND)
+upstream_governor = UpstreamGovernor()
+
@@ -0,0 +1,37 @@
+"""
+Redis 客户端 - 各模块共享的异步连接
+"""
+import logging
+from typing import Optional
+import redis.asyncio as redis
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """获取共享 Redis 客户端,未启用 Redis 时返回 None"""
+    global _client
+    if not settings.REDIS_ENABLED:
+        return None
+    if _client is None:
+        _client = redis.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        )
+    return _client
+
+
+async def close_redis():
+    """关闭共享 Redis 客户端"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        try:
+            await client.aclose()
+        except redis.RedisError as e:
+            logger.warning("关闭 Redis 连接失败: %s", e)
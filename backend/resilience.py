@@ -0,0 +1,145 @@
+"""
+容错 - 上游调用的重试退避与熔断
+"""
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Tuple
+import httpx
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 可重试的上游状态码 (429 由限流模块处理冷却,不在此重试)
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """是否属于提供商侧故障 (计入熔断错误率)"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """是否可以安全重试
+
+    连接阶段的错误与 5xx 可以重试;读超时说明模型可能仍在生成,重试只会放大延迟和成本。
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(exc, httpx.ReadTimeout):
+        return False
+    return isinstance(exc, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """第 attempt 次重试前的等待时间 (指数退避 + 全抖动)"""
+    cap = min(settings.AI_RETRY_MAX_DELAY, settings.AI_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    """熔断器
+
+    closed: 统计最近 AI_BREAKER_WINDOW 秒内的调用结果,
+    请求数达到 AI_BREAKER_MIN_REQUESTS 且错误率超过 AI_BREAKER_ERROR_RATE 时打开;
+    open: 直接拒绝调用,AI_BREAKER_OPEN_SECONDS 后进入 half_open;
+    half_open: 只放行一个探测请求,成功则关闭,失败则重新打开。
+    状态为进程内,各 worker 独立判断。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - settings.AI_BREAKER_WINDOW:
+            self._outcomes.popleft()
+
+    @property
+    def retry_after(self) -> float:
+        """距离允许探测的剩余秒数"""
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self._opened_at + settings.AI_BREAKER_OPEN_SECONDS - time.monotonic())
+
+    @property
+    def available(self) -> bool:
+        """当前是否可能放行请求 (不占用探测名额)"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return self.retry_after <= 0
+        return not self._probe_in_flight
+
+    def allow(self) -> bool:
+        """是否放行本次调用,half_open 时占用唯一的探测名额"""
+        if not settings.AI_BREAKER_ENABLED:
+            return True
+        if self.state == "open" and self.retry_after <= 0:
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state == "half_open":
+            logger.info("%s 熔断恢复", self.name)
+            self.state = "closed"
+            self._outcomes.clear()
+        self._probe_in_flight = False
+        self._record(True)
+
+    def record_failure(self):
+        if self.state == "half_open":
+            self._open()
+            return
+        self._record(False)
+        total = len(self._outcomes)
+        if total >= settings.AI_BREAKER_MIN_REQUESTS:
+            errors = sum(1 for _, ok in self._outcomes if not ok)
+            if errors / total >= settings.AI_BREAKER_ERROR_RATE:
+                self._open()
+
+    def release_probe(self):
+        """探测请求因非上游原因结束 (如客户端错误) 时归还探测名额"""
+        self._probe_in_flight = False
+
+    def _record(self, ok: bool):
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        self._trim(now)
+
+    def _open(self):
+        if self.state != "open":
+            logger.warning("%s 熔断打开,%s 秒内直接失败", self.name, settings.AI_BREAKER_OPEN_SECONDS)
+            self.opened += 1
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._outcomes.clear()
+
+    def snapshot(self) -> dict:
+        self._trim(time.monotonic())
+        total = len(self._outcomes)
+        errors = sum(1 for _, ok in self._outcomes if not ok)
+        return {
+            "state": self.state,
+            "requests": total,
+            "error_rate": round(errors / total, 3) if total else None,
+            "retry_after": round(self.retry_after, 1),
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
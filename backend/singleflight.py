@@ -0,0 +1,162 @@
+"""
+请求合并 (single-flight) - 相同键的并发请求只触发一次上游调用
+"""
+import asyncio
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+import redis.asyncio as redis
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# 仅当锁仍归自己所有时才删除,避免误删其他 worker 重新获取的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """请求合并
+
+    进程内: 相同键的并发调用共享同一个任务,任务独立于发起者运行,
+    因此首个调用方断开连接不会影响其他等待者。
+    跨 worker: 启用 Redis 时通过 SET NX 锁选出一个执行者,
+    其余 worker 订阅结果频道等待;执行者失败或超时后各自回退为直接调用。
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.shared = 0
+        self.remote_shared = 0
+
+    async def do(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[str]],
+        lookup: Optional[Callable[[], Awaitable[Optional[str]]]] = None
+    ) -> str:
+        """执行 fn,相同 key 的并发调用合并为一次
+
+        lookup 用于跨 worker 等待时检查结果是否已写入共享缓存
+        """
+        if not settings.AI_SINGLEFLIGHT_ENABLED:
+            return await fn()
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(self._run(key, fn, lookup))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有调用方都已取消时,避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[str]],
+        lookup: Optional[Callable[[], Awaitable[Optional[str]]]]
+    ) -> str:
+        client = get_redis()
+        if client is None:
+            return await fn()
+
+        lock_key = f"sf:{self.namespace}:lock:{key}"
+        channel = f"sf:{self.namespace}:done:{key}"
+        token = uuid.uuid4().hex
+
+        try:
+            acquired = await client.set(
+                lock_key, token, nx=True, px=int(settings.AI_SINGLEFLIGHT_LOCK_TTL * 1000)
+            )
+        except redis.RedisError as e:
+            logger.warning("获取 single-flight 锁失败: %s", e)
+            return await fn()
+
+        if not acquired:
+            result = await self._wait_remote(client, lock_key, channel, lookup)
+            if result is not None:
+                self.remote_shared += 1
+                return result
+            return await fn()
+
+        message = {"ok": False}
+        try:
+            result = await fn()
+            message = {"ok": True, "result": result}
+            return result
+        finally:
+            try:
+                await client.publish(channel, json.dumps(message, ensure_ascii=False))
+                await client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            except redis.RedisError as e:
+                logger.warning("释放 single-flight 锁失败: %s", e)
+
+    async def _wait_remote(
+        self,
+        client: redis.Redis,
+        lock_key: str,
+        channel: str,
+        lookup: Optional[Callable[[], Awaitable[Optional[str]]]]
+    ) -> Optional[str]:
+        """等待其他 worker 的执行结果,失败返回 None"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.AI_SINGLEFLIGHT_WAIT_TIMEOUT
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            # 订阅前执行者可能已完成,先检查共享缓存
+            if lookup is not None:
+                result = await lookup()
+                if result is not None:
+                    return result
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=min(remaining, 1.0)
+                )
+                if message is not None:
+                    payload = json.loads(message["data"])
+                    return payload["result"] if payload.get("ok") else None
+                # 执行者崩溃时锁会过期,不再继续等待
+                if not await client.exists(lock_key):
+                    return None
+        except redis.RedisError as e:
+            logger.warning("等待 single-flight 结果失败: %s", e)
+            return None
+        finally:
+            try:
+                await pubsub.unsubscribe(channel)
+                await pubsub.aclose()
+            except redis.RedisError:
+                pass
+
+    def stats(self) -> dict:
+        """请求合并统计"""
+        return {
+            "enabled": settings.AI_SINGLEFLIGHT_ENABLED,
+            "inflight": len(self._inflight),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "remote_shared": self.remote_shared,
+        }
@@ -0,0 +1,254 @@
+"""
+模板库 - 模板目录常驻内存,列表与详情预先序列化并附带 ETag
+
+模板数量有限且很少修改: 启动时一次性加载,之后每 TEMPLATE_CATALOG_REFRESH_INTERVAL 秒
+在下次访问时重新加载 (获取其他 worker 或直接写库的修改);本进程内通过 ORM 修改模板时立即失效。
+使用次数先在内存中累加,每 TEMPLATE_USAGE_FLUSH_INTERVAL 秒合并为一次批量 UPDATE 写回数据库。
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import bindparam, event, func, select, update
+from config import settings
+from database import AsyncSessionLocal
+from models import Template
+
+logger = logging.getLogger(__name__)
+
+# 列表视图的字段,不包含模板内容
+SUMMARY_FIELDS = (
+    "id", "name", "category", "diagram_type", "render_engine",
+    "thumbnail_url", "description", "usage_count", "is_featured",
+)
+CONTENT_FIELDS = ("mermaid_code", "excalidraw_data")
+
+
+class CachedBody:
+    """预先序列化的 JSON 响应体及其 ETag"""
+
+    __slots__ = ("body", "etag")
+
+    def __init__(self, payload):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+
+
+def _record(template: Template) -> dict:
+    record = {field: getattr(template, field) for field in SUMMARY_FIELDS + CONTENT_FIELDS}
+    record["diagram_type"] = template.diagram_type.value
+    record["render_engine"] = template.render_engine.value
+    record["usage_count"] = template.usage_count or 0
+    record["is_featured"] = bool(template.is_featured)
+    return record
+
+
+def _summary(record: dict) -> dict:
+    return {field: record[field] for field in SUMMARY_FIELDS}
+
+
+class TemplateCatalog:
+    """进程内模板目录
+
+    列表按 (分类, 是否精选) 在首次请求时序列化并缓存,详情在加载时序列化;重新加载后全部重建。
+    列表按精选优先、使用次数降序排列,使用次数以最近一次加载时数据库中的值为准。
+    """
+
+    def __init__(self):
+        self._records: Dict[int, dict] = {}
+        self._order: List[int] = []
+        self._details: Dict[int, CachedBody] = {}
+        self._listings: Dict[Tuple[Optional[str], Optional[bool]], CachedBody] = {}
+        self._categories: List[str] = []
+        self._loaded_at: Optional[float] = None
+        self._stale = True
+        self._lock = asyncio.Lock()
+        self._pending: Counter = Counter()
+        self._flusher: Optional[asyncio.Task] = None
+        self.reloads = 0
+        self.flushed_uses = 0
+        self.flush_failures = 0
+
+    async def start(self):
+        """加载模板目录并启动使用次数的定时写回"""
+        try:
+            await self.ensure_loaded()
+        except Exception:
+            logger.exception("加载模板目录失败,将在首次访问时重试")
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run(), name="template-usage-flusher")
+
+    async def stop(self):
+        """停止定时写回,并写回尚未提交的使用次数"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    # ===== 目录加载 =====
+
+    def invalidate(self):
+        """标记目录已过期,下次访问时重新加载"""
+        self._stale = True
+
+    def _expired(self) -> bool:
+        return (
+            self._stale
+            or self._loaded_at is None
+            or time.monotonic() - self._loaded_at >= settings.TEMPLATE_CATALOG_REFRESH_INTERVAL
+        )
+
+    async def ensure_loaded(self):
+        """目录过期时重新加载,并发请求只加载一次"""
+        if not self._expired():
+            return
+        async with self._lock:
+            if not self._expired():
+                return
+            # 先清除标记: 加载期间发生的修改会重新标记,下次访问时再次加载
+            self._stale = False
+            try:
+                await self._load()
+            except Exception:
+                self._stale = True
+                raise
+
+    async def _load(self):
+        async with AsyncSessionLocal() as db:
+            templates = (await db.scalars(select(Template))).all()
+            records = {template.id: _record(template) for template in templates}
+
+        order = sorted(
+            records,
+            key=lambda template_id: (
+                not records[template_id]["is_featured"],
+                -records[template_id]["usage_count"],
+                template_id,
+            ),
+        )
+        self._records = records
+        self._order = order
+        self._details = {template_id: CachedBody(record) for template_id, record in records.items()}
+        self._listings = {}
+        self._categories = sorted({record["category"] for record in records.values()})
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    # ===== 查询 =====
+
+    def _select(self, category: Optional[str], featured: Optional[bool], query: Optional[str]) -> List[dict]:
+        needle = query.casefold() if query else None
+        items = []
+        for template_id in self._order:
+            record = self._records[template_id]
+            if category is not None and record["category"] != category:
+                continue
+            if featured is not None and record["is_featured"] != featured:
+                continue
+            if needle is not None and not any(
+                needle in (record[field] or "").casefold() for field in ("name", "description", "category")
+            ):
+                continue
+            items.append(_summary(record))
+        return items
+
+    async def listing(
+        self,
+        category: Optional[str] = None,
+        featured: Optional[bool] = None,
+        query: Optional[str] = None
+    ) -> CachedBody:
+        """模板列表 {"items": [...], "categories": [...]}
+
+        按分类/精选筛选的结果缓存到下次重新加载;带搜索词时即时筛选,不缓存。
+        """
+        await self.ensure_loaded()
+        query = query.strip() if query else None
+        if query:
+            return CachedBody({"items": self._select(category, featured, query), "categories": self._categories})
+
+        key = (category, featured)
+        body = self._listings.get(key)
+        if body is None:
+            body = CachedBody({"items": self._select(category, featured, None), "categories": self._categories})
+            # 只缓存已有分类,避免任意分类参数占用内存
+            if category is None or category in self._categories:
+                self._listings[key] = body
+        return body
+
+    async def detail(self, template_id: int) -> Optional[CachedBody]:
+        """模板详情 (包含模板内容)"""
+        await self.ensure_loaded()
+        return self._details.get(template_id)
+
+    async def get(self, template_id: int) -> Optional[dict]:
+        """模板记录的副本,可直接用于创建图形"""
+        await self.ensure_loaded()
+        record = self._records.get(template_id)
+        return copy.deepcopy(record) if record is not None else None
+
+    # ===== 使用次数 =====
+
+    def record_use(self, template_id: int):
+        """记录一次使用,由后台任务合并写回"""
+        self._pending[template_id] += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.TEMPLATE_USAGE_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        """把累加的使用次数合并为一次批量 UPDATE 写回;失败时保留到下次写回"""
+        pending, self._pending = self._pending, Counter()
+        if not pending:
+            return
+
+        table = Template.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("template_id"))
+            .values(usage_count=func.coalesce(table.c.usage_count, 0) + bindparam("uses"))
+        )
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    statement,
+                    [{"template_id": template_id, "uses": uses} for template_id, uses in pending.items()]
+                )
+                await db.commit()
+        except Exception as e:
+            self.flush_failures += 1
+            self._pending.update(pending)
+            logger.warning("写回模板使用次数失败: %s", e)
+            return
+        self.flushed_uses += sum(pending.values())
+
+    def stats(self) -> dict:
+        """目录与使用次数统计"""
+        return {
+            "templates": len(self._records),
+            "categories": len(self._categories),
+            "reloads": self.reloads,
+            "cached_listings": len(self._listings),
+            "pending_uses": sum(self._pending.values()),
+            "flushed_uses": self.flushed_uses,
+            "flush_failures": self.flush_failures,
+        }
+
+
+# 全局模板目录实例
+template_catalog = TemplateCatalog()
+
+
+@event.listens_for(Template, "after_insert")
+@event.listens_for(Template, "after_update")
+@event.listens_for(Template, "after_delete")
+def _invalidate_template_catalog(mapper, connection, target: Template):
+    """通过 ORM 新增、修改或删除模板时使目录失效 (使用次数的批量写回不经过 ORM,不会触发)"""
+    template_catalog.invalidate()
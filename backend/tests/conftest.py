@@ -0,0 +1,58 @@
+"""
+测试公共配置 - 在导入后端模块之前指向临时 SQLite 数据库并关闭 Redis
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DB = os.path.join(tempfile.mkdtemp(prefix="genai-flow-test-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DB}"
+os.environ["REDIS_ENABLED"] = "false"
+sys.path.insert(0, BACKEND_DIR)
+
+import pytest
+from database import Base, async_engine, engine
+import models  # noqa: F401  注册所有表
+
+
+class FakeClock:
+    """可手动推进的 time.monotonic"""
+
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr("time.monotonic", fake)
+    return fake
+
+
+@pytest.fixture
+def tables():
+    """每个测试使用空表"""
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def run():
+    """在新的事件循环中运行协程,结束后释放异步连接池 (连接不能跨事件循环复用)"""
+    def _run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(main())
+    return _run
@@ -0,0 +1,59 @@
+import pytest
+from collab import merge_text, validate_text_edits
+from diagram_patch import PatchError
+
+BASE = "graph TD\nA --> B\nB --> C\nC --> D\n"
+
+
+def test_merge_without_local_or_remote_changes():
+    changed = BASE.replace("A --> B", "A --> X")
+    assert merge_text(BASE, BASE, changed) == changed
+    assert merge_text(BASE, changed, BASE) == changed
+    assert merge_text(BASE, changed, changed) == changed
+
+
+def test_merge_non_overlapping_edits():
+    ours = BASE.replace("A --> B", "A --> X")
+    theirs = BASE.replace("C --> D", "C --> Y") + "Y --> Z\n"
+    assert merge_text(BASE, ours, theirs) == "graph TD\nA --> X\nB --> C\nC --> Y\nY --> Z\n"
+
+
+def test_merge_identical_edit_on_both_sides():
+    ours = BASE.replace("A --> B", "A --> X") + "D --> E\n"
+    theirs = BASE.replace("A --> B", "A --> X")
+    assert merge_text(BASE, ours, theirs) == ours
+
+
+def test_merge_conflicting_edits():
+    ours = BASE.replace("B --> C", "B --> X")
+    theirs = BASE.replace("B --> C", "B --> Y")
+    assert merge_text(BASE, ours, theirs) is None
+
+
+def test_merge_insertions_at_same_position_conflict():
+    ours = BASE + "D --> E\n"
+    theirs = BASE + "D --> F\n"
+    assert merge_text(BASE, ours, theirs) is None
+
+
+def test_validate_text_edits_accepts_ordered_edits():
+    edits = [[0, 1, ["flowchart LR\n"]], [2, 2, ["X --> Y\n"]], [3, 4, []]]
+    assert validate_text_edits(BASE, edits) is edits
+    assert validate_text_edits(BASE, [[4, 4, ["D --> E\n"]]])
+
+
+@pytest.mark.parametrize("edits", [
+    "not a list",
+    [[0, 1]],
+    [[0, 1, "line"]],
+    [[0, 1, [1]]],
+    [[True, 1, []]],
+    [[2, 1, []]],
+    [[0, 5, []]],
+    [[-1, 0, []]],
+    [[1, 3, []], [2, 4, []]],
+    [[2, 3, []], [0, 1, []]],
+])
+def test_validate_text_edits_rejects_invalid(edits):
+    with pytest.raises(PatchError):
+        validate_text_edits(BASE, edits)
@@ -0,0 +1,130 @@
+import pytest
+from diagram_patch import (
+    PatchError,
+    apply_json_patch,
+    apply_line_patch,
+    number_lines,
+    parse_patch,
+    upsert_elements,
+)
+
+CODE = "graph TD\nA[开始] --> B\nB --> C\nC --> D"
+
+
+def test_number_lines():
+    assert number_lines("a\nb") == "1| a\n2| b"
+
+
+def test_parse_patch_accepts_array_and_ops_object():
+    assert parse_patch('[{"op": "delete", "start": 1}]') == [{"op": "delete", "start": 1}]
+    assert parse_patch('{"ops": [{"op": "delete", "start": 1}]}') == [{"op": "delete", "start": 1}]
+
+
+@pytest.mark.parametrize("text", ["not json", '{"op": "delete"}', "[1, 2]"])
+def test_parse_patch_rejects_invalid(text):
+    with pytest.raises(PatchError):
+        parse_patch(text)
+
+
+def test_line_patch_uses_original_line_numbers():
+    result = apply_line_patch(CODE, [
+        {"op": "insert", "after": 0, "lines": ["%% 注释"]},
+        {"op": "replace", "start": 3, "end": 3, "lines": ["B --> X", "X --> C"]},
+        {"op": "delete", "start": 4},
+    ])
+    assert result == "%% 注释\ngraph TD\nA[开始] --> B\nB --> X\nX --> C"
+
+
+def test_line_patch_accepts_string_lines():
+    assert apply_line_patch("a\nb", [{"op": "replace", "start": 2, "lines": "x\ny"}]) == "a\nx\ny"
+
+
+def test_line_patch_insert_and_replace_at_same_boundary():
+    result = apply_line_patch("a\nb\nc", [
+        {"op": "insert", "after": 1, "lines": ["new"]},
+        {"op": "replace", "start": 2, "end": 2, "lines": ["B"]},
+    ])
+    assert result == "a\nnew\nB\nc"
+
+
+def test_line_patch_rejects_overlap():
+    with pytest.raises(PatchError, match="重叠"):
+        apply_line_patch(CODE, [
+            {"op": "replace", "start": 2, "end": 3, "lines": ["x"]},
+            {"op": "delete", "start": 3, "end": 4},
+        ])
+
+
+@pytest.mark.parametrize("op", [
+    {"op": "delete", "start": 0},
+    {"op": "delete", "start": 5},
+    {"op": "replace", "start": 3, "end": 2, "lines": []},
+    {"op": "insert", "after": True, "lines": []},
+    {"op": "replace", "start": 1, "lines": [1]},
+    {"op": "move", "start": 1},
+])
+def test_line_patch_rejects_invalid_ops(op):
+    with pytest.raises(PatchError):
+        apply_line_patch(CODE, [op])
+
+
+def test_json_patch_does_not_modify_input():
+    doc = {"elements": [{"id": "a", "x": 1}], "appState": {}}
+    result = apply_json_patch(doc, [
+        {"op": "replace", "path": "/elements/0/x", "value": 5},
+        {"op": "add", "path": "/elements/-", "value": {"id": "b"}},
+        {"op": "add", "path": "/appState/grid", "value": 20},
+        {"op": "remove", "path": "/appState/grid"},
+    ])
+    assert result == {"elements": [{"id": "a", "x": 5}, {"id": "b"}], "appState": {}}
+    assert doc == {"elements": [{"id": "a", "x": 1}], "appState": {}}
+
+
+def test_json_patch_escaped_pointer():
+    assert apply_json_patch({"a/b": 1, "c~d": 2}, [
+        {"op": "replace", "path": "/a~1b", "value": 3},
+        {"op": "remove", "path": "/c~0d"},
+    ]) == {"a/b": 3}
+
+
+def test_json_patch_replaces_root():
+    assert apply_json_patch({"a": 1}, [{"op": "replace", "path": "", "value": [1]}]) == [1]
+
+
+def test_json_patch_test_op():
+    doc = {"elements": [{"id": "a", "version": 2}]}
+    ops = [
+        {"op": "test", "path": "/elements/0/version", "value": 2},
+        {"op": "replace", "path": "/elements/0/version", "value": 3},
+    ]
+    assert apply_json_patch(doc, ops)["elements"][0]["version"] == 3
+    with pytest.raises(PatchError, match="test"):
+        apply_json_patch(doc, [{"op": "test", "path": "/elements/0/version", "value": 1}] + ops[1:])
+
+
+@pytest.mark.parametrize("op", [
+    {"op": "remove", "path": "/missing"},
+    {"op": "replace", "path": "/elements/1", "value": 1},
+    {"op": "add", "path": "/elements/2", "value": 1},
+    {"op": "add", "path": "/elements/x", "value": 1},
+    {"op": "add", "path": "/elements/0"},
+    {"op": "remove", "path": ""},
+    {"op": "copy", "path": "/elements"},
+    {"op": "add", "path": "elements", "value": 1},
+])
+def test_json_patch_rejects_invalid_ops(op):
+    with pytest.raises(PatchError):
+        apply_json_patch({"elements": [{"id": "a"}]}, [op])
+
+
+def test_upsert_elements_keeps_higher_version():
+    doc = {"elements": [{"id": "a", "version": 3, "x": 1}], "appState": {"x": 1}}
+    result = upsert_elements(doc, [
+        {"id": "a", "version": 2, "x": 9},
+        {"id": "b", "version": 1},
+    ])
+    assert result["elements"] == [{"id": "a", "version": 3, "x": 1}, {"id": "b", "version": 1}]
+    assert result["appState"] == {"x": 1}
+    assert upsert_elements(doc, [{"id": "a", "version": 3, "x": 2}])["elements"][0]["x"] == 2
+    with pytest.raises(PatchError):
+        upsert_elements(doc, [{"version": 1}])
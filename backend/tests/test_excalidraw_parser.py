@@ -0,0 +1,110 @@
+import pytest
+from excalidraw_parser import (
+    ElementError,
+    ElementStreamParser,
+    excalidraw_payload,
+    parse_elements,
+    validate_element,
+)
+
+OUTPUT = (
+    '下面是图形:\n```json\n['
+    '{"type": "rectangle", "x": 0, "y": 0, "width": 120, "height": 60, "label": "开始"},'
+    '{"type": "arrow", "startX": 60, "startY": 60, "endX": 60, "endY": 140, "label": "下一步 \\"是\\""},'
+    '{"type": "text", "x": 10, "y": 200, "text": "说明", "fontSize": "16"}'
+    ']\n```\n以上。'
+)
+
+
+def test_parse_complete_output():
+    result = parse_elements(OUTPUT)
+    assert [element["type"] for element in result.elements] == ["rectangle", "arrow", "text"]
+    assert result.elements[0]["label"] == "开始"
+    assert result.elements[1]["label"] == '下一步 "是"'
+    assert result.elements[2]["fontSize"] == 16
+    assert not result.truncated and result.warnings == []
+
+
+def test_text_is_kept_verbatim():
+    # 序列图消息、备注等长文本与括号原样保留,只去除首尾空白
+    message = "  用户提交订单 (含优惠券) 并等待支付结果 [超时 30s] {重试}  "
+    assert validate_element({"type": "text", "x": 0, "y": 0, "text": message})["text"] == message.strip()
+    assert validate_element({"type": "arrow", "startX": 0, "startY": 0, "endX": 1, "endY": 0, "label": 12})["label"] == "12"
+    assert excalidraw_payload(f'[{{"type": "text", "x": 0, "y": 0, "text": "{message}"}}]')[0]["text"] == message.strip()
+
+
+def test_chunked_feed_matches_whole_input():
+    parser = ElementStreamParser()
+    emitted = []
+    for ch in OUTPUT:
+        emitted.extend(parser.feed(ch))
+    assert emitted == parse_elements(OUTPUT).elements
+    assert parser.complete
+
+
+@pytest.mark.parametrize("cut", range(1, len(OUTPUT), 7))
+def test_truncated_output_keeps_closed_elements(cut):
+    text = OUTPUT[:cut]
+    result = parse_elements(text)
+    full = parse_elements(OUTPUT).elements
+    assert result.elements == full[:len(result.elements)]
+    if result.found_array and cut <= OUTPUT.rindex("]"):
+        assert result.truncated
+        assert "输出被截断,已保留完整的元素" in result.warnings
+
+
+def test_garbage_between_and_invalid_elements():
+    text = (
+        '[{"type": "ellipse", "x": 0, "y": 0, "width": 10, "height": 10} garbage ,,'
+        '{"type": "rectangle", "x": "abc", "y": 0, "width": 10, "height": 10},'
+        '{"type": "star", "x": 0},'
+        '{"type": "rectangle", x: 1},'
+        '{"type": "diamond", "x": 5, "y": 5, "width": 10, "height": 10, "strokeColor": "}]{", "unknown": 1}'
+        ']'
+    )
+    result = parse_elements(text)
+    assert [element["type"] for element in result.elements] == ["ellipse", "diamond"]
+    assert "unknown" not in result.elements[1]
+    # 字符串中的括号不影响对象边界
+    assert result.elements[1]["strokeColor"] == "}]{"
+    assert len(result.errors) == 3
+    assert result.errors[0].startswith("元素 1:")
+    assert "JSON 格式错误" in result.errors[2]
+
+
+def test_scene_object_and_missing_array():
+    scene = '{"type": "excalidraw", "elements": [{"type": "text", "x": 0, "y": 0, "text": "hi"}]}'
+    assert parse_elements(scene).elements == [{"type": "text", "x": 0, "y": 0, "text": "hi"}]
+
+    result = parse_elements("graph TD\nA --> B")
+    assert not result.found_array and not result.truncated and result.elements == []
+    assert excalidraw_payload("graph TD\nA --> B") == "graph TD\nA --> B"
+    assert excalidraw_payload("[]") == []
+
+
+@pytest.mark.parametrize("raw", [
+    "rectangle",
+    {"type": "rectangle", "x": 0, "y": 0, "width": 0, "height": 10},
+    {"type": "rectangle", "x": float("nan"), "y": 0, "width": 10, "height": 10},
+    {"type": "rectangle", "x": 10 ** 9, "y": 0, "width": 10, "height": 10},
+    {"type": "rectangle", "x": True, "y": 0, "width": 10, "height": 10},
+    {"type": "arrow", "startX": 0, "startY": 0, "endX": 0, "endY": 0},
+    {"type": "arrow", "x": 0, "y": 0, "points": [[0, 0]]},
+    {"type": "line", "x": 0, "y": 0, "points": [[0, 0], [1]]},
+    {"type": "text", "x": 0, "y": 0, "text": "  "},
+    {"type": "text", "x": 0, "y": 0, "text": ["a"]},
+])
+def test_validate_element_rejects_invalid(raw):
+    with pytest.raises(ElementError):
+        validate_element(raw)
+
+
+def test_validate_element_normalizes_fields():
+    element = validate_element({
+        "type": " Arrow ", "x": "1.5", "y": 2.0, "points": [[0, 0], ["10", 20]],
+        "strokeWidth": "2", "startId": "a", "endId": "", "groupIds": ["g"],
+    })
+    assert element == {
+        "type": "arrow", "x": 1.5, "y": 2, "points": [[0, 0], [10, 20]],
+        "strokeWidth": 2, "startId": "a",
+    }
@@ -0,0 +1,123 @@
+import pytest
+from layout import layout_graph, layout_topology
+
+
+def _node(node_id, label=None, shape="rectangle"):
+    return {"id": node_id, "label": label or node_id, "shape": shape}
+
+
+def _edge(source, target, label=None):
+    return {"from": source, "to": target, "label": label}
+
+
+def _split(elements):
+    shapes = {element["id"]: element for element in elements if element["type"] != "arrow" and element["type"] != "text"}
+    arrows = {element["id"]: element for element in elements if element["type"] == "arrow"}
+    return shapes, arrows
+
+
+def _absolute(arrow):
+    return [(arrow["x"] + dx, arrow["y"] + dy) for dx, dy in arrow["points"]]
+
+
+def _on_boundary(point, shape):
+    x, y = point
+    inside_x = shape["x"] <= x <= shape["x"] + shape["width"]
+    inside_y = shape["y"] <= y <= shape["y"] + shape["height"]
+    on_horizontal = y in (shape["y"], shape["y"] + shape["height"]) and inside_x
+    on_vertical = x in (shape["x"], shape["x"] + shape["width"]) and inside_y
+    return on_horizontal or on_vertical
+
+
+def _overlap(a, b):
+    return (
+        a["x"] < b["x"] + b["width"] and b["x"] < a["x"] + a["width"]
+        and a["y"] < b["y"] + b["height"] and b["y"] < a["y"] + a["height"]
+    )
+
+
+def test_empty_graph():
+    assert layout_graph([], []) == []
+
+
+def test_chain_is_layered_top_to_bottom():
+    nodes = [_node("a"), _node("b"), _node("c")]
+    shapes, arrows = _split(layout_graph(nodes, [_edge("a", "b"), _edge("b", "c")]))
+    ys = [shapes[f"node-{i}"]["y"] for i in range(3)]
+    assert ys == sorted(ys) and len(set(ys)) == 3
+    assert min(shape["x"] for shape in shapes.values()) == 0
+    assert min(shape["y"] for shape in shapes.values()) == 0
+    for arrow in arrows.values():
+        points = _absolute(arrow)
+        assert _on_boundary(points[0], shapes[arrow["startId"]])
+        assert _on_boundary(points[-1], shapes[arrow["endId"]])
+
+
+@pytest.mark.parametrize("direction", ["LR", "RL", "BT"])
+def test_direction(direction):
+    shapes, _ = _split(layout_graph([_node("a"), _node("b")], [_edge("a", "b")], direction))
+    a, b = shapes["node-0"], shapes["node-1"]
+    axis = "x" if direction in ("LR", "RL") else "y"
+    forward = direction == "LR"
+    assert (a[axis] < b[axis]) == forward
+
+
+def test_cycle_is_broken_and_all_edges_routed():
+    nodes = [_node("a"), _node("b"), _node("c")]
+    edges = [_edge("a", "b"), _edge("b", "c"), _edge("c", "a", "重试")]
+    elements = layout_graph(nodes, edges)
+    shapes, arrows = _split(elements)
+    assert len(shapes) == 3 and len(arrows) == 3
+    assert len({shape["y"] for shape in shapes.values()}) == 3
+
+    back = arrows["edge-2"]
+    assert (back["startId"], back["endId"]) == ("node-2", "node-0")
+    points = _absolute(back)
+    # 回边跨越两层,经过一个虚拟节点;方向与原始连线一致
+    assert len(points) == 3
+    assert _on_boundary(points[0], shapes["node-2"])
+    assert _on_boundary(points[-1], shapes["node-0"])
+    labels = [element for element in elements if element["type"] == "text"]
+    assert [label["text"] for label in labels] == ["重试"]
+
+
+def test_long_edges_get_bends_and_self_loops_are_dropped():
+    nodes = [_node(name) for name in "abcd"]
+    edges = [_edge("a", "b"), _edge("b", "c"), _edge("c", "d"), _edge("a", "d"), _edge("b", "b")]
+    shapes, arrows = _split(layout_graph(nodes, edges))
+    assert len(arrows) == 4
+    assert len(arrows["edge-3"]["points"]) == 4
+    assert all(len(arrows[f"edge-{i}"]["points"]) == 2 for i in range(3))
+    # 虚拟节点占用层内位置,长边不穿过中间层的节点
+    for x, y in _absolute(arrows["edge-3"])[1:-1]:
+        for shape in (shapes["node-1"], shapes["node-2"]):
+            assert not (shape["x"] <= x <= shape["x"] + shape["width"] and shape["y"] <= y <= shape["y"] + shape["height"])
+
+
+def test_nodes_do_not_overlap():
+    nodes = [_node(f"n{i}", f"节点 {i}", "diamond" if i % 5 == 0 else "rectangle") for i in range(30)]
+    edges = [_edge(f"n{i}", f"n{(i * 7 + 3) % 30}") for i in range(30)] + [_edge(f"n{i}", f"n{i + 1}") for i in range(29)]
+    shapes, arrows = _split(layout_graph(nodes, edges))
+    assert len(shapes) == 30
+    items = list(shapes.values())
+    for i, a in enumerate(items):
+        for b in items[i + 1:]:
+            assert not _overlap(a, b)
+
+
+def test_layout_topology_adds_missing_nodes_and_keeps_placed_elements():
+    text = (
+        '[{"direction": "LR"},'
+        '{"id": "a", "label": "开始", "shape": "ellipse"},'
+        '{"from": "a", "to": "b"}, {"from": "a", "to": "b"},'
+        '{"type": "text", "x": 0, "y": 0, "text": "标题"},'
+        '{"from": "b", "to": '
+    )
+    result = layout_topology(text)
+    assert result.truncated
+    assert result.elements[0] == {"type": "text", "x": 0, "y": 0, "text": "标题"}
+    shapes, arrows = _split(result.elements[1:])
+    assert [shape["label"] for shape in shapes.values()] == ["开始", "b"]
+    assert shapes["node-0"]["type"] == "ellipse"
+    assert len(arrows) == 1
+    assert shapes["node-0"]["x"] < shapes["node-1"]["x"]
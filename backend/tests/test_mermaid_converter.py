@@ -0,0 +1,67 @@
+import pytest
+from mermaid_converter import ConversionError, mermaid_to_elements, to_scene
+
+FLOWCHART = "graph TD\n    A[开始] --> B{判断}\n    B -->|是| C[结束]\n    B -->|否| A"
+
+
+def test_flowchart_scene_binds_labels_and_arrows():
+    scene = to_scene(mermaid_to_elements(FLOWCHART))
+    assert scene["type"] == "excalidraw" and scene["source"] == "genai-flow"
+    elements = {element["id"]: element for element in scene["elements"]}
+    assert len(elements) == len(scene["elements"])
+
+    shapes = [element for element in scene["elements"] if element["type"] in ("rectangle", "diamond", "ellipse")]
+    arrows = [element for element in scene["elements"] if element["type"] == "arrow"]
+    assert sorted(element["type"] for element in shapes) == ["diamond", "rectangle", "rectangle"]
+    assert len(arrows) == 3
+
+    for shape in shapes:
+        bound = {item["id"]: item["type"] for item in shape["boundElements"]}
+        labels = [elements[item_id] for item_id, kind in bound.items() if kind == "text"]
+        assert len(labels) == 1 and labels[0]["containerId"] == shape["id"]
+    for arrow in arrows:
+        for binding in ("startBinding", "endBinding"):
+            shape = elements[arrow[binding]["elementId"]]
+            assert {"type": "arrow", "id": arrow["id"]} in shape["boundElements"]
+        assert arrow["points"][0] == [0, 0]
+
+    texts = [element["text"] for element in scene["elements"] if element["type"] == "text"]
+    assert {"开始", "判断", "结束", "是", "否"} <= set(texts)
+
+
+def test_scene_is_deterministic():
+    assert to_scene(mermaid_to_elements(FLOWCHART)) == to_scene(mermaid_to_elements(FLOWCHART))
+
+
+def test_to_scene_expands_simple_elements():
+    scene = to_scene([
+        {"type": "rectangle", "id": "r", "x": 0, "y": 0, "width": 100, "height": 50, "backgroundColor": "#fff"},
+        {"type": "line", "startX": 0, "startY": 80, "endX": 100, "endY": 120},
+        {"type": "arrow", "x": 50, "y": 50, "points": [[0, 0], [0, 30], [40, 30]], "startId": "r", "endId": "missing"},
+        {"type": "text", "x": 5, "y": 5, "text": "备注"},
+    ])
+    rect, line, arrow, text = scene["elements"]
+    assert rect["backgroundColor"] == "#fff" and rect["roundness"] == {"type": 3}
+    assert line["id"] == "element-1" and line["points"] == [[0, 0], [100, 40]]
+    assert (line["width"], line["height"]) == (100, 40) and line["endArrowhead"] is None
+    assert arrow["roundness"] == {"type": 2} and arrow["endBinding"] is None
+    assert arrow["startBinding"]["elementId"] == "r"
+    assert text["containerId"] is None and text["fontSize"] == 20
+
+
+def test_sequence_and_state_diagrams():
+    sequence = to_scene(mermaid_to_elements(
+        "sequenceDiagram\n    participant U as 用户\n    U->>S: 登录\n    S-->>U: 成功\n    Note over U,S: 会话建立"
+    ))
+    texts = {element["text"] for element in sequence["elements"] if element["type"] == "text"}
+    assert {"用户", "S", "登录", "成功", "会话建立"} <= texts
+
+    state = mermaid_to_elements("stateDiagram-v2\n    [*] --> 待处理\n    待处理 --> 完成: 处理\n    完成 --> [*]")
+    assert any(element.get("label") == "待处理" for element in state)
+    assert sum(element["type"] == "arrow" for element in state) == 3
+
+
+@pytest.mark.parametrize("code", ["", "pie\n    \"A\": 1", "not mermaid"])
+def test_unsupported_chart_type(code):
+    with pytest.raises(ConversionError):
+        mermaid_to_elements(code)
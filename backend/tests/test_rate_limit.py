@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from rate_limit import TokenBucketLimiter, rate_limited
+
+
+def test_bucket_allows_burst_then_throttles(clock):
+    limiter = TokenBucketLimiter("test", capacity=3, rate=1)
+    assert [limiter._acquire_local("u1", 1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter._acquire_local("u1", 1) == pytest.approx(1.0)
+    # 其他键使用独立的桶
+    assert limiter._acquire_local("u2", 1) == 0.0
+
+
+def test_bucket_refills_over_time(clock):
+    limiter = TokenBucketLimiter("test", capacity=2, rate=0.5)
+    limiter._acquire_local("u", 2)
+    clock.advance(1)
+    assert limiter._acquire_local("u", 1) == pytest.approx(1.0)
+    clock.advance(1)
+    assert limiter._acquire_local("u", 1) == 0.0
+    # 补充不超过容量
+    clock.advance(100)
+    assert limiter._acquire_local("u", 2) == 0.0
+    assert limiter._acquire_local("u", 1) == pytest.approx(2.0)
+
+
+def test_cost_larger_than_tokens(clock):
+    limiter = TokenBucketLimiter("test", capacity=5, rate=2)
+    assert limiter._acquire_local("u", 4) == 0.0
+    assert limiter._acquire_local("u", 3) == pytest.approx(1.0)
+    # 被拒绝的请求不消耗令牌
+    clock.advance(1)
+    assert limiter._acquire_local("u", 3) == 0.0
+
+
+def test_acquire_without_redis_counts_results(clock):
+    limiter = TokenBucketLimiter("test", capacity=1, rate=1)
+
+    async def acquire_twice():
+        return [await limiter.acquire("u"), await limiter.acquire("u")]
+
+    first, second = asyncio.run(acquire_twice())
+    assert first == 0 and second > 0
+    assert limiter.stats()["allowed"] == 1 and limiter.stats()["throttled"] == 1
+
+
+def test_rate_limited_response():
+    error = rate_limited(0.2, "请求过于频繁")
+    assert error.status_code == 429
+    assert error.headers == {"Retry-After": "1"}
+    assert rate_limited(12.1, "x").headers["Retry-After"] == "13"
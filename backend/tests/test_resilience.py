@@ -0,0 +1,99 @@
+import httpx
+import pytest
+from config import settings
+from resilience import CircuitBreaker, backoff_delay, is_retryable, is_upstream_failure
+
+
+@pytest.fixture
+def breaker(clock, monkeypatch):
+    monkeypatch.setattr(settings, "AI_BREAKER_ENABLED", True)
+    monkeypatch.setattr(settings, "AI_BREAKER_WINDOW", 60.0)
+    monkeypatch.setattr(settings, "AI_BREAKER_MIN_REQUESTS", 4)
+    monkeypatch.setattr(settings, "AI_BREAKER_ERROR_RATE", 0.5)
+    monkeypatch.setattr(settings, "AI_BREAKER_OPEN_SECONDS", 30.0)
+    return CircuitBreaker("test")
+
+
+def _open(breaker):
+    for _ in range(4):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_opens_when_error_rate_exceeded(breaker):
+    for ok in (True, True, False):
+        assert breaker.allow()
+        breaker.record_success() if ok else breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 1
+    assert not breaker.allow() and breaker.rejected == 1
+    assert breaker.retry_after == 30.0 and not breaker.available
+
+
+def test_old_outcomes_leave_the_window(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(61)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["requests"] == 1
+
+
+def test_half_open_allows_single_probe(breaker, clock):
+    _open(breaker)
+    clock.advance(30)
+    assert breaker.available
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.available
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.snapshot()["requests"] == 1
+
+
+def test_failed_probe_reopens(breaker, clock):
+    _open(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 2
+    assert breaker.retry_after == 30.0
+    clock.advance(29)
+    assert not breaker.allow()
+
+
+def test_released_probe_can_be_retaken(breaker, clock):
+    _open(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.state == "half_open" and breaker.available
+    assert breaker.allow()
+
+
+def test_disabled_breaker_always_allows(breaker, monkeypatch):
+    _open(breaker)
+    monkeypatch.setattr(settings, "AI_BREAKER_ENABLED", False)
+    assert breaker.allow()
+
+
+def _status_error(code):
+    request = httpx.Request("POST", "https://example.com")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(code, request=request))
+
+
+def test_error_classification():
+    assert is_upstream_failure(_status_error(503)) and is_retryable(_status_error(503))
+    assert not is_upstream_failure(_status_error(400)) and not is_retryable(_status_error(429))
+    assert is_upstream_failure(httpx.ConnectError("x")) and is_retryable(httpx.ConnectError("x"))
+    assert is_upstream_failure(httpx.ReadTimeout("x")) and not is_retryable(httpx.ReadTimeout("x"))
+    assert not is_upstream_failure(ValueError()) and not is_retryable(ValueError())
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr(settings, "AI_RETRY_BASE_DELAY", 0.5)
+    monkeypatch.setattr(settings, "AI_RETRY_MAX_DELAY", 4.0)
+    assert all(0 <= backoff_delay(attempt) <= min(4.0, 0.5 * 2 ** attempt) for attempt in range(10) for _ in range(20))
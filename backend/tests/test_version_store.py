@@ -0,0 +1,172 @@
+import random
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import select
+from config import settings
+from database import AsyncSessionLocal
+from diagram_patch import apply_json_patch
+from models import DiagramVersion
+from version_store import (
+    apply_delta,
+    apply_line_diff,
+    diff_json,
+    diff_lines,
+    make_delta,
+    version_store,
+)
+
+
+@pytest.mark.parametrize("old, new", [
+    ("", "a\nb\n"),
+    ("a\nb\nc", "a\nc"),
+    ("a\nb\nc\n", "x\nb\ny\nz\n"),
+    ("a\nb", "a\nb\n"),
+    ("a\nb\n", ""),
+])
+def test_line_diff_round_trip(old, new):
+    assert apply_line_diff(old, diff_lines(old, new)) == new
+
+
+def test_line_diff_random_round_trip():
+    rng = random.Random(7)
+    for _ in range(200):
+        old = "\n".join(rng.choice("abcd") for _ in range(rng.randint(0, 8)))
+        new = "\n".join(rng.choice("abcde") for _ in range(rng.randint(0, 8)))
+        assert apply_line_diff(old, diff_lines(old, new)) == new
+
+
+def _scene(*elements):
+    return {"type": "excalidraw", "elements": list(elements), "appState": {"gridSize": None}}
+
+
+@pytest.mark.parametrize("old, new", [
+    (_scene({"id": "a", "x": 1}), _scene({"id": "a", "x": 2})),
+    (_scene({"id": "a"}, {"id": "b"}, {"id": "c"}), _scene({"id": "c"}, {"id": "a", "y": 1})),
+    (_scene({"id": "a"}), _scene({"id": "b"}, {"id": "a"}, {"id": "c"})),
+    (_scene(), {"elements": None, "files": {"f/1": {"id": "x~"}}}),
+    ({"a": [1, 2, 3]}, {"a": [3, 2, 1, 2]}),
+    ({"a": 1}, [1, 2]),
+])
+def test_json_diff_round_trip(old, new):
+    assert apply_json_patch(old, diff_json(old, new)) == new
+
+
+def test_json_diff_updates_elements_in_place():
+    old = _scene({"id": "a", "x": 1, "label": "开始"}, {"id": "b", "x": 2})
+    new = _scene({"id": "a", "x": 5, "label": "开始"}, {"id": "b", "x": 2})
+    assert diff_json(old, new) == [{"op": "replace", "path": "/elements/0/x", "value": 5}]
+
+
+def test_delta_contains_only_changed_fields():
+    old = {"mermaid_code": "graph TD\nA --> B", "excalidraw_data": None}
+    new = {"mermaid_code": "graph TD\nA --> C", "excalidraw_data": None}
+    delta = make_delta(old, new)
+    assert list(delta) == ["mermaid_code"]
+    assert apply_delta(old, delta) == new
+    assert make_delta(old, old) == {}
+
+    cleared = {"mermaid_code": None, "excalidraw_data": _scene({"id": "a"})}
+    assert apply_delta(old, make_delta(old, cleared)) == cleared
+
+
+def _contents(count):
+    """逐步修改的版本内容序列"""
+    contents = []
+    lines = ["graph TD"]
+    elements = []
+    for index in range(count):
+        lines.append(f"N{index} --> N{index + 1}")
+        elements = elements + [{"id": f"e{index}", "x": index}]
+        if index % 3 == 0 and len(elements) > 1:
+            elements[0] = dict(elements[0], x=elements[0]["x"] + 100)
+        contents.append({"mermaid_code": "\n".join(lines), "excalidraw_data": _scene(*elements)})
+    return contents
+
+
+async def _record_all(contents, diagram_id=1):
+    diagram = SimpleNamespace(id=diagram_id, mermaid_code=None, excalidraw_data=None)
+    async with AsyncSessionLocal() as db:
+        for number, content in enumerate(contents, start=1):
+            diagram.mermaid_code = content["mermaid_code"]
+            diagram.excalidraw_data = content["excalidraw_data"]
+            assert await version_store.record(db, diagram, user_id=1) == number
+            await db.commit()
+
+
+async def _rows(diagram_id=1):
+    async with AsyncSessionLocal() as db:
+        return (await db.scalars(
+            select(DiagramVersion)
+            .where(DiagramVersion.diagram_id == diagram_id)
+            .order_by(DiagramVersion.version_number)
+        )).all()
+
+
+async def _reconstruct_all(numbers, diagram_id=1):
+    async with AsyncSessionLocal() as db:
+        return [await version_store.reconstruct(db, diagram_id, number) for number in numbers]
+
+
+def test_record_and_reconstruct(tables, run, monkeypatch):
+    monkeypatch.setattr(settings, "VERSION_SNAPSHOT_INTERVAL", 5)
+    # 增量比例放宽,保证除周期快照外都保存增量
+    monkeypatch.setattr(settings, "VERSION_DELTA_MAX_RATIO", 10.0)
+    contents = _contents(12)
+    run(_record_all(contents))
+
+    rows = run(_rows())
+    assert [row.version_number for row in rows if row.is_snapshot] == [1, 6, 11]
+    assert all(row.delta and row.mermaid_code is None for row in rows if not row.is_snapshot)
+    assert run(_reconstruct_all(range(1, 13))) == contents
+    assert run(_reconstruct_all([13])) == [None]
+
+
+def test_record_saves_baseline_as_first_version(tables, run):
+    before = {"mermaid_code": "graph TD\nA --> B", "excalidraw_data": None}
+    diagram = SimpleNamespace(id=1, mermaid_code="graph TD\nA --> C", excalidraw_data=None)
+
+    async def record():
+        async with AsyncSessionLocal() as db:
+            number = await version_store.record(db, diagram, user_id=1, baseline=before)
+            await db.commit()
+            return number
+
+    assert run(record()) == 2
+    assert run(_reconstruct_all([1, 2])) == [before, {"mermaid_code": diagram.mermaid_code, "excalidraw_data": None}]
+
+
+def test_large_delta_saved_as_snapshot(tables, run):
+    contents = [
+        {"mermaid_code": "graph TD\nA --> B", "excalidraw_data": None},
+        {"mermaid_code": "sequenceDiagram\nX->>Y: 完全不同的内容", "excalidraw_data": None},
+    ]
+    run(_record_all(contents))
+    assert [row.is_snapshot for row in run(_rows())] == [True, True]
+    assert run(_reconstruct_all([1, 2])) == contents
+
+
+def test_compaction_keeps_latest_versions(tables, run, monkeypatch):
+    monkeypatch.setattr(settings, "VERSION_SNAPSHOT_INTERVAL", 100)
+    monkeypatch.setattr(settings, "VERSION_DELTA_MAX_RATIO", 10.0)
+    monkeypatch.setattr(settings, "VERSION_MAX_COUNT", 4)
+    contents = _contents(10)
+    run(_record_all(contents))
+    run(_record_all(_contents(3), diagram_id=2))
+
+    run(version_store.compact(1))
+
+    rows = run(_rows())
+    assert [row.version_number for row in rows] == [7, 8, 9, 10]
+    assert rows[0].is_snapshot and rows[0].delta is None
+    assert run(_reconstruct_all(range(7, 11))) == contents[6:]
+    assert run(_reconstruct_all([6])) == [None]
+    # 其他图形的版本不受影响
+    assert len(run(_rows(2))) == 3
+
+
+def test_needs_compaction(monkeypatch):
+    monkeypatch.setattr(settings, "VERSION_MAX_COUNT", 100)
+    monkeypatch.setattr(settings, "VERSION_COMPACT_EVERY", 20)
+    assert not version_store.needs_compaction(100)
+    assert not version_store.needs_compaction(110)
+    assert version_store.needs_compaction(120)
@@ -0,0 +1,112 @@
+"""
+用户缓存 - 认证路径上避免每个请求都查询数据库
+"""
+import asyncio
+import json
+import logging
+from typing import Optional, Set
+import redis.asyncio as redis
+from sqlalchemy import event
+from config import settings
+from models import User
+from redis_client import get_redis
+from ai_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "user:"
+
+# 认证及 UserResponse 需要的字段
+CACHED_FIELDS = ("id", "username", "email", "avatar_url", "is_active")
+
+
+class UserCache:
+    """按用户 ID 缓存认证所需的用户字段
+
+    进程内 LRU 使用较短 TTL,Redis (启用时) 作为跨 worker 共享层。
+    用户更新时通过 SQLAlchemy 事件自动失效。
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(settings.USER_CACHE_MAX_ENTRIES, settings.USER_CACHE_TTL)
+        self.hits = 0
+        self.misses = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def get(self, user_id: int) -> Optional[User]:
+        """读取缓存的用户,返回未绑定会话的 User 对象"""
+        if not settings.USER_CACHE_ENABLED:
+            return None
+
+        raw = self.memory.get(str(user_id))
+        if raw is None:
+            client = get_redis()
+            if client is not None:
+                try:
+                    raw = await client.get(f"{REDIS_KEY_PREFIX}{user_id}")
+                except redis.RedisError as e:
+                    logger.warning("读取用户缓存失败: %s", e)
+                if raw is not None:
+                    self.memory.set(str(user_id), raw)
+
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return User(**json.loads(raw))
+
+    async def set(self, user: User):
+        """写入缓存"""
+        if not settings.USER_CACHE_ENABLED:
+            return
+
+        raw = json.dumps({field: getattr(user, field) for field in CACHED_FIELDS}, ensure_ascii=False)
+        self.memory.set(str(user.id), raw)
+        client = get_redis()
+        if client is not None:
+            try:
+                await client.set(f"{REDIS_KEY_PREFIX}{user.id}", raw, ex=settings.USER_CACHE_REDIS_TTL)
+            except redis.RedisError as e:
+                logger.warning("写入用户缓存失败: %s", e)
+
+    async def invalidate(self, user_id: int):
+        """使缓存失效"""
+        self.memory.delete(str(user_id))
+        client = get_redis()
+        if client is not None:
+            try:
+                await client.delete(f"{REDIS_KEY_PREFIX}{user_id}")
+            except redis.RedisError as e:
+                logger.warning("删除用户缓存失败: %s", e)
+
+    def invalidate_soon(self, user_id: int):
+        """在同步上下文 (如 ORM 事件) 中使缓存失效"""
+        self.memory.delete(str(user_id))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.invalidate(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> dict:
+        """缓存命中统计"""
+        return {
+            "enabled": settings.USER_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+        }
+
+
+# 全局用户缓存实例
+user_cache = UserCache()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user_cache(mapper, connection, target: User):
+    """用户被更新 (如禁用、修改资料) 或删除时使缓存失效"""
+    user_cache.invalidate_soon(target.id)
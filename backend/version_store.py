@@ -0,0 +1,357 @@
+"""
+版本历史 - 周期性完整快照 + 增量存储
+
+版本内容为 {"mermaid_code": ..., "excalidraw_data": ...}。
+增量版本的 delta 只包含变化的字段: Mermaid 代码为行级差异,Excalidraw 数据为 JSON Patch。
+读取任意版本时从不晚于它的最近快照开始依次应用增量,链长不超过 VERSION_SNAPSHOT_INTERVAL。
+"""
+import difflib
+import json
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Hashable, List, Optional
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from database import AsyncSessionLocal
+from models import Diagram, DiagramVersion
+from diagram_patch import PatchError, apply_json_patch
+
+logger = logging.getLogger(__name__)
+
+CONTENT_FIELDS = ("mermaid_code", "excalidraw_data")
+
+
+# ===== 差异计算 =====
+
+def diff_lines(old: str, new: str) -> List[list]:
+    """计算文本的行级差异: [[起始行, 结束行, 新行列表], ...],行号为旧文本的 0 起始下标"""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [
+        [i1, i2, new_lines[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def apply_line_diff(text: str, edits: List[list]) -> str:
+    """应用 diff_lines 生成的行级差异"""
+    lines = text.splitlines(keepends=True)
+    # 从后往前应用,前面的行号不受影响
+    for start, end, new_lines in reversed(edits):
+        lines[start:end] = new_lines
+    return "".join(lines)
+
+
+def _escape_pointer(key: Any) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _element_key(item: Any) -> Hashable:
+    """数组元素的匹配键: Excalidraw 元素按 id 匹配,以便生成字段级的补丁"""
+    if isinstance(item, dict) and isinstance(item.get("id"), str):
+        return ("id", item["id"])
+    return ("value", json.dumps(item, sort_keys=True, ensure_ascii=False))
+
+
+def diff_json(old: Any, new: Any, path: str = "") -> List[dict]:
+    """计算把 old 变为 new 的 JSON Patch,可由 diagram_patch.apply_json_patch 按顺序应用"""
+    if type(old) is not type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+
+    if isinstance(old, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(key)}"})
+        for key, value in new.items():
+            child = f"{path}/{_escape_pointer(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": child, "value": value})
+            else:
+                ops.extend(diff_json(old[key], value, child))
+        return ops
+
+    if isinstance(old, list):
+        return _diff_list(old, new, path)
+
+    return [] if old == new else [{"op": "replace", "path": path, "value": new}]
+
+
+def _diff_list(old: list, new: list, path: str) -> List[dict]:
+    matcher = difflib.SequenceMatcher(
+        None, [_element_key(item) for item in old], [_element_key(item) for item in new], autojunk=False
+    )
+    ops = []
+    # 从后往前生成,每个操作的下标在应用到当前文档时都有效
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal" or (tag == "replace" and i2 - i1 == j2 - j1):
+            for offset in reversed(range(i2 - i1)):
+                ops.extend(diff_json(old[i1 + offset], new[j1 + offset], f"{path}/{i1 + offset}"))
+            continue
+        for index in reversed(range(i1, i2)):
+            ops.append({"op": "remove", "path": f"{path}/{index}"})
+        for offset, item in enumerate(new[j1:j2]):
+            ops.append({"op": "add", "path": f"{path}/{i1 + offset}", "value": item})
+    return ops
+
+
+def make_delta(old: Dict[str, Any], new: Dict[str, Any]) -> dict:
+    """计算两个版本内容之间的增量,只包含变化的字段"""
+    delta = {}
+    if old["mermaid_code"] != new["mermaid_code"]:
+        if isinstance(old["mermaid_code"], str) and isinstance(new["mermaid_code"], str):
+            delta["mermaid_code"] = {"lines": diff_lines(old["mermaid_code"], new["mermaid_code"])}
+        else:
+            delta["mermaid_code"] = {"value": new["mermaid_code"]}
+    if old["excalidraw_data"] != new["excalidraw_data"]:
+        delta["excalidraw_data"] = {"patch": diff_json(old["excalidraw_data"], new["excalidraw_data"])}
+    return delta
+
+
+def apply_delta(content: Dict[str, Any], delta: dict) -> Dict[str, Any]:
+    """在版本内容上应用增量,返回新的内容"""
+    result = dict(content)
+    mermaid = delta.get("mermaid_code")
+    if mermaid is not None:
+        if "lines" in mermaid:
+            result["mermaid_code"] = apply_line_diff(content["mermaid_code"], mermaid["lines"])
+        else:
+            result["mermaid_code"] = mermaid["value"]
+    excalidraw = delta.get("excalidraw_data")
+    if excalidraw is not None:
+        result["excalidraw_data"] = apply_json_patch(content["excalidraw_data"], excalidraw["patch"])
+    return result
+
+
+def _size(value: Any) -> int:
+    return len(json.dumps(value, ensure_ascii=False))
+
+
+def unified_diff(old: Optional[str], new: Optional[str], old_label: str, new_label: str) -> str:
+    """两个版本 Mermaid 代码的统一 diff 文本"""
+    return "\n".join(difflib.unified_diff(
+        (old or "").splitlines(),
+        (new or "").splitlines(),
+        fromfile=old_label,
+        tofile=new_label,
+        lineterm="",
+    ))
+
+
+# ===== 存储 =====
+
+def content_of(obj: Any) -> Dict[str, Any]:
+    """图形或快照版本的内容"""
+    return {field: getattr(obj, field) for field in CONTENT_FIELDS}
+
+
+class VersionStore:
+    """图形版本的写入、重建与压缩"""
+
+    async def latest_number(self, db: AsyncSession, diagram_id: int) -> Optional[int]:
+        return await db.scalar(
+            select(func.max(DiagramVersion.version_number)).where(DiagramVersion.diagram_id == diagram_id)
+        )
+
+    async def reconstruct(self, db: AsyncSession, diagram_id: int, version_number: int) -> Optional[Dict[str, Any]]:
+        """重建指定版本的内容,版本不存在时返回 None"""
+        base = (
+            select(func.max(DiagramVersion.version_number))
+            .where(
+                DiagramVersion.diagram_id == diagram_id,
+                DiagramVersion.version_number <= version_number,
+                DiagramVersion.is_snapshot == True
+            )
+            .scalar_subquery()
+        )
+        rows = (await db.execute(
+            select(
+                DiagramVersion.version_number,
+                DiagramVersion.is_snapshot,
+                DiagramVersion.mermaid_code,
+                DiagramVersion.excalidraw_data,
+                DiagramVersion.delta
+            )
+            .where(
+                DiagramVersion.diagram_id == diagram_id,
+                DiagramVersion.version_number >= base,
+                DiagramVersion.version_number <= version_number
+            )
+            .order_by(DiagramVersion.version_number)
+        )).all()
+        if not rows or rows[-1].version_number != version_number:
+            return None
+
+        content = content_of(rows[0])
+        try:
+            for row in rows[1:]:
+                content = content_of(row) if row.is_snapshot else apply_delta(content, row.delta or {})
+        except (PatchError, IndexError, KeyError, TypeError) as e:
+            logger.error("重建版本失败 (diagram=%s, version=%s): %s", diagram_id, version_number, e)
+            raise HTTPException(status_code=500, detail="版本数据已损坏")
+        return content
+
+    async def record(
+        self,
+        db: AsyncSession,
+        diagram: Diagram,
+        user_id: int,
+        description: Optional[str] = None,
+        baseline: Optional[Dict[str, Any]] = None,
+        coalesce_window: Optional[float] = None
+    ) -> int:
+        """把图形的当前内容记录为新版本 (不提交),返回版本号
+
+        图形还没有版本时,先把 baseline (修改前的内容) 保存为版本 1。
+        与上一版本相比增量过大,或距上一快照已有 VERSION_SNAPSHOT_INTERVAL 个版本时保存完整快照。
+        指定 coalesce_window 时,同一用户在该时间窗口内的连续保存合并到最新版本 (用于自动保存)。
+        """
+        current = content_of(diagram)
+        latest = await self.latest_number(db, diagram.id)
+        if latest is None:
+            if baseline is None or baseline == current:
+                self._add(db, diagram.id, 1, user_id, description, current)
+                return 1
+            self._add(db, diagram.id, 1, user_id, "初始版本", baseline)
+            latest, previous = 1, baseline
+        else:
+            if coalesce_window and await self._coalesce(db, diagram.id, latest, user_id, current, coalesce_window):
+                return latest
+            previous = await self.reconstruct(db, diagram.id, latest)
+
+        version_number = latest + 1
+        last_snapshot = await db.scalar(
+            select(func.max(DiagramVersion.version_number)).where(
+                DiagramVersion.diagram_id == diagram.id,
+                DiagramVersion.is_snapshot == True
+            )
+        ) or 1
+        self._add(
+            db, diagram.id, version_number, user_id, description, current, previous,
+            force_snapshot=version_number - last_snapshot >= settings.VERSION_SNAPSHOT_INTERVAL
+        )
+        return version_number
+
+    async def _coalesce(
+        self,
+        db: AsyncSession,
+        diagram_id: int,
+        latest: int,
+        user_id: int,
+        current: Dict[str, Any],
+        window: float
+    ) -> bool:
+        """把当前内容合并到最新版本,版本 1 作为修改前的基线不参与合并"""
+        if latest <= 1:
+            return False
+        row = await db.scalar(
+            select(DiagramVersion).where(
+                DiagramVersion.diagram_id == diagram_id,
+                DiagramVersion.version_number == latest
+            )
+        )
+        # 使用数据库时钟,与 created_at 的默认值一致
+        now = await db.scalar(select(func.now()))
+        if row is None or row.changed_by != user_id or row.created_at is None or now is None:
+            return False
+        if now.replace(tzinfo=None) - row.created_at.replace(tzinfo=None) > timedelta(seconds=window):
+            return False
+
+        previous = await self.reconstruct(db, diagram_id, latest - 1)
+        if previous is None:
+            return False
+        self._fill(row, current, previous, force_snapshot=row.is_snapshot)
+        return True
+
+    def _add(
+        self,
+        db: AsyncSession,
+        diagram_id: int,
+        version_number: int,
+        user_id: int,
+        description: Optional[str],
+        current: Dict[str, Any],
+        previous: Optional[Dict[str, Any]] = None,
+        force_snapshot: bool = False
+    ):
+        row = DiagramVersion(
+            diagram_id=diagram_id,
+            version_number=version_number,
+            changed_by=user_id,
+            change_description=description[:500] if description else None
+        )
+        self._fill(row, current, previous, force_snapshot)
+        db.add(row)
+
+    def _fill(
+        self,
+        row: DiagramVersion,
+        current: Dict[str, Any],
+        previous: Optional[Dict[str, Any]],
+        force_snapshot: bool
+    ):
+        """写入版本内容: 没有上一版本、要求快照或增量过大时保存完整内容,否则保存增量"""
+        delta = make_delta(previous, current) if previous is not None else None
+        if force_snapshot or delta is None or _size(delta) > settings.VERSION_DELTA_MAX_RATIO * _size(current):
+            row.is_snapshot = True
+            row.mermaid_code = current["mermaid_code"]
+            row.excalidraw_data = current["excalidraw_data"]
+            row.delta = None
+        else:
+            row.is_snapshot = False
+            row.mermaid_code = None
+            row.excalidraw_data = None
+            row.delta = delta
+
+    def needs_compaction(self, version_number: int) -> bool:
+        """每新增 VERSION_COMPACT_EVERY 个版本压缩一次,保存的版本数不超过两者之和"""
+        return (
+            version_number > settings.VERSION_MAX_COUNT
+            and version_number % settings.VERSION_COMPACT_EVERY == 0
+        )
+
+    async def compact(self, diagram_id: int):
+        """只保留最近 VERSION_MAX_COUNT 个版本,最早保留的版本转为快照 (后台任务)"""
+        try:
+            async with AsyncSessionLocal() as db:
+                latest = await self.latest_number(db, diagram_id)
+                if latest is None:
+                    return
+                cutoff = latest - settings.VERSION_MAX_COUNT + 1
+                oldest = await db.scalar(
+                    select(func.min(DiagramVersion.version_number)).where(DiagramVersion.diagram_id == diagram_id)
+                )
+                if oldest is None or oldest >= cutoff:
+                    return
+
+                row = await db.scalar(
+                    select(DiagramVersion).where(
+                        DiagramVersion.diagram_id == diagram_id,
+                        DiagramVersion.version_number == cutoff
+                    )
+                )
+                if row is None:
+                    return
+                if not row.is_snapshot:
+                    content = await self.reconstruct(db, diagram_id, cutoff)
+                    row.is_snapshot = True
+                    row.mermaid_code = content["mermaid_code"]
+                    row.excalidraw_data = content["excalidraw_data"]
+                    row.delta = None
+                await db.execute(
+                    delete(DiagramVersion).where(
+                        DiagramVersion.diagram_id == diagram_id,
+                        DiagramVersion.version_number < cutoff
+                    )
+                )
+                await db.commit()
+        except Exception as e:
+            logger.warning("压缩版本历史失败 (diagram=%s): %s", diagram_id, e)
+
+
+# 全局版本存储实例
+version_store = VersionStore()
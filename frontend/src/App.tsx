@@ -309,26 +309,31 @@ export default function App() {
         saveToHistory(newState)
       } else if (activeTab === DiagramType.EXCALIDRAW) {
         // Excalidraw 模式：后端可能返回 Excalidraw JSON 或 Mermaid 代码
-        const dataContent = response.data || response.code || ''
+        // 元素列表已由后端解析校验，字符串为 Mermaid 代码或旧格式的 JSON 文本
+        const dataContent = typeof response.data === 'string' ? response.data : (response.code || '')
         
         console.log('📦 [AI生成] 后端返回数据:', {
           hasData: !!response.data,
           hasCode: !!response.code,
-          dataLength: dataContent.length,
+          elementCount: Array.isArray(response.data) ? response.data.length : undefined,
           dataPreview: dataContent.substring(0, 200)
         })
         
-        if (!dataContent || dataContent.trim() === '') {
+        if (!Array.isArray(response.data) && (!dataContent || dataContent.trim() === '')) {
           throw new Error('后端返回的图表数据为空')
         }
         
         try {
           // 尝试解析为 JSON，判断是否为 Excalidraw 格式
           let parsedData: any
-          try {
-            parsedData = JSON.parse(dataContent)
-          } catch {
-            parsedData = null
+          if (Array.isArray(response.data)) {
+            parsedData = response.data
+          } else {
+            try {
+              parsedData = JSON.parse(dataContent)
+            } catch {
+              parsedData = null
+            }
           }
 
           let elements: ExcalidrawElement[] = []
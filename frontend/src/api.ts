@@ -7,14 +7,60 @@ export interface GenerateDiagramRequest {
   diagram_type: DiagramType
   model?: string
   chart_type?: string
+  bypass_cache?: boolean  // 跳过服务端缓存，强制重新生成
+}
+
+// 后端校验后的 Excalidraw 元素 (矩形/椭圆/菱形/箭头/线条/文本)
+export interface GeneratedElement {
+  type: 'rectangle' | 'ellipse' | 'diamond' | 'arrow' | 'line' | 'text'
+  x?: number
+  y?: number
+  width?: number
+  height?: number
+  startX?: number
+  startY?: number
+  endX?: number
+  endY?: number
+  points?: number[][]
+  label?: string
+  text?: string
+  fontSize?: number
+  [key: string]: unknown
 }
 
 export interface GenerateDiagramResponse {
   code?: string  // Mermaid 模式下返回
-  data?: string  // Excalidraw 模式下返回
+  data?: GeneratedElement[] | string  // Excalidraw 模式下返回元素列表,模型返回 Mermaid 代码时为字符串
   diagram_type: string
 }
 
+export interface BatchTarget {
+  chart_type: string
+  diagram_type?: DiagramType
+  model?: string
+}
+
+export interface GenerateBatchRequest {
+  prompt: string
+  targets: BatchTarget[]
+  model?: string
+  bypass_cache?: boolean
+}
+
+// 批量生成中单个目标的结果,index 对应请求中 targets 的下标
+export interface BatchResult extends GenerateDiagramResponse {
+  index: number
+  chart_type: string
+  model: string
+}
+
+export interface BatchError {
+  index: number
+  chart_type: string
+  model: string
+  detail: string
+}
+
 export interface AuthResponse {
   access_token: string
   token_type: string
@@ -34,8 +80,74 @@ export interface DiagramResponse {
   render_engine: DiagramType
   mermaid_code?: string | null
   excalidraw_data?: any
+  thumbnail_url?: string | null
   created_at: string
   updated_at?: string | null
+  revision: number
+}
+
+export interface TemplateSummary {
+  id: number
+  name: string
+  category: string
+  diagram_type: DiagramType
+  render_engine: DiagramType
+  thumbnail_url: string
+  description?: string | null
+  usage_count: number
+  is_featured: boolean
+}
+
+export interface TemplateDetail extends TemplateSummary {
+  mermaid_code?: string | null
+  excalidraw_data?: any
+}
+
+export interface TemplateListResponse {
+  items: TemplateSummary[]
+  categories: string[]
+}
+
+export interface DiagramUpdateRequest {
+  title?: string
+  description?: string | null
+  tags?: string[]
+  is_public?: boolean
+  mermaid_code?: string | null
+  excalidraw_data?: any
+  excalidraw_patch?: any[]
+  elements?: any[]  // 按 id 更新或追加的 Excalidraw 元素
+  svg_content?: string | null
+  change_description?: string
+}
+
+export interface DiagramUpdateResult {
+  diagram: DiagramResponse
+  etag: string | null
+}
+
+export interface DiagramRefineResponse {
+  diagram: DiagramResponse
+  version_number: number
+  patch: any[]
+}
+
+export interface DiagramVersionItem {
+  version_number: number
+  is_snapshot: boolean
+  changed_by: number
+  change_description?: string | null
+  created_at?: string | null
+}
+
+export interface DiagramVersionListResponse {
+  items: DiagramVersionItem[]
+  next_before?: number | null
+}
+
+export interface DiagramRestoreResponse {
+  diagram: DiagramResponse
+  version_number: number
 }
 
 export interface DiagramCreateRequest {
@@ -43,6 +155,7 @@ export interface DiagramCreateRequest {
   diagram_type: DiagramType
   mermaid_code?: string | null
   excalidraw_data?: any
+  svg_content?: string | null
 }
 
 export interface RegisterRequest {
@@ -201,6 +314,143 @@ export async function generateDiagram(data: GenerateDiagramRequest): Promise<Gen
   return await response.json()
 }
 
+// 流式生成图表 (SSE)，每收到一段增量文本调用 onDelta，Excalidraw 元素完整后调用 onElement，返回完整内容
+export async function generateDiagramStream(
+  data: GenerateDiagramRequest,
+  onDelta: (text: string, content: string) => void,
+  onElement?: (element: GeneratedElement) => void
+): Promise<string | GeneratedElement[]> {
+  const token = getToken()
+
+  const headers: HeadersInit = {
+    'Content-Type': 'application/json',
+  }
+
+  if (token) {
+    headers['Authorization'] = `Bearer ${token}`
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/ai/generate/stream`, {
+    method: 'POST',
+    headers,
+    body: JSON.stringify(data),
+  })
+
+  if (!response.ok || !response.body) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '生成失败')
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  let content = ''
+
+  while (true) {
+    const { done, value } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+
+    // SSE 事件以空行分隔
+    let boundary = buffer.indexOf('\n\n')
+    while (boundary >= 0) {
+      const raw = buffer.slice(0, boundary)
+      buffer = buffer.slice(boundary + 2)
+      boundary = buffer.indexOf('\n\n')
+
+      const event = raw.match(/^event: (.*)$/m)?.[1]
+      const payload = raw.match(/^data: (.*)$/m)?.[1]
+      if (!event || !payload) continue
+
+      const message = JSON.parse(payload)
+      if (event === 'delta') {
+        content += message.text
+        onDelta(message.text, content)
+      } else if (event === 'element') {
+        onElement?.(message.element)
+      } else if (event === 'done') {
+        return message.content
+      } else if (event === 'error') {
+        throw new Error(message.detail || '生成失败')
+      }
+    }
+  }
+
+  return content
+}
+
+// 同一提示词批量生成多种图表，每个目标完成后立即回调，返回成功与失败的数量
+export async function generateDiagramBatch(
+  data: GenerateBatchRequest,
+  onResult: (result: BatchResult) => void,
+  onError?: (error: BatchError) => void
+): Promise<{ succeeded: number; failed: number }> {
+  const token = getToken()
+
+  const headers: HeadersInit = {
+    'Content-Type': 'application/json',
+  }
+
+  if (token) {
+    headers['Authorization'] = `Bearer ${token}`
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/ai/generate/batch`, {
+    method: 'POST',
+    headers,
+    body: JSON.stringify(data),
+  })
+
+  if (!response.ok || !response.body) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '生成失败')
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+
+  while (true) {
+    const { done, value } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+
+    let boundary = buffer.indexOf('\n\n')
+    while (boundary >= 0) {
+      const raw = buffer.slice(0, boundary)
+      buffer = buffer.slice(boundary + 2)
+      boundary = buffer.indexOf('\n\n')
+
+      const event = raw.match(/^event: (.*)$/m)?.[1]
+      const payload = raw.match(/^data: (.*)$/m)?.[1]
+      if (!event || !payload) continue
+
+      const message = JSON.parse(payload)
+      if (event === 'result') {
+        onResult(message)
+      } else if (event === 'error') {
+        // 带 index 的错误只影响对应目标，否则整个批次失败
+        if (typeof message.index !== 'number') {
+          throw new Error(message.detail || '生成失败')
+        }
+        onError?.(message)
+      } else if (event === 'done') {
+        return message
+      }
+    }
+  }
+
+  throw new Error('生成中断')
+}
+
 // 检查是否已登录
 export function isAuthenticated(): boolean {
   return !!getToken()
@@ -234,3 +484,326 @@ export async function saveDiagram(data: DiagramCreateRequest): Promise<DiagramRe
 
   return await response.json()
 }
+
+// AI 增量修改已保存的图形（服务端只请求补丁并保存为新版本）
+export async function refineDiagram(diagramId: number, instruction: string, model?: string): Promise<DiagramRefineResponse> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/diagrams/${diagramId}/refine`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`,
+    },
+    body: JSON.stringify(model ? { instruction, model } : { instruction }),
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || 'AI 修改失败')
+  }
+
+  return await response.json()
+}
+
+// 部分更新图形，etag 不为空时作为 If-Match 条件（不一致返回 412）
+export async function updateDiagram(
+  diagramId: number,
+  data: DiagramUpdateRequest,
+  options: { etag?: string | null; autosave?: boolean } = {}
+): Promise<DiagramUpdateResult> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const headers: Record<string, string> = {
+    'Content-Type': 'application/json',
+    'Authorization': `Bearer ${token}`,
+  }
+  if (options.etag) {
+    headers['If-Match'] = options.etag
+  }
+
+  const query = options.autosave ? '?autosave=true' : ''
+  const response = await fetch(`${API_BASE_URL}/api/diagrams/${diagramId}${query}`, {
+    method: 'PATCH',
+    headers,
+    body: JSON.stringify(data),
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    if (response.status === 412) {
+      throw new Error('图形已在其他地方被修改，请刷新后重试')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '保存失败')
+  }
+
+  return { diagram: await response.json(), etag: response.headers.get('ETag') }
+}
+
+// 合并两次未提交的修改：元素按 id 取最新，其余字段后者覆盖前者
+function mergeUpdates(previous: DiagramUpdateRequest, next: DiagramUpdateRequest): DiagramUpdateRequest {
+  const merged: DiagramUpdateRequest = { ...previous, ...next }
+  if (next.excalidraw_data !== undefined) {
+    // 整体替换已包含之前的元素修改
+    delete merged.elements
+    delete merged.excalidraw_patch
+  } else if (previous.elements && next.elements) {
+    const byId = new Map<string, any>()
+    for (const element of [...previous.elements, ...next.elements]) {
+      byId.set(element.id, element)
+    }
+    merged.elements = Array.from(byId.values())
+  }
+  if (previous.excalidraw_patch && next.excalidraw_patch) {
+    merged.excalidraw_patch = [...previous.excalidraw_patch, ...next.excalidraw_patch]
+  }
+  return merged
+}
+
+// 自动保存：修改在 delayMs 内去抖并合并为一次 PATCH，同一时间只有一个请求在途
+export function createAutosaver(
+  diagramId: number,
+  etag: string | null,
+  options: { delayMs?: number; onSaved?: (diagram: DiagramResponse) => void; onError?: (error: Error) => void } = {}
+) {
+  const delayMs = options.delayMs ?? 2000
+  let currentEtag = etag
+  let pending: DiagramUpdateRequest | null = null
+  let timer: ReturnType<typeof setTimeout> | null = null
+  let inFlight: Promise<void> | null = null
+
+  const flush = async (): Promise<void> => {
+    if (timer) {
+      clearTimeout(timer)
+      timer = null
+    }
+    if (inFlight) {
+      await inFlight
+    }
+    if (!pending) {
+      return
+    }
+    const data = pending
+    pending = null
+    inFlight = updateDiagram(diagramId, data, { etag: currentEtag, autosave: true })
+      .then((result) => {
+        currentEtag = result.etag ?? currentEtag
+        options.onSaved?.(result.diagram)
+      })
+      .catch((error: Error) => {
+        options.onError?.(error)
+      })
+      .finally(() => {
+        inFlight = null
+      })
+    await inFlight
+  }
+
+  return {
+    schedule(update: DiagramUpdateRequest) {
+      pending = pending ? mergeUpdates(pending, update) : update
+      if (timer) {
+        clearTimeout(timer)
+      }
+      timer = setTimeout(() => {
+        void flush()
+      }, delayMs)
+    },
+    flush,
+    get etag() {
+      return currentEtag
+    },
+  }
+}
+
+export async function getDiagramVersions(diagramId: number, before?: number): Promise<DiagramVersionListResponse> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const query = before ? `?before=${before}` : ''
+  const response = await fetch(`${API_BASE_URL}/api/diagrams/${diagramId}/versions${query}`, {
+    headers: {
+      'Authorization': `Bearer ${token}`,
+    },
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '获取版本历史失败')
+  }
+
+  return await response.json()
+}
+
+export async function restoreDiagramVersion(diagramId: number, versionNumber: number): Promise<DiagramRestoreResponse> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/diagrams/${diagramId}/versions/${versionNumber}/restore`, {
+    method: 'POST',
+    headers: {
+      'Authorization': `Bearer ${token}`,
+    },
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '恢复版本失败')
+  }
+
+  return await response.json()
+}
+
+export interface MermaidConvertResponse {
+  chart_type: string
+  excalidraw_data: any
+}
+
+// 服务端确定性转换 Mermaid 代码为 Excalidraw 场景（流程图、状态图、时序图），不调用模型
+export async function convertMermaidToScene(mermaidCode: string): Promise<MermaidConvertResponse> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/convert/mermaid-to-excalidraw`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`,
+    },
+    body: JSON.stringify({ mermaid_code: mermaidCode }),
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '转换失败')
+  }
+
+  return await response.json()
+}
+
+// 把已保存图形的 Mermaid 代码转换为 Excalidraw 数据并切换渲染引擎
+export async function convertDiagramToExcalidraw(diagramId: number): Promise<DiagramResponse> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/diagrams/${diagramId}/convert`, {
+    method: 'POST',
+    headers: {
+      'Authorization': `Bearer ${token}`,
+    },
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '转换失败')
+  }
+
+  return await response.json()
+}
+
+// 打开图形的实时协作连接（浏览器无法为 WebSocket 设置请求头，令牌通过查询参数传递）
+export function openCollabSocket(diagramId: number): WebSocket {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const url = new URL(`/api/diagrams/${diagramId}/ws`, API_BASE_URL)
+  url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
+  url.searchParams.set('token', token)
+  return new WebSocket(url.toString())
+}
+
+async function templateRequest<T>(path: string, init: RequestInit = {}): Promise<T> {
+  const token = getToken()
+
+  if (!token) {
+    throw new Error('未登录，请先登录')
+  }
+
+  const response = await fetch(`${API_BASE_URL}${path}`, {
+    ...init,
+    headers: {
+      ...(init.body ? { 'Content-Type': 'application/json' } : {}),
+      'Authorization': `Bearer ${token}`,
+    },
+  })
+
+  if (!response.ok) {
+    if (response.status === 401) {
+      removeToken()
+      throw new Error('登录已过期，请重新登录')
+    }
+    const error = await response.json()
+    throw new Error(error.detail || '获取模板失败')
+  }
+
+  return await response.json()
+}
+
+// 模板列表 (不含内容)；服务端返回 ETag，浏览器缓存会自动携带 If-None-Match 重新验证
+export function getTemplates(params: { category?: string; featured?: boolean; q?: string } = {}): Promise<TemplateListResponse> {
+  const query = new URLSearchParams()
+  if (params.category) query.set('category', params.category)
+  if (params.featured !== undefined) query.set('featured', String(params.featured))
+  if (params.q) query.set('q', params.q)
+  const suffix = query.toString() ? `?${query}` : ''
+  return templateRequest<TemplateListResponse>(`/api/templates${suffix}`)
+}
+
+export function getTemplate(templateId: number): Promise<TemplateDetail> {
+  return templateRequest<TemplateDetail>(`/api/templates/${templateId}`)
+}
+
+// 以模板内容创建新图形
+export function instantiateTemplate(templateId: number, title?: string): Promise<DiagramResponse> {
+  return templateRequest<DiagramResponse>(`/api/templates/${templateId}/instantiate`, {
+    method: 'POST',
+    body: JSON.stringify({ title }),
+  })
+}
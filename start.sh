@@ -56,6 +56,7 @@ elif [ "$choice" == "2" ]; then
     fi
     source venv/bin/activate
     pip install -r requirements.txt > /dev/null 2>&1
+    python migrate.py
     python main.py &
     BACKEND_PID=$!
     cd ..